@@ -1,32 +1,20 @@
 
+import numbers
 import os
-from datetime import date, time
+from contextlib import contextmanager
+from datetime import date, time, timedelta
 from typing import Any, Dict, List, Optional, Tuple
 import re
+import threading
+import uuid
 
-
-# ===================== HELPER: inferir método pela descrição =====================
-def _guess_method_from_desc(desc: str) -> str:
-    d = (str(desc) if desc is not None else "").upper()
-    if "PIX" in d or "QRCODE" in d or "QR CODE" in d or "CHAVE" in d:
-        return "pix"
-    if "TED" in d or "TEF" in d or "DOC" in d or "TRANSFER" in d or "TRANSFERÊNCIA" in d or "TRANSFERENCIA" in d:
-        return "transferência"
-    if any(k in d for k in ["PAYGO","PAGSEGURO","STONE","CIELO","REDE","GETNET","MERCADO PAGO","VISA","MASTERCARD","ELO"]):
-        return "cartão crédito"
-    if "DÉBITO" in d or "DEBITO" in d:
-        return "cartão débito"
-    if "BOLETO" in d:
-        return "boleto"
-    if "SAQUE" in d or "ATM" in d:
-        return "dinheiro"
-    return "outro"
-
-
+import numpy as np
 import pandas as pd
 import psycopg, psycopg.rows
 import streamlit as st
 
+from sisget import bank, brl, ifood, nfe, products, rules, services
+
 # ===================== CONFIG =====================
 st.set_page_config(
     page_title="SISGET",
@@ -93,6 +81,269 @@ def qexec(sql: str, params=None):
                 cur.execute(sql, params)
             return cur.rowcount or 0
 
+@contextmanager
+def qtx():
+    """Cursor numa única conexão/transação: commit ao sair, rollback se der erro."""
+    with _get_conn() as con:
+        with con.transaction():
+            with con.cursor() as cur:
+                yield cur
+
+# ===================== Invalidação de cache entre sessões (LISTEN/NOTIFY) =====================
+# Triggers por comando nas tabelas-chave fazem pg_notify(CACHE_NOTIFY_CHANNEL, <tabela>). Uma thread por
+# processo escuta o canal e limpa os @st.cache_data registrados com @invalidated_by(<tabela>): o que outra
+# sessão (ou a API/CLI) grava aparece na hora, e o TTL vira só rede de segurança.
+CACHE_NOTIFY_CHANNEL = "sisget_cache"
+CACHE_NOTIFY_TABLES = ("product", "supplier", "cash_category", "cash_rule", "inventory_movement", "cashbook",
+                       "period_close")
+CACHE_LISTENER_MAX_BACKOFF = 60   # s entre tentativas de reconexão
+_CACHE_DEPS: Dict[str, List[Any]] = {}
+
+def invalidated_by(*tables: str):
+    """Decorador (acima do @st.cache_data): o cache da função é limpo quando alguma das tabelas mudar."""
+    def deco(fn):
+        for t in tables:
+            _CACHE_DEPS.setdefault(t, []).append(fn)
+        return fn
+    return deco
+
+def _invalidate_caches(table: Optional[str] = None) -> None:
+    """Limpa os caches dependentes de `table` (None = todos)."""
+    fns = _CACHE_DEPS.get(table, []) if table else [f for fs in _CACHE_DEPS.values() for f in fs]
+    for fn in {id(f): f for f in fns}.values():
+        fn.clear()
+
+@st.cache_resource(show_spinner=False)
+def _ensure_cache_notify_schema():
+    qexec("""
+    create or replace function resto.fn_notify_change() returns trigger language plpgsql as $$
+    begin
+      perform pg_notify(TG_ARGV[0], TG_TABLE_NAME);   -- repetidos na mesma transação viram 1 só
+      return null;
+    end $$;
+
+    -- trigger de comando dispara mesmo sem linhas (insert ... on conflict, delete sem alvo):
+    -- só avisa se a tabela de transição tiver algo; no update, só se alguma linha mudou de fato
+    create or replace function resto.fn_notify_rows() returns trigger language plpgsql as $$
+    begin
+      if TG_OP = 'UPDATE' then
+        if exists (select t::text from changed_rows t except select t::text from old_rows t) then
+          perform pg_notify(TG_ARGV[0], TG_TABLE_NAME);
+        end if;
+      elsif exists (select 1 from changed_rows) then
+        perform pg_notify(TG_ARGV[0], TG_TABLE_NAME);
+      end if;
+      return null;
+    end $$;
+    """)
+    # insert/update/delete: 1 aviso por comando que mudou linhas (update em massa não gera 1 por linha);
+    # truncate: sempre. Assim os upserts das categorias que rodam a cada tela (linha já existe → nada
+    # muda) não invalidam cash_categories()/cash_rules().
+    for t in CACHE_NOTIFY_TABLES:
+        qexec(f"""
+        do $$ begin
+          if to_regclass('resto.{t}') is null then
+            return;
+          end if;
+          if exists (select 1 from pg_trigger
+                      where tgname = 'trg_{t}_notify' and tgrelid = 'resto.{t}'::regclass) then
+            drop trigger trg_{t}_notify on resto.{t};   -- versão antiga: insert/delete/truncate juntos
+          end if;
+          if not exists (select 1 from pg_trigger
+                          where tgname = 'trg_{t}_notify_ins' and tgrelid = 'resto.{t}'::regclass) then
+            create trigger trg_{t}_notify_ins
+              after insert on resto.{t}
+              referencing new table as changed_rows
+              for each statement execute function resto.fn_notify_rows('{CACHE_NOTIFY_CHANNEL}');
+          end if;
+          if not exists (select 1 from pg_trigger
+                          where tgname = 'trg_{t}_notify_del' and tgrelid = 'resto.{t}'::regclass) then
+            create trigger trg_{t}_notify_del
+              after delete on resto.{t}
+              referencing old table as changed_rows
+              for each statement execute function resto.fn_notify_rows('{CACHE_NOTIFY_CHANNEL}');
+          end if;
+          if not exists (select 1 from pg_trigger
+                          where tgname = 'trg_{t}_notify_trunc' and tgrelid = 'resto.{t}'::regclass) then
+            create trigger trg_{t}_notify_trunc
+              after truncate on resto.{t}
+              for each statement execute function resto.fn_notify_change('{CACHE_NOTIFY_CHANNEL}');
+          end if;
+          if exists (select 1 from pg_trigger
+                      where tgname = 'trg_{t}_notify_upd' and tgrelid = 'resto.{t}'::regclass
+                        and tgtype & 1 = 1) then
+            drop trigger trg_{t}_notify_upd on resto.{t};   -- versão antiga: por linha
+          end if;
+          if not exists (select 1 from pg_trigger
+                          where tgname = 'trg_{t}_notify_upd' and tgrelid = 'resto.{t}'::regclass) then
+            create trigger trg_{t}_notify_upd
+              after update on resto.{t}
+              referencing old table as old_rows new table as changed_rows
+              for each statement execute function resto.fn_notify_rows('{CACHE_NOTIFY_CHANNEL}');
+          end if;
+        end $$;
+        """)
+
+def _cache_listen_loop() -> None:
+    wait, delay = threading.Event(), 1
+    while True:
+        try:
+            with _get_conn() as con:
+                con.execute(f"listen {CACHE_NOTIFY_CHANNEL};")
+                _invalidate_caches()   # o que mudou enquanto estávamos sem escutar
+                delay = 1
+                for n in con.notifies():
+                    _invalidate_caches(n.payload)
+        except Exception:
+            wait.wait(delay)
+            delay = min(delay * 2, CACHE_LISTENER_MAX_BACKOFF)
+
+@st.cache_resource(show_spinner=False)
+def _start_cache_listener() -> threading.Thread:
+    """Uma thread por processo (não por sessão), com conexão dedicada ao LISTEN."""
+    th = threading.Thread(target=_cache_listen_loop, name="sisget-cache-listener", daemon=True)
+    th.start()
+    return th
+
+# ===================== Grades (data_editor): diff + gravação em lote =====================
+def _grid_py(v):
+    """Valor do DataFrame → tipo Python aceito pelo psycopg (NaN/NaT → None)."""
+    if v is None or (not isinstance(v, (list, tuple, dict)) and pd.isna(v)):
+        return None
+    if isinstance(v, pd.Timestamp):
+        return v.date() if v == v.normalize() else v.to_pydatetime()
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+def _grid_key(k):
+    k = _grid_py(k)
+    return int(k) if isinstance(k, float) and k.is_integer() else k
+
+def _grid_blank(s: pd.Series) -> pd.Series:
+    return s.isna() | s.astype(object).map(lambda v: isinstance(v, str) and not v.strip())
+
+def _grid_num(v) -> bool:
+    return isinstance(v, numbers.Number) and not isinstance(v, bool)
+
+def _grid_eq(a: pd.Series, b: pd.Series) -> pd.Series:
+    """Igualdade por linha (a = original, b = editado): nulo == '' e ' x' == 'x' sempre; tolerância
+       numérica (Decimal == float) só se o original é número e date == Timestamp só se o original é data.
+       Texto (código, EAN, CNPJ...) compara como texto: '0789' != '789'."""
+    na_a, na_b = _grid_blank(a), _grid_blank(b)
+    is_num = ((pd.api.types.is_numeric_dtype(a) and not pd.api.types.is_bool_dtype(a))
+              | a.map(_grid_num)) & ~na_a
+    num_eq = pd.Series(False, index=a.index)
+    if is_num.any():
+        an = pd.to_numeric(a.where(is_num), errors="coerce")
+        bn = pd.to_numeric(b.where(is_num), errors="coerce")
+        num_eq = an.notna() & bn.notna() & np.isclose(an.fillna(0).astype(float), bn.fillna(0).astype(float),
+                                                      rtol=0, atol=1e-9)
+    is_dt = (pd.api.types.is_datetime64_any_dtype(a) | a.map(lambda v: isinstance(v, date))) & ~na_a
+    dt_eq = pd.Series(False, index=a.index)
+    if is_dt.any():
+        ad = pd.to_datetime(a.where(is_dt), errors="coerce")
+        bd = pd.to_datetime(b.where(is_dt & ~na_b), errors="coerce")
+        dt_eq = ad.notna() & bd.notna() & (ad == bd)
+    str_eq = a.astype(str).str.strip() == b.astype(str).str.strip()
+    return (na_a & na_b) | (~na_a & ~na_b & (num_eq | dt_eq | str_eq))
+
+def grid_diff(orig: pd.DataFrame, edited: pd.DataFrame, fields: List[str], key: str = "id",
+              delete_col: Optional[str] = "Excluir?") -> Tuple[List[Any], pd.DataFrame, pd.DataFrame]:
+    """Compara o DataFrame original com o editado (vetorizado).
+       Retorna (chaves marcadas p/ excluir, linhas alteradas, linhas novas sem chave)."""
+    ins = edited[edited[key].isna()] if key in edited else edited.iloc[0:0]
+    new = edited[edited[key].notna()].set_index(key)
+    old = orig.set_index(key).reindex(new.index)
+
+    dele = (new[delete_col].fillna(False).astype(bool) if delete_col and delete_col in new
+            else pd.Series(False, index=new.index))
+    changed = pd.Series(False, index=new.index)
+    for f in fields:
+        if f in new and f in old:
+            changed |= ~_grid_eq(old[f], new[f])
+    return new.index[dele].tolist(), new[changed & ~dele], ins
+
+def grid_apply(table: str, orig: pd.DataFrame, edited: pd.DataFrame, fields: List[str], *,
+               prepare=None, key: str = "id", delete_col: Optional[str] = "Excluir?",
+               update_where: str = "", insert_extra: Optional[Dict[str, Any]] = None,
+               after=None) -> Dict[str, Any]:
+    """Aplica exclusões, alterações e inclusões de um data_editor numa única transação.
+       prepare(linha) → {coluna: valor} (ValueError = erro só daquela linha). Cada lote vai num
+       executemany; se o banco recusar, refaz linha a linha (savepoint) p/ apontar quem falhou.
+       after(cur) roda no fim, na mesma transação (ex.: recalcular totais do cabeçalho)."""
+    prepare = prepare or (lambda r: {f: _grid_py(r.get(f)) for f in fields})
+    to_del, upd, ins = grid_diff(orig, edited, fields, key=key, delete_col=delete_col)
+    res: Dict[str, Any] = {"deleted": 0, "updated": 0, "inserted": 0, "errors": []}
+
+    def _prep(rows: pd.DataFrame, acao: str, with_key: bool):
+        out = []
+        for k, r in rows.iterrows():
+            try:
+                vals = prepare(r)
+            except (ValueError, TypeError, KeyError) as e:
+                res["errors"].append({"id": k if with_key else None, "ação": acao, "erro": str(e)})
+                continue
+            out.append((k if with_key else None, vals))
+        return out
+
+    upd_rows = _prep(upd, "atualizar", True)
+    ins_rows = _prep(ins, "incluir", False)
+
+    with qtx() as cur:
+        con = cur.connection
+
+        def _batch(acao: str, sql: str, items: List[Tuple[Any, tuple]]) -> int:
+            if not items:
+                return 0
+            try:
+                with con.transaction():
+                    cur.executemany(sql, [p for _, p in items])
+                return len(items)
+            except psycopg.Error:
+                ok = 0
+                for k, p in items:
+                    try:
+                        with con.transaction():
+                            cur.execute(sql, p)
+                        ok += 1
+                    except psycopg.Error as e:
+                        res["errors"].append({"id": k, "ação": acao, "erro": str(e).strip().splitlines()[0]})
+                return ok
+
+        res["deleted"] = _batch("excluir", f"delete from {table} where {key}=%s;",
+                                [(k, (_grid_key(k),)) for k in to_del])
+        if upd_rows:
+            cols = list(upd_rows[0][1].keys())
+            res["updated"] = _batch(
+                "atualizar",
+                f"update {table} set {', '.join(f'{c}=%s' for c in cols)} where {key}=%s {update_where};",
+                [(k, tuple(v[c] for c in cols) + (_grid_key(k),)) for k, v in upd_rows])
+        if ins_rows:
+            extra = insert_extra or {}
+            cols = list(ins_rows[0][1].keys()) + list(extra.keys())
+            res["inserted"] = _batch(
+                "incluir",
+                f"insert into {table}({', '.join(cols)}) values ({', '.join(['%s'] * len(cols))});",
+                [(None, tuple(v.values()) + tuple(extra.values())) for _, v in ins_rows])
+        if after:
+            after(cur)
+    return res
+
+def grid_feedback(res: Dict[str, Any], label: str = "") -> bool:
+    """Mensagem padrão das grades; lista os erros por linha. True se não houve erro."""
+    pre = f"{label}: " if label else ""
+    parts = []
+    if res["inserted"]:
+        parts.append(f"➕ {res['inserted']} incluído(s)")
+    parts += [f"✅ {res['updated']} atualizado(s)", f"🗑️ {res['deleted']} excluído(s)",
+              f"⚠️ {len(res['errors'])} erro(s)"]
+    st.success(pre + " • ".join(parts) + ".")
+    if res["errors"]:
+        st.dataframe(pd.DataFrame(res["errors"]), use_container_width=True, hide_index=True)
+        return False
+    return True
+
 # ===================== Ensure & Migrations =====================
 def ensure_ping():
     try:
@@ -129,6 +380,18 @@ def ensure_migrations():
     );
     """)
     qexec("""create index if not exists invmov_ref_idx on resto.inventory_movement(reference_id);""")
+    _ensure_expiry_alert_schema()
+    _ensure_traceability_schema()
+    _ensure_nfe_schema()
+    _ensure_price_history_schema()
+    _ensure_sale_schema()
+    _ensure_search_schema()
+    _ensure_cashbook_daily_schema()
+    _ensure_cashbook_hash_schema()
+    _ensure_statement_batch_schema()
+    _ensure_cash_rule_schema()
+    _ensure_period_close_schema()
+    _ensure_cache_notify_schema()
 
 def _ensure_product_schema_unificado():
     qexec("""
@@ -165,12 +428,25 @@ def _ensure_product_schema_unificado():
     end $$;
     """)
 
-def _money_br(v):
-    try:
-        v = float(v or 0)
-    except Exception:
-        v = 0.0
-    return ("R$ {:,.2f}".format(v)).replace(",", "X").replace(".", ",").replace("X", ".")
+PRODUCT_GRID_FIELDS = ["code","name","unit","category","barcode","min_stock","last_cost",
+                       "sale_price","is_sale_item","is_ingredient","default_markup","active"]
+
+def _prep_product_row(b) -> Dict[str, Any]:
+    """Linha do grid de produtos (Cadastros/Estoque) → colunas de resto.product."""
+    if not (b.get("name") or "").strip():
+        raise ValueError("nome obrigatório")
+    return {
+        "code": _grid_py(b.get("code")), "name": b.get("name").strip(), "unit": _grid_py(b.get("unit")),
+        "category": _grid_py(b.get("category")), "barcode": _grid_py(b.get("barcode")),
+        "min_stock": float(_grid_py(b.get("min_stock")) or 0), "last_cost": float(_grid_py(b.get("last_cost")) or 0),
+        "sale_price": float(_grid_py(b.get("sale_price")) or 0),
+        "is_sale_item": bool(b.get("is_sale_item")), "is_ingredient": bool(b.get("is_ingredient")),
+        "default_markup": float(_grid_py(b.get("default_markup")) or 0), "active": bool(b.get("active")),
+    }
+
+def _prep_payable_row(b) -> Dict[str, Any]:
+    """Linha dos grids de contas a pagar (Financeiro/Agenda) → colunas editáveis de resto.payable."""
+    return {"due_date": _grid_py(b["due_date"]), "amount": float(b["amount"]), "note": _grid_py(b.get("note")) or None}
 
 # --- Helpers (colocar no topo da page_compras) ---
 def _ensure_cash_category_compras() -> int:
@@ -206,6 +482,31 @@ def _sales_import_category_id() -> int:
     """Categoria padrão para entradas importadas tratadas como VENDAS."""
     return _ensure_cash_category('IN', 'Vendas (Importadas)')
 
+@invalidated_by("cash_category")
+@st.cache_data(ttl=3600, show_spinner=False)
+def cash_categories(kind: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Categorias do caixa (id, name, kind) por nome; kind 'IN'/'OUT' filtra."""
+    return qall("""
+        select id, name, kind from resto.cash_category where %(k)s::text is null or kind = %(k)s order by name;
+    """, {"k": kind}) or []
+
+@invalidated_by("cash_rule", "cash_category", "supplier")
+@st.cache_data(ttl=3600, show_spinner=False)
+def cash_rules() -> List[Dict[str, Any]]:
+    """Regras de categorização (todas, com nomes p/ exibição) na ordem de avaliação."""
+    return qall("""
+        select r.id, r.pattern, r.is_regex, c.kind, r.category_id, c.name as category, r.method,
+               r.supplier_id, s.name as supplier, r.priority, r.active
+          from resto.cash_rule r
+          left join resto.cash_category c on c.id = r.category_id
+          left join resto.supplier s on s.id = r.supplier_id
+         order by r.priority, r.id;
+    """) or []
+
+def rule_matcher() -> rules.Matcher:
+    """Regras ativas compiladas (+ as de método embutidas)."""
+    return rules.compile_rules([r for r in cash_rules() if r["active"]])
+
 def _record_cashbook_out_from_purchase(purchase_id: int, method: str, entry_date):
     head = qone("""
         select p.id, p.doc_date, coalesce(p.freight_value,0) frete, coalesce(p.other_costs,0) outros, s.name fornecedor
@@ -222,6 +523,156 @@ def _record_cashbook_out_from_purchase(purchase_id: int, method: str, entry_date
         values (%s,'OUT',%s,%s,%s,%s);
     """, (entry_date, cat_id, desc, total, method))
 
+# ===================== Livro caixa: consolidado diário =====================
+# resto.cashbook_daily = soma/contagem por dia × tipo × categoria × método, mantida por triggers de
+# comando (tabelas de transição) no próprio resto.cashbook. DRE, painéis e comparativos leem daqui:
+# 5 anos de comparativo são algumas centenas de linhas em vez do razão inteiro.
+# Sem categoria → category_id 0; sem método → '' (chave primária não aceita nulos).
+@st.cache_resource(show_spinner=False)
+def _ensure_cashbook_daily_schema():
+    qexec("""
+    create or replace function resto.fn_cashbook_daily_apply() returns trigger language plpgsql as $$
+    begin
+      if TG_OP = 'TRUNCATE' then
+        truncate resto.cashbook_daily;
+        return null;
+      end if;
+      if TG_OP in ('UPDATE', 'DELETE') then
+        insert into resto.cashbook_daily as d (day, kind, category_id, method, amount, n)
+        select entry_date, kind, coalesce(category_id, 0), coalesce(method, ''),
+               -coalesce(sum(amount), 0), -count(*)
+          from old_rows where entry_date is not null group by 1, 2, 3, 4
+        on conflict (day, kind, category_id, method)
+        do update set amount = d.amount + excluded.amount, n = d.n + excluded.n;
+      end if;
+      if TG_OP in ('INSERT', 'UPDATE') then
+        insert into resto.cashbook_daily as d (day, kind, category_id, method, amount, n)
+        select entry_date, kind, coalesce(category_id, 0), coalesce(method, ''),
+               coalesce(sum(amount), 0), count(*)
+          from new_rows where entry_date is not null group by 1, 2, 3, 4
+        on conflict (day, kind, category_id, method)
+        do update set amount = d.amount + excluded.amount, n = d.n + excluded.n;
+      end if;
+      if TG_OP in ('UPDATE', 'DELETE') then
+        delete from resto.cashbook_daily d
+         using (select distinct entry_date, kind from old_rows) o
+         where d.day = o.entry_date and d.kind = o.kind and d.n <= 0;
+      end if;
+      return null;
+    end $$;
+    """)
+    qexec("""
+    do $$
+    begin
+      if to_regclass('resto.cashbook_daily') is null then
+        create table resto.cashbook_daily (
+          day          date    not null,
+          kind         text    not null,
+          category_id  bigint  not null default 0,
+          method       text    not null default '',
+          amount       numeric not null default 0,
+          n            integer not null default 0,
+          primary key (day, kind, category_id, method)
+        );
+        -- carga inicial e triggers na mesma transação, com o razão travado p/ escrita
+        lock table resto.cashbook in share row exclusive mode;
+        insert into resto.cashbook_daily (day, kind, category_id, method, amount, n)
+        select entry_date, kind, coalesce(category_id, 0), coalesce(method, ''), coalesce(sum(amount), 0), count(*)
+          from resto.cashbook
+         where entry_date is not null
+         group by 1, 2, 3, 4;
+
+        create trigger trg_cashbook_daily_ins after insert on resto.cashbook
+          referencing new table as new_rows
+          for each statement execute function resto.fn_cashbook_daily_apply();
+        create trigger trg_cashbook_daily_upd after update on resto.cashbook
+          referencing old table as old_rows new table as new_rows
+          for each statement execute function resto.fn_cashbook_daily_apply();
+        create trigger trg_cashbook_daily_del after delete on resto.cashbook
+          referencing old table as old_rows
+          for each statement execute function resto.fn_cashbook_daily_apply();
+        create trigger trg_cashbook_daily_trunc after truncate on resto.cashbook
+          for each statement execute function resto.fn_cashbook_daily_apply();
+      end if;
+    end $$;
+    """)
+
+# Hash de conteúdo do lançamento (data, tipo, valor, descrição normalizada) p/ deduplicar importações
+# de extrato por índice. O único vale só p/ source='import': lançamentos manuais idênticos são legítimos.
+@st.cache_resource(show_spinner=False)
+def _ensure_cashbook_hash_schema():
+    qexec(r"""
+    create or replace function resto.fn_cashbook_hash(d date, k text, a numeric, descr text) returns text
+    language sql immutable parallel safe as $$
+      select md5((d - date '2000-01-01')::text || '|' || coalesce(k, '') || '|' || round(a, 2)::text || '|'
+                 || lower(regexp_replace(btrim(coalesce(descr, '')), '\s+', ' ', 'g')))
+    $$;
+    """)
+    qexec("""
+    do $$
+    begin
+      alter table resto.cashbook add column if not exists source text;
+      if not exists (select 1 from information_schema.columns
+                      where table_schema = 'resto' and table_name = 'cashbook' and column_name = 'content_hash') then
+        alter table resto.cashbook add column content_hash text
+          generated always as (resto.fn_cashbook_hash(entry_date, kind, amount, description)) stored;
+      end if;
+      create index if not exists cashbook_content_hash_idx on resto.cashbook(content_hash);
+      create unique index if not exists cashbook_import_hash_uq on resto.cashbook(content_hash)
+        where source = 'import';
+    end $$;
+    """)
+
+# Lote de importação de extratos (vários arquivos de uma vez): cada lançamento importado guarda o lote,
+# e desfazer o lote apaga exatamente esses lançamentos.
+@st.cache_resource(show_spinner=False)
+def _ensure_statement_batch_schema():
+    qexec("""
+    create table if not exists resto.statement_import_batch (
+      id             bigserial primary key,
+      imported_at    timestamptz not null default now(),
+      rows           int not null default 0,
+      inserted       int not null default 0,
+      duplicates     int not null default 0,
+      rolled_back_at timestamptz
+    );
+    create table if not exists resto.statement_import_file (
+      batch_id  bigint not null references resto.statement_import_batch(id) on delete cascade,
+      file_no   int    not null,
+      file_name text   not null,
+      layout    text,
+      encoding  text,
+      rows      int    not null default 0,
+      inserted  int    not null default 0,
+      primary key (batch_id, file_no)
+    );
+    alter table resto.cashbook add column if not exists import_batch_id bigint
+      references resto.statement_import_batch(id);
+    create index if not exists cashbook_import_batch_idx on resto.cashbook(import_batch_id)
+      where import_batch_id is not null;
+    """)
+
+# Regras de categorização de lançamentos importados (padrão na descrição → categoria/método/fornecedor).
+# Compiladas e aplicadas por sisget.rules; menor prioridade é avaliada antes.
+@st.cache_resource(show_spinner=False)
+def _ensure_cash_rule_schema():
+    qexec("""
+    create table if not exists resto.cash_rule (
+      id          bigserial primary key,
+      pattern     text    not null,
+      is_regex    boolean not null default false,
+      category_id bigint references resto.cash_category(id) on delete cascade,
+      method      text,
+      supplier_id bigint references resto.supplier(id) on delete cascade,
+      priority    int     not null default 100,
+      active      boolean not null default true,
+      created_at  timestamptz not null default now(),
+      check (category_id is not null or method is not null or supplier_id is not null)
+    );
+    create index if not exists cash_rule_active_idx on resto.cash_rule(priority, id) where active;
+    alter table resto.cashbook add column if not exists supplier_id bigint references resto.supplier(id);
+    """)
+
 # ===================== IMPORTAÇÕES IFOOD – SCHEMA =====================
 def _ensure_ifood_schema():
     """
@@ -349,11 +800,147 @@ def header(title: str, subtitle: str = "", logo: str | None = None, logo_height:
 def card_start(): st.markdown("<div class='modern-card'>", unsafe_allow_html=True)
 def card_end():   st.markdown("</div>", unsafe_allow_html=True)
 
-def money(v: float) -> str:
-    return ("R$ {:,.2f}".format(v)).replace(",", "X").replace(".", ",").replace("X", ".")
+money = brl.money   # um valor; colunas inteiras: brl.fmt
 
 
 
+# ===================== Busca (typeahead) de produtos e fornecedores =====================
+# Índices GIN pg_trgm sobre unaccent(lower(...)): "contém" sem acento/caixa usa índice, e o
+# navegador recebe só os top-N resultados em vez do cadastro inteiro.
+SEARCH_LIMIT = 20
+SEARCH_CACHE_TTL = 600   # s — alterações chegam via NOTIFY; o TTL só cobre o listener fora do ar
+
+@st.cache_resource(show_spinner=False)
+def _ensure_search_schema():
+    qexec(r"""
+    do $$
+    declare ua text; tg text;
+    begin
+      create extension if not exists pg_trgm;
+      create extension if not exists unaccent;
+      -- search_suppliers busca também pelo documento (coluna criada antes só pela página de Estoque)
+      alter table resto.supplier add column if not exists doc varchar(32);
+      select n.nspname into ua from pg_extension e join pg_namespace n on n.oid = e.extnamespace
+       where e.extname = 'unaccent';
+      select n.nspname into tg from pg_extension e join pg_namespace n on n.oid = e.extnamespace
+       where e.extname = 'pg_trgm';
+
+      -- unaccent() é STABLE; o wrapper IMMUTABLE (com dicionário qualificado) pode entrar em índice
+      execute format($f$
+        create or replace function resto.f_unaccent(text) returns text
+        language sql immutable parallel safe strict
+        as $b$ select %1$I.unaccent(%2$L::regdictionary, $1) $b$
+      $f$, ua, ua || '.unaccent');
+
+      execute format('create index if not exists product_name_trgm on resto.product
+                        using gin (resto.f_unaccent(lower(name)) %I.gin_trgm_ops)', tg);
+      execute format('create index if not exists product_code_trgm on resto.product
+                        using gin (lower(code) %I.gin_trgm_ops)', tg);
+      execute format('create index if not exists product_barcode_trgm on resto.product
+                        using gin (barcode %I.gin_trgm_ops)', tg);
+      execute format('create index if not exists supplier_name_trgm on resto.supplier
+                        using gin (resto.f_unaccent(lower(name)) %I.gin_trgm_ops)', tg);
+    end $$;
+    """)
+
+def _like_escape(q: str) -> str:
+    return (q or "").strip().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+@invalidated_by("product")
+@st.cache_data(ttl=SEARCH_CACHE_TTL, show_spinner=False)
+def search_products(q: str = "", limit: int = SEARCH_LIMIT, only_sale: bool = False,
+                    only_active: bool = False, only_ingredient: bool = False) -> List[Dict[str, Any]]:
+    """Top-N produtos por nome (contém, sem acento), código ou EAN (prefixo).
+       Ordem: código/EAN exato, nome começando com o termo, similaridade, nome."""
+    q = (q or "").strip()
+    return qall(r"""
+        with t as (select resto.f_unaccent(lower(%(q)s)) as q, %(esc)s as esc, lower(%(q)s) as raw)
+        select p.id, p.name, p.unit, p.unit_id, p.code, p.barcode,
+               coalesce(p.sale_price,0)::float as sale_price, coalesce(p.last_cost,0)::float as last_cost
+          from resto.product p, t
+         where (t.raw = ''
+                or resto.f_unaccent(lower(p.name)) like '%%' || resto.f_unaccent(lower(t.esc)) || '%%'
+                or lower(p.code) like lower(t.esc) || '%%'
+                or p.barcode like t.esc || '%%')
+           and (not %(sale)s or p.is_sale_item)
+           and (not %(active)s or coalesce(p.active, true))
+           and (not %(ing)s or coalesce(p.is_ingredient, true))
+         order by (lower(p.code) = t.raw or p.barcode = %(q)s) desc,
+                  resto.f_unaccent(lower(p.name)) like resto.f_unaccent(lower(t.esc)) || '%%' desc,
+                  similarity(resto.f_unaccent(lower(p.name)), t.q) desc,
+                  p.name
+         limit %(lim)s;
+    """, {"q": q, "esc": _like_escape(q), "lim": int(limit), "sale": bool(only_sale),
+          "active": bool(only_active), "ing": bool(only_ingredient)}) or []
+
+@invalidated_by("supplier")
+@st.cache_data(ttl=SEARCH_CACHE_TTL, show_spinner=False)
+def search_suppliers(q: str = "", limit: int = SEARCH_LIMIT) -> List[Dict[str, Any]]:
+    """Top-N fornecedores por nome (contém, sem acento) ou CNPJ/documento (prefixo dos dígitos)."""
+    q = (q or "").strip()
+    return qall(r"""
+        select s.id, s.name, coalesce(nullif(s.cnpj,''), s.doc) as cnpj
+          from resto.supplier s
+         where %(q)s = ''
+            or resto.f_unaccent(lower(s.name)) like '%%' || resto.f_unaccent(lower(%(esc)s)) || '%%'
+            or (%(dig)s <> '' and regexp_replace(coalesce(nullif(s.cnpj,''), s.doc, ''), '\D', '', 'g')
+                                  like %(dig)s || '%%')
+         order by resto.f_unaccent(lower(s.name)) like resto.f_unaccent(lower(%(esc)s)) || '%%' desc,
+                  similarity(resto.f_unaccent(lower(s.name)), resto.f_unaccent(lower(%(q)s))) desc,
+                  s.name
+         limit %(lim)s;
+    """, {"q": q, "esc": _like_escape(q), "dig": re.sub(r"\D", "", q), "lim": int(limit)}) or []
+
+def _picker(label: str, key: str, rows: List[Dict[str, Any]], fmt, selected: Optional[Dict[str, Any]],
+            placeholder: Optional[str], disabled: bool) -> Optional[Dict[str, Any]]:
+    by_id = {int(r["id"]): r for r in rows}
+    if selected and int(selected["id"]) not in by_id:   # mantém a escolha atual mesmo fora do top-N
+        by_id = {int(selected["id"]): selected, **by_id}
+    ids = list(by_id)
+    prev = st.session_state.get(key)
+    if prev is not None and prev not in by_id:
+        st.session_state.pop(key)   # escolha anterior saiu dos resultados: volta ao 1º item
+    index = ids.index(int(selected["id"])) if selected else (None if placeholder else 0)
+    sel = st.selectbox(label, options=ids, index=index if ids else None, key=key, disabled=disabled,
+                       format_func=lambda i: fmt(by_id[i]), placeholder=placeholder or "Nenhum resultado")
+    return by_id.get(sel) if sel is not None else None
+
+def product_picker(label: str, key: str, *, selected_id: Optional[int] = None, only_sale: bool = False,
+                   only_active: bool = False, only_ingredient: bool = False, placeholder: Optional[str] = None,
+                   limit: int = SEARCH_LIMIT, disabled: bool = False) -> Optional[Dict[str, Any]]:
+    """Campo de busca + seleção entre os top-N produtos. Retorna o dict do produto (ou None).
+       Fora de st.form: a busca precisa de rerun ao digitar."""
+    q = st.text_input(f"🔎 Buscar {label.lower().rstrip(' *')}", key=f"{key}_q", disabled=disabled,
+                      placeholder="nome, código ou EAN")
+    rows = search_products(q, limit, only_sale, only_active, only_ingredient)
+    selected = None
+    if selected_id:
+        selected = next((r for r in rows if int(r["id"]) == int(selected_id)), None) or product_by_id(selected_id)
+    return _picker(label, key, rows,
+                   lambda r: f"{r['name']} [{r.get('unit') or 'un'}]" + (f" • {r['code']}" if r.get("code") else ""),
+                   selected, placeholder, disabled)
+
+def supplier_picker(label: str, key: str, *, selected_id: Optional[int] = None, placeholder: Optional[str] = None,
+                    limit: int = SEARCH_LIMIT, disabled: bool = False) -> Optional[Dict[str, Any]]:
+    """Campo de busca + seleção entre os top-N fornecedores. Retorna o dict do fornecedor (ou None)."""
+    q = st.text_input(f"🔎 Buscar {label.lower().rstrip(' *')}", key=f"{key}_q", disabled=disabled,
+                      placeholder="nome ou CNPJ")
+    rows = search_suppliers(q, limit)
+    selected = None
+    if selected_id:
+        selected = next((r for r in rows if int(r["id"]) == int(selected_id)), None) or qone(
+            "select id, name, coalesce(nullif(cnpj,''), doc) as cnpj from resto.supplier where id=%s;",
+            (int(selected_id),))
+    return _picker(label, key, rows, lambda r: r["name"] + (f" • {r['cnpj']}" if r.get("cnpj") else ""),
+                   selected, placeholder, disabled)
+
+def product_by_id(product_id: int) -> Optional[Dict[str, Any]]:
+    return qone("""
+        select id, name, unit, unit_id, code, barcode,
+               coalesce(sale_price,0)::float as sale_price, coalesce(last_cost,0)::float as last_cost
+          from resto.product where id=%s;
+    """, (int(product_id),))
+
 # ===================== Domain Helpers =====================
 def lot_balances_for_product(product_id: int) -> pd.DataFrame:
     """Retorna saldos por lote (purchase_item) para um produto.
@@ -378,27 +965,373 @@ def lot_balances_for_product(product_id: int) -> pd.DataFrame:
     """, (product_id,))
     return pd.DataFrame(rows)
 
-def fifo_allocate(product_id: int, required_qty: float) -> List[Dict[str, Any]]:
-    """Aloca quantidade necessária por lotes (FIFO por validade, depois id)."""
-    df = lot_balances_for_product(product_id)
-    alloc = []
-    remaining = float(required_qty or 0.0)
-    for _, r in df.iterrows():
-        if remaining <= 0:
-            break
-        avail = float(r["saldo"] or 0.0)
-        if avail <= 0:
-            continue
-        take = min(avail, remaining)
-        alloc.append({
-            "lot_id": int(r["lot_id"]),
-            "qty": take,
-            "unit_cost": float(r["unit_price"] or 0.0),
-            "expiry_date": r.get("expiry_date"),
-            "lot_number": r.get("lot_number"),
-        })
-        remaining -= take
-    return alloc
+def produce(product_id: int, qty: float, lot_number: Optional[str] = None,
+            expiry_date=None, note: str = "") -> Dict[str, Any]:
+    """Ordem de produção (consumo FIFO por lote + entrada do produto final) numa transação."""
+    with qtx() as cur:
+        return services.produce(cur, product_id, qty, lot_number, expiry_date, note)
+
+# ===================== Validade (alertas pré-calculados) =====================
+# resto.expiry_alert guarda o saldo de cada lote com validade (purchase_item).
+# É mantida por trigger a cada movimento/alteração de lote e reconstruída por
+# agenda (EXPIRY_REFRESH_HOURS). Dias/faixa são calculados na view, pois mudam
+# com a data corrente e não com os dados.
+EXPIRY_REFRESH_HOURS = 6
+
+_EXPIRY_BUCKETS = ["vencido", "0-7 dias", "8-15 dias", "16-30 dias", "31-60 dias", "61-90 dias", "> 90 dias"]
+
+@st.cache_resource(show_spinner=False)
+def _ensure_expiry_alert_schema():
+    qexec("""
+    do $$
+    begin
+      create table if not exists resto.expiry_alert (
+        lot_id        bigint primary key references resto.purchase_item(id) on delete cascade,
+        product_id    bigint not null references resto.product(id),
+        lot_number    text,
+        expiry_date   date not null,
+        lot_qty       numeric(14,3) not null default 0,
+        consumed      numeric(14,3) not null default 0,
+        saldo         numeric(14,3) not null default 0,
+        unit_price    numeric(14,4) not null default 0,
+        value_at_risk numeric(14,2) not null default 0,
+        refreshed_at  timestamptz not null default now()
+      );
+      create index if not exists expiry_alert_exp_idx on resto.expiry_alert(expiry_date) where saldo > 0;
+      -- hora da última reconstrução completa (a tabela pode ficar vazia: sem lotes com validade)
+      create table if not exists resto.expiry_alert_meta (
+        id         boolean primary key default true check (id),
+        rebuilt_at timestamptz not null
+      );
+    end $$;
+    """)
+    qexec("""
+    create or replace function resto.fn_expiry_alert_refresh(p_lot_id bigint) returns void
+    language plpgsql as $f$
+    begin
+      delete from resto.expiry_alert where lot_id = p_lot_id;
+      insert into resto.expiry_alert(lot_id, product_id, lot_number, expiry_date, lot_qty, consumed,
+                                     saldo, unit_price, value_at_risk, refreshed_at)
+      select pi.id, pi.product_id, pi.lot_number, pi.expiry_date, pi.qty, coalesce(c.qty_out,0),
+             greatest(pi.qty - coalesce(c.qty_out,0), 0), coalesce(pi.unit_price,0),
+             round(greatest(pi.qty - coalesce(c.qty_out,0), 0) * coalesce(pi.unit_price,0), 2), now()
+        from resto.purchase_item pi
+        left join lateral (
+          select sum(m.qty) as qty_out
+            from resto.inventory_movement m
+           where m.kind='OUT' and m.reference_id = pi.id
+        ) c on true
+       where pi.id = p_lot_id
+         and pi.expiry_date is not null;
+    end $f$;
+    """)
+    qexec("""
+    create or replace function resto.tg_expiry_alert_movement() returns trigger
+    language plpgsql as $f$
+    begin
+      if tg_op in ('UPDATE','DELETE') and old.kind = 'OUT' and old.reference_id is not null then
+        perform resto.fn_expiry_alert_refresh(old.reference_id);
+      end if;
+      if tg_op in ('INSERT','UPDATE') and new.kind = 'OUT' and new.reference_id is not null then
+        perform resto.fn_expiry_alert_refresh(new.reference_id);
+      end if;
+      return null;
+    end $f$;
+    """)
+    qexec("""
+    create or replace function resto.tg_expiry_alert_lot() returns trigger
+    language plpgsql as $f$
+    begin
+      if tg_op = 'DELETE' then
+        delete from resto.expiry_alert where lot_id = old.id;
+      else
+        perform resto.fn_expiry_alert_refresh(new.id);
+      end if;
+      return null;
+    end $f$;
+    """)
+    qexec("""
+    do $$
+    begin
+      if not exists (select 1 from pg_trigger where tgname = 'expiry_alert_movement_trg') then
+        create trigger expiry_alert_movement_trg
+          after insert or update or delete on resto.inventory_movement
+          for each row execute function resto.tg_expiry_alert_movement();
+      end if;
+      if not exists (select 1 from pg_trigger where tgname = 'expiry_alert_lot_trg') then
+        create trigger expiry_alert_lot_trg
+          after insert or update of qty, unit_price, expiry_date, lot_number, product_id or delete
+          on resto.purchase_item
+          for each row execute function resto.tg_expiry_alert_lot();
+      end if;
+    end $$;
+    """)
+    qexec(f"""
+    create or replace view resto.v_expiry_alert as
+    select a.lot_id, a.product_id, p.name as product_name, a.lot_number, a.expiry_date,
+           a.lot_qty, a.consumed, a.saldo, a.unit_price, a.value_at_risk, a.refreshed_at,
+           (a.expiry_date - current_date) as dias,
+           case
+             when a.expiry_date <  current_date      then '{_EXPIRY_BUCKETS[0]}'
+             when a.expiry_date - current_date <=  7 then '{_EXPIRY_BUCKETS[1]}'
+             when a.expiry_date - current_date <= 15 then '{_EXPIRY_BUCKETS[2]}'
+             when a.expiry_date - current_date <= 30 then '{_EXPIRY_BUCKETS[3]}'
+             when a.expiry_date - current_date <= 60 then '{_EXPIRY_BUCKETS[4]}'
+             when a.expiry_date - current_date <= 90 then '{_EXPIRY_BUCKETS[5]}'
+             else '{_EXPIRY_BUCKETS[6]}'
+           end as bucket
+      from resto.expiry_alert a
+      join resto.product p on p.id = a.product_id;
+    """)
+    return True
+
+def refresh_expiry_alerts() -> int:
+    """Reconstrói resto.expiry_alert inteira (um único insert set-based). Retorna nº de lotes."""
+    with qtx() as cur:
+        cur.execute("delete from resto.expiry_alert;")
+        cur.execute("""
+            with cons as (
+              select reference_id as lot_id, coalesce(sum(qty),0) as qty_out
+                from resto.inventory_movement
+               where kind='OUT' and reference_id is not null
+               group by reference_id
+            )
+            insert into resto.expiry_alert(lot_id, product_id, lot_number, expiry_date, lot_qty, consumed,
+                                           saldo, unit_price, value_at_risk, refreshed_at)
+            select pi.id, pi.product_id, pi.lot_number, pi.expiry_date, pi.qty, coalesce(c.qty_out,0),
+                   greatest(pi.qty - coalesce(c.qty_out,0), 0), coalesce(pi.unit_price,0),
+                   round(greatest(pi.qty - coalesce(c.qty_out,0), 0) * coalesce(pi.unit_price,0), 2), now()
+              from resto.purchase_item pi
+              left join cons c on c.lot_id = pi.id
+             where pi.expiry_date is not null;
+        """)
+        n = cur.rowcount or 0
+        cur.execute("""
+            insert into resto.expiry_alert_meta(id, rebuilt_at) values (true, now())
+            on conflict (id) do update set rebuilt_at = excluded.rebuilt_at;
+        """)
+        return n
+
+def refresh_expiry_alerts_if_stale(max_age_hours: float = EXPIRY_REFRESH_HOURS) -> bool:
+    """Refaz o cálculo completo se a última reconstrução for mais antiga que max_age_hours
+       (ou se nunca houve uma)."""
+    r = qone("""
+        select coalesce((select rebuilt_at from resto.expiry_alert_meta)
+                        < now() - make_interval(secs => %s), true) as stale;
+    """, (float(max_age_hours) * 3600.0,))
+    if r and r.get("stale"):
+        refresh_expiry_alerts()
+        return True
+    return False
+
+def expiry_write_off(note: str = "") -> Tuple[int, float]:
+    """Baixa (OUT) todo o saldo de lotes vencidos numa única transação.
+       Retorna (nº de lotes baixados, valor baixado)."""
+    with qtx() as cur:
+        cur.execute("""
+            select pi.id as lot_id, pi.product_id, pi.expiry_date, coalesce(pi.unit_price,0) as unit_price,
+                   greatest(pi.qty - coalesce(c.qty_out,0), 0) as saldo
+              from resto.purchase_item pi
+              left join lateral (
+                select sum(m.qty) as qty_out
+                  from resto.inventory_movement m
+                 where m.kind='OUT' and m.reference_id = pi.id
+              ) c on true
+             where pi.expiry_date < current_date
+               and pi.qty - coalesce(c.qty_out,0) > 0
+             order by pi.id;
+        """)
+        lots = cur.fetchall()
+        if not lots:
+            return 0, 0.0
+        cur.executemany(
+            "select resto.sp_register_movement(%s,'OUT',%s,%s,'expiry_writeoff',%s,%s);",
+            [(int(l["product_id"]), float(l["saldo"]), float(l["unit_price"]), int(l["lot_id"]),
+              f"writeoff:expiry;lot:{l['lot_id']};exp:{l['expiry_date']}" + (f";{note}" if note else ""))
+             for l in lots],
+        )
+    return len(lots), float(sum(float(l["saldo"]) * float(l["unit_price"]) for l in lots))
+
+# ===================== Rastreabilidade (lote de compra ⇄ produção) =====================
+# production_item.lot_id só aponta p/ lotes de compra. Quando o ingrediente é um produto
+# produzido (lot_id nulo), ligamos à(s) produção(ões) daquele produto feitas antes e ainda
+# dentro da validade (ou de TRACE_SHELF_DAYS, se não houver validade). É uma sobre-aproximação
+# proposital: num recall é melhor listar a mais do que deixar de fora.
+TRACE_SHELF_DAYS = 30
+TRACE_MAX_DEPTH = 6
+TRACE_CACHE_TTL = 3600
+
+@st.cache_resource(show_spinner=False)
+def _ensure_traceability_schema():
+    qexec("""
+    do $$
+    begin
+      alter table resto.production add column if not exists status text;
+      alter table resto.supplier add column if not exists doc varchar(32);   -- lido no rastreio p/ trás
+      create index if not exists prod_item_lot_idx on resto.production_item(lot_id) where lot_id is not null;
+      create index if not exists prod_item_prod_idx on resto.production_item(production_id);
+      create index if not exists prod_item_ingr_nolot_idx on resto.production_item(ingredient_id) where lot_id is null;
+      create index if not exists production_prod_date_idx on resto.production(product_id, date);
+    end $$;
+    """)
+
+@invalidated_by("inventory_movement")
+@st.cache_data(ttl=TRACE_CACHE_TTL, show_spinner=False)
+def trace_lot_forward(lot_id: int, max_depth: int = TRACE_MAX_DEPTH,
+                      shelf_days: int = TRACE_SHELF_DAYS) -> pd.DataFrame:
+    """Lote de compra → produções que o consumiram → produções que usaram esses produtos (recursivo)."""
+    rows = qall("""
+        with recursive fwd(production_id, depth, path) as (
+            select distinct it.production_id, 1, array[it.production_id]
+              from resto.production_item it
+             where it.lot_id = %s
+          union all
+            select b.production_id, f.depth + 1, f.path || b.production_id
+              from fwd f
+              join resto.production a       on a.id = f.production_id
+              join resto.production_item b  on b.ingredient_id = a.product_id and b.lot_id is null
+              join resto.production bp      on bp.id = b.production_id
+             where bp.date >= a.date
+               and bp.date::date <= coalesce(a.expiry_date, a.date::date + %s::int)
+               and b.production_id <> all(f.path)
+               and f.depth < %s
+        )
+        select p.id as production_id, min(f.depth) as nivel, p.date, pr.name as produto,
+               p.qty, p.lot_number, p.expiry_date, coalesce(p.status,'FECHADA') as status
+          from fwd f
+          join resto.production p on p.id = f.production_id
+          join resto.product pr   on pr.id = p.product_id
+         group by p.id, pr.name
+         order by nivel, p.date;
+    """, (int(lot_id), int(shelf_days), int(max_depth)))
+    return pd.DataFrame(rows or [])
+
+@invalidated_by("inventory_movement")
+@st.cache_data(ttl=TRACE_CACHE_TTL, show_spinner=False)
+def trace_production_backward(production_id: int, max_depth: int = TRACE_MAX_DEPTH,
+                              shelf_days: int = TRACE_SHELF_DAYS) -> pd.DataFrame:
+    """Produção → lotes de fornecedor consumidos, descendo pelas produções intermediárias."""
+    rows = qall("""
+        with recursive bwd(production_id, depth, path) as (
+            select %s::bigint, 0, array[%s::bigint]
+          union all
+            select a.id, b.depth + 1, b.path || a.id
+              from bwd b
+              join resto.production bp       on bp.id = b.production_id
+              join resto.production_item it  on it.production_id = bp.id and it.lot_id is null
+              join resto.production a        on a.product_id = it.ingredient_id
+             where a.date <= bp.date
+               and bp.date::date <= coalesce(a.expiry_date, a.date::date + %s::int)
+               and coalesce(a.status,'FECHADA') <> 'CANCELADA'
+               and a.id <> all(b.path)
+               and b.depth < %s
+        )
+        select pi.id as lot_id, ing.name as ingrediente, pi.lot_number, pi.expiry_date,
+               s.name as fornecedor, coalesce(nullif(s.cnpj,''), s.doc) as cnpj, pu.doc_number, pu.doc_date,
+               sum(it.qty) as qty_consumida, min(b.depth) as nivel,
+               array_agg(distinct it.production_id order by it.production_id) as producoes
+          from bwd b
+          join resto.production_item it on it.production_id = b.production_id and it.lot_id is not null
+          join resto.purchase_item pi   on pi.id = it.lot_id
+          join resto.purchase pu        on pu.id = pi.purchase_id
+          join resto.supplier s         on s.id = pu.supplier_id
+          join resto.product ing        on ing.id = pi.product_id
+         group by pi.id, ing.name, s.name, s.cnpj, s.doc, pu.doc_number, pu.doc_date
+         order by nivel, ingrediente, pi.expiry_date nulls last;
+    """, (int(production_id), int(production_id), int(shelf_days), int(max_depth)))
+    return pd.DataFrame(rows or [])
+
+# ===================== Replay de CMP / estoque a partir do razão =====================
+# CMP móvel: IN recalcula (Q·cmp + q·c)/(Q + q); OUT baixa a quantidade e mantém o CMP.
+# Entrada com saldo anterior ≤ 0 reinicia o CMP no custo da entrada.
+# Com a = Q/(Q+q) e b = q·c/(Q+q), cmp_k = a_k·cmp_{k-1} + b_k — recorrência linear resolvida em
+# bloco por segmento (entre reinícios) via P_k = ∏a: cmp_k = P_k · Σ b_j/P_j.
+_REPLAY_LOG_FLOOR = -600.0   # abaixo disso exp(-logP) estoura float64 → recalcula o produto em laço
+
+def _replay_avg_loop(q: np.ndarray, c: np.ndarray, q_before: np.ndarray) -> np.ndarray:
+    out = np.empty(len(q))
+    avg = 0.0
+    for i in range(len(q)):
+        qb = q_before[i]
+        avg = c[i] if qb <= 0 else (qb * avg + q[i] * c[i]) / (qb + q[i])
+        out[i] = avg
+    return out
+
+def replay_stock_and_avg_cost() -> pd.DataFrame:
+    """Recalcula estoque e CMP de todos os produtos a partir de resto.inventory_movement
+       (ordem move_date, id) e compara com product.stock_qty / product.avg_cost."""
+    mv = pd.DataFrame(qall("""
+        select id, product_id, kind, qty::float8 as qty, coalesce(unit_cost,0)::float8 as unit_cost
+          from resto.inventory_movement
+         where kind in ('IN','OUT')
+         order by product_id, move_date, id;
+    """) or [], columns=["id", "product_id", "kind", "qty", "unit_cost"])
+
+    cur = pd.DataFrame(qall("""
+        select p.id as product_id, p.name, coalesce(p.unit,'un') as unit,
+               coalesce(p.stock_qty,0)::float8 as stock_qty, coalesce(p.avg_cost,0)::float8 as avg_cost
+          from resto.product p;
+    """) or [], columns=["product_id", "name", "unit", "stock_qty", "avg_cost"])
+
+    if mv.empty:
+        rep = pd.DataFrame({"product_id": cur["product_id"], "replay_qty": 0.0, "replay_avg": np.nan})
+    else:
+        is_in = (mv["kind"] == "IN").to_numpy()
+        signed = np.where(is_in, mv["qty"], -mv["qty"])
+        q_after = pd.Series(signed).groupby(mv["product_id"].to_numpy()).cumsum().to_numpy()
+        q_before = q_after - signed
+
+        ins = mv.loc[is_in, ["product_id", "qty", "unit_cost"]].copy()
+        qb = q_before[is_in]
+        q, c = ins["qty"].to_numpy(), ins["unit_cost"].to_numpy()
+        reset = qb <= 0
+        den = np.where(reset, 1.0, qb + q)
+        a = np.where(reset, 1.0, qb / den)        # no reinício o fator não entra no produto
+        b = np.where(reset, c, q * c / den)
+
+        ins["seg"] = pd.Series(reset).cumsum().to_numpy()   # segmentos não cruzam produtos: 1ª entrada sempre reinicia
+        with np.errstate(divide="ignore"):
+            log_a = np.log(np.where(a > 0, a, np.nan))
+        ins["logP"] = pd.Series(np.nan_to_num(log_a, nan=-np.inf)).groupby(ins["seg"].to_numpy()).cumsum().to_numpy()
+        with np.errstate(over="ignore", invalid="ignore"):
+            terms = b * np.exp(-ins["logP"].to_numpy())
+            ins["avg"] = np.exp(ins["logP"].to_numpy()) * pd.Series(terms).groupby(ins["seg"].to_numpy()).cumsum().to_numpy()
+
+        bad = ins.loc[~np.isfinite(ins["avg"]) | (ins["logP"] < _REPLAY_LOG_FLOOR), "product_id"].unique()
+        for pid in bad:
+            m = (ins["product_id"] == pid).to_numpy()
+            ins.loc[m, "avg"] = _replay_avg_loop(q[m], c[m], qb[m])
+
+        rep = pd.DataFrame({
+            "replay_qty": pd.Series(q_after).groupby(mv["product_id"].to_numpy()).last(),
+            "replay_avg": ins.groupby("product_id")["avg"].last(),
+        }).rename_axis("product_id").reset_index()
+
+    out = cur.merge(rep, on="product_id", how="left")
+    out["replay_qty"] = out["replay_qty"].fillna(0.0).round(3)
+    out["replay_avg"] = out["replay_avg"].fillna(out["avg_cost"]).round(2)   # sem entradas: mantém o CMP atual
+    out["drift_qty"] = (out["stock_qty"] - out["replay_qty"]).round(3)
+    out["drift_avg"] = (out["avg_cost"] - out["replay_avg"]).round(2)
+    out["drift_valor"] = (out["stock_qty"] * out["avg_cost"] - out["replay_qty"] * out["replay_avg"]).round(2)
+    out["divergente"] = (out["drift_qty"].abs() >= 0.001) | (out["drift_avg"].abs() >= 0.01)
+    return out.sort_values(["divergente", "drift_valor"], ascending=[False, False],
+                           key=lambda s: s.abs() if s.name == "drift_valor" else s).reset_index(drop=True)
+
+def apply_stock_replay(df: pd.DataFrame) -> int:
+    """Grava estoque/CMP recalculados (somente divergentes) numa única transação."""
+    fix = df[df["divergente"] == True] if df is not None and not df.empty else pd.DataFrame()
+    if fix.empty:
+        return 0
+    with qtx() as cur:
+        cur.execute("""
+            update resto.product p
+               set stock_qty = u.qty, avg_cost = u.avg
+              from unnest(%s::bigint[], %s::numeric[], %s::numeric[]) as u(id, qty, avg)
+             where p.id = u.id;
+        """, ([int(x) for x in fix["product_id"]],
+              [float(x) for x in fix["replay_qty"]],
+              [float(x) for x in fix["replay_avg"]]))
+        return cur.rowcount or 0
 
 # helper universal (coloque perto das outras funções utilitárias)
 def _rerun():
@@ -417,23 +1350,13 @@ def page_dashboard():
 
     stock = qone("select coalesce(sum(stock_qty * avg_cost),0) as val, coalesce(sum(stock_qty),0) as qty from resto.product;") or {}
     cmv = qall("select month, cmv_value from resto.v_cmv order by month desc limit 6;")
+    refresh_expiry_alerts_if_stale()
     soon = qall("""
-        with cons as (
-          select reference_id as lot_id, coalesce(sum(qty),0) as qty_out
-            from resto.inventory_movement
-           where kind='OUT' and reference_id is not null
-           group by reference_id
-        )
-        select pi.id, p.name, pi.expiry_date,
-               greatest(pi.qty - coalesce(c.qty_out,0),0) as saldo,
-               (pi.expiry_date - current_date) as dias
-          from resto.purchase_item pi
-          join resto.product p on p.id = pi.product_id
-          left join cons c on c.lot_id = pi.id
-         where pi.expiry_date is not null
-           and (pi.expiry_date - current_date) <= 30
-           and greatest(pi.qty - coalesce(c.qty_out,0),0) > 0
-         order by pi.expiry_date asc
+        select lot_id as id, product_name as name, expiry_date, saldo, value_at_risk, dias
+          from resto.v_expiry_alert
+         where saldo > 0
+           and expiry_date <= current_date + 30
+         order by expiry_date asc
          limit 10;
     """)
 
@@ -460,7 +1383,7 @@ def page_dashboard():
         df = pd.DataFrame(soon)
         if not df.empty:
             df["dias"] = df["dias"].astype(int)
-            st.dataframe(df[["name","expiry_date","saldo","dias"]], use_container_width=True, hide_index=True)
+            st.dataframe(df[["name","expiry_date","saldo","value_at_risk","dias"]], use_container_width=True, hide_index=True)
         else:
             st.caption("Nenhum lote a vencer nos próximos 30 dias.")
         card_end()
@@ -625,61 +1548,25 @@ def page_cadastros():
                 st.rerun()
 
             if apply:
-                orig = df_sup.set_index("id")
-                new  = edited.set_index("id")
-                upd = delc = err = 0
-
-                # --- exclusões marcadas ---
-                to_del = new.index[new["Excluir?"] == True].tolist()
-                for fid in to_del:
-                    try:
-                        qexec("delete from resto.supplier where id=%s;", (int(fid),))
-                        delc += 1
-                    except Exception:
-                        # normalmente vai falhar se tiver FK (compras, produtos, etc.)
-                        err += 1
-
-                # --- updates (linhas não marcadas para excluir) ---
-                keep = [i for i in new.index if i not in to_del]
-                for fid in keep:
-                    a = orig.loc[fid]
-                    b = new.loc[fid]
-
+                def _prep_sup(b):
                     # normaliza iguais ao formulário
-                    name_new  = (b.get("name") or "").strip()
-                    cnpj_new  = re.sub(r"\D", "", str(b.get("cnpj") or "")) or None
-                    ie_new    = (b.get("ie") or "").strip() or None
-                    email_new = (b.get("email") or "").strip() or None
-                    phone_new = re.sub(r"\D", "", str(b.get("phone") or "")) or None
-                    active_new= bool(b.get("active"))
-
+                    name_new = (b.get("name") or "").strip()
                     if not name_new:
-                        err += 1
-                        continue
-
-                    changed = (
-                        name_new  != (a.get("name") or "") or
-                        (cnpj_new or "")  != (a.get("cnpj") or "") or
-                        (ie_new or "")    != (a.get("ie") or "") or
-                        (email_new or "") != (a.get("email") or "") or
-                        (phone_new or "") != (a.get("phone") or "") or
-                        active_new        != bool(a.get("active"))
-                    )
-                    if not changed:
-                        continue
-
-                    try:
-                        qexec("""
-                            update resto.supplier
-                               set name=%s, cnpj=%s, ie=%s, email=%s, phone=%s, active=%s
-                             where id=%s;
-                        """, (name_new, cnpj_new, ie_new, email_new, phone_new, active_new, int(fid)))
-                        upd += 1
-                    except Exception:
-                        err += 1
+                        raise ValueError("nome obrigatório")
+                    return {
+                        "name":   name_new,
+                        "cnpj":   re.sub(r"\D", "", str(b.get("cnpj") or "")) or None,
+                        "ie":     (b.get("ie") or "").strip() or None,
+                        "email":  (b.get("email") or "").strip() or None,
+                        "phone":  re.sub(r"\D", "", str(b.get("phone") or "")) or None,
+                        "active": bool(b.get("active")),
+                    }
 
-                st.success(f"Fornecedores: ✅ {upd} atualizado(s) • 🗑️ {delc} excluído(s) • ⚠️ {err} erro(s).")
-                st.rerun()
+                # exclusões normalmente falham se houver FK (compras, produtos, etc.) → aparecem como erro da linha
+                res = grid_apply("resto.supplier", df_sup, edited,
+                                 ["name","cnpj","ie","email","phone","active"], prepare=_prep_sup)
+                if grid_feedback(res, "Fornecedores"):
+                    st.rerun()
         else:
             st.caption("Nenhum fornecedor cadastrado.")
 
@@ -840,45 +1727,9 @@ def page_cadastros():
                 st.rerun()
 
             if apply:
-                orig = df.set_index("id")
-                new  = edited.set_index("id")
-                upd = delc = err = 0
-
-                # exclusões
-                to_del = new.index[new["Excluir?"] == True].tolist()
-                for pid in to_del:
-                    try:
-                        qexec("delete from resto.product where id=%s;", (int(pid),))
-                        delc += 1
-                    except Exception:
-                        err += 1
-
-                # updates
-                keep = [i for i in new.index if i not in to_del]
-                for pid in keep:
-                    a = orig.loc[pid]; b = new.loc[pid]
-                    changed = any(str(a.get(f,"")) != str(b.get(f,"")) for f in
-                                  ["code","name","unit","category","barcode","min_stock","last_cost",
-                                   "sale_price","is_sale_item","is_ingredient","default_markup","active"])
-                    if not changed:
-                        continue
-                    try:
-                        qexec("""
-                            update resto.product
-                               set code=%s, name=%s, unit=%s, category=%s, barcode=%s,
-                                   min_stock=%s, last_cost=%s, sale_price=%s,
-                                   is_sale_item=%s, is_ingredient=%s, default_markup=%s, active=%s
-                             where id=%s;
-                        """, (b.get("code"), b.get("name"), b.get("unit"), b.get("category"), b.get("barcode"),
-                              float(b.get("min_stock") or 0), float(b.get("last_cost") or 0), float(b.get("sale_price") or 0),
-                              bool(b.get("is_sale_item")), bool(b.get("is_ingredient")), float(b.get("default_markup") or 0),
-                              bool(b.get("active")), int(pid)))
-                        upd += 1
-                    except Exception:
-                        err += 1
-
-                st.success(f"Produtos: ✅ {upd} atualizado(s) • 🗑️ {delc} excluído(s) • ⚠️ {err} erro(s).")
-                st.rerun()
+                res = grid_apply("resto.product", df, edited, PRODUCT_GRID_FIELDS, prepare=_prep_product_row)
+                if grid_feedback(res, "Produtos"):
+                    st.rerun()
         else:
             st.caption("Nenhum produto cadastrado.")
 
@@ -890,15 +1741,6 @@ def page_cadastros():
             "e o campo **Preço** como valor de venda."
         )
 
-        import unicodedata
-
-        def _norm_colname(c: str) -> str:
-            if not c:
-                return ""
-            c = unicodedata.normalize("NFKD", str(c))
-            c = "".join(ch for ch in c if not unicodedata.combining(ch))
-            return c.lower().strip()
-
         file_prod = st.file_uploader(
             "Arquivo de produtos (.xlsx ou .csv)",
             type=["xlsx", "xls", "csv"],
@@ -908,27 +1750,14 @@ def page_cadastros():
         if file_prod is not None:
             # lê o arquivo em DataFrame
             try:
-                if str(file_prod.name).lower().endswith((".xlsx", ".xls")):
-                    df_imp = pd.read_excel(file_prod)
-                else:
-                    df_imp = pd.read_csv(file_prod, sep=";|,", engine="python")
+                df_imp = products.read_olaclick(file_prod, file_prod.name)
             except Exception as e:
                 st.error(f"Erro ao ler o arquivo: {e}")
                 df_imp = None
 
             if df_imp is not None:
-                # mapa: nome normalizado -> nome real da coluna
-                norm_map = {_norm_colname(c): c for c in df_imp.columns}
-
-                col_nome   = norm_map.get("nome do produto") or norm_map.get("nome")
-                col_cat    = norm_map.get("categoria do produto") or norm_map.get("categoria")
-                col_desc   = norm_map.get("descricao") or norm_map.get("descrição")
-                # ➜ AGORA o preço principal é sempre PREÇO (valor de venda)
-                col_preco  = norm_map.get("preco") or norm_map.get("preço")
-                # usado só como fallback se o preço estiver vazio/zero
-                col_preco_desc = norm_map.get("preco com desconto") or norm_map.get("preço com desconto")
-
-                if not col_nome or not col_preco:
+                cols = products.olaclick_columns(df_imp)
+                if not cols["nome"] or not cols["preco"]:
                     st.error(
                         "A planilha precisa ter, no mínimo, as colunas "
                         "'Nome do produto' e 'Preço'."
@@ -936,93 +1765,427 @@ def page_cadastros():
                 else:
                     st.write("Pré-visualização dos dados lidos da planilha:")
                     preview_cols = [
-                        c for c in [col_cat, col_nome, col_desc, col_preco, col_preco_desc] if c
+                        c for c in [cols["categoria"], cols["nome"], cols["descricao"], cols["preco"], cols["preco_desc"]] if c
                     ]
                     st.dataframe(df_imp[preview_cols].head(30), use_container_width=True)
 
-                    def _to_float(val):
-                        try:
-                            return float(val)
-                        except Exception:
-                            return 0.0
-
                     if st.button("🚀 Importar produtos da planilha", key="btn_import_prod_olaclick"):
-                        ok = err = 0
-                        for _, row in df_imp.iterrows():
-                            name = str(row[col_nome] or "").strip()
-                            if not name:
-                                continue
-
-                            # categoria (texto exatamente como está na planilha)
-                            if col_cat and not pd.isna(row[col_cat]):
-                                category = str(row[col_cat]).strip() or None
-                            else:
-                                category = None
-
-                            # preço de venda: sempre usa PREÇO.
-                            price_val = 0.0
-                            if not pd.isna(row[col_preco]):
-                                price_val = _to_float(row[col_preco])
-
-                            # se preço vier 0 e existir "Preço com desconto", usa como fallback
-                            if (price_val == 0.0) and col_preco_desc and not pd.isna(row.get(col_preco_desc)):
-                                price_val = _to_float(row[col_preco_desc])
-
-                            try:
-                                qexec("""
-                                    insert into resto.product(
-                                        code, name, unit, category, supplier_id, barcode,
-                                        min_stock, last_cost, active,
-                                        sale_price, is_sale_item, is_ingredient, default_markup,
-                                        ncm, cest, cfop_venda, csosn, cst_icms, aliquota_icms,
-                                        cst_pis, aliquota_pis, cst_cofins, aliquota_cofins, iss_aliquota
-                                    )
-                                    values (%s,%s,%s,%s,%s,%s,
-                                            %s,%s,%s,
-                                            %s,%s,%s,%s,
-                                            %s,%s,%s,%s,%s,%s,
-                                            %s,%s,%s,%s,%s)
-                                    on conflict (name) do update set
-                                        unit=excluded.unit,
-                                        category=excluded.category,
-                                        min_stock=excluded.min_stock,
-                                        last_cost=excluded.last_cost,
-                                        active=excluded.active,
-                                        sale_price=excluded.sale_price,
-                                        is_sale_item=excluded.is_sale_item,
-                                        is_ingredient=excluded.is_ingredient,
-                                        default_markup=excluded.default_markup;
-                                """, (
-                                    None,                    # code
-                                    name,
-                                    "un",                    # unidade padrão
-                                    category,
-                                    None,                    # supplier_id
-                                    None,                    # barcode
-                                    0.0,                     # min_stock
-                                    0.0,                     # last_cost (custo você vai alimentar depois)
-                                    True,                    # active
-                                    float(price_val or 0.0), # sale_price (PREÇO)
-                                    True,                    # is_sale_item
-                                    False,                   # is_ingredient
-                                    0.0,                     # default_markup
-                                    None, None, None, None, None, None,
-                                    None, None, None, None, None
-                                ))
-                                ok += 1
-                            except Exception:
-                                err += 1
-
-                        st.success(
-                            f"Importação concluída: {ok} produto(s) importado(s)/atualizado(s) "
-                            f"• {err} erro(s)."
-                        )
-                        st.info("Depois clique em '🔄 Atualizar' acima para recarregar a lista de produtos.")
+                        try:
+                            with qtx() as cur:
+                                res = products.upsert_olaclick(cur, products.olaclick_rows(df_imp))
+                        except Exception as e:
+                            st.error(f"Falha na importação (nada foi gravado): {e}")
+                        else:
+                            st.success(
+                                f"Importação concluída: ➕ {res['inserted']} incluído(s) • "
+                                f"✅ {res['updated']} atualizado(s) • {res['unchanged']} sem alteração."
+                            )
+                            st.info("Depois clique em '🔄 Atualizar' acima para recarregar a lista de produtos.")
 
 
         card_end()
 
 #==========================================================COMPRAS===========================================================================
+# ===================== Compras (gravação atômica) =====================
+# Regras em sisget.services (compartilhadas com a API/CLI); aqui só abrimos a transação.
+def post_purchase(purchase_id: int) -> int:
+    """Posta uma compra já gravada: tudo ou nada."""
+    with qtx() as cur:
+        return services.post_purchase(cur, purchase_id)
+
+def unpost_purchase(purchase_id: int) -> int:
+    """Estorna (OUT) todos os itens de uma compra POSTADA e marca ESTORNADA: tudo ou nada."""
+    with qtx() as cur:
+        return services.unpost_purchase(cur, purchase_id)
+
+def save_purchase(head: Dict[str, Any], items: List[Dict[str, Any]], post: bool = False) -> int:
+    """Grava cabeçalho + itens e, se post=True, posta no estoque — numa única transação."""
+    with qtx() as cur:
+        return services.save_purchase(cur, head, items, post)
+
+# ===================== Histórico de preços de compra =====================
+# Resumo por produto × fornecedor (último, mín., máx., média ponderada, média ponderada 90 dias)
+# e série mensal, mantidos por resto.fn_price_history_refresh() ao postar/estornar compras.
+PRICE_HISTORY_REFRESH_HOURS = 24   # janela de 90 dias "anda" com o tempo → recalcula 1x/dia
+COST_BASIS = {"last": "Último custo (cadastro)", "avg90": "Média ponderada 90 dias (compras)"}
+
+@st.cache_resource(show_spinner=False)
+def _ensure_price_history_schema():
+    qexec("""
+    do $$
+    begin
+      create table if not exists resto.price_history (
+        product_id   bigint not null references resto.product(id) on delete cascade,
+        supplier_id  bigint not null references resto.supplier(id) on delete cascade,
+        last_price   numeric(14,4),
+        last_date    date,
+        min_price    numeric(14,4),
+        max_price    numeric(14,4),
+        avg_price    numeric(14,4),
+        total_qty    numeric(18,3) not null default 0,
+        total_value  numeric(18,2) not null default 0,
+        qty_90d      numeric(18,3) not null default 0,
+        value_90d    numeric(18,2) not null default 0,
+        avg_90d      numeric(14,4),
+        n_purchases  integer not null default 0,
+        refreshed_at timestamptz not null default now(),
+        primary key (product_id, supplier_id)
+      );
+
+      create table if not exists resto.price_series_monthly (
+        product_id  bigint not null references resto.product(id) on delete cascade,
+        supplier_id bigint not null references resto.supplier(id) on delete cascade,
+        month       date not null,
+        qty         numeric(18,3) not null default 0,
+        value       numeric(18,2) not null default 0,
+        avg_price   numeric(14,4),
+        min_price   numeric(14,4),
+        max_price   numeric(14,4),
+        primary key (product_id, supplier_id, month)
+      );
+    end $$;
+    """)
+    qexec("""
+    create or replace view resto.v_purchase_price as
+      select pi.id, pi.product_id, pu.supplier_id, pu.doc_date, pi.qty,
+             coalesce(nullif(pi.total,0), pi.qty * pi.unit_price) as value,
+             coalesce(nullif(pi.total,0), pi.qty * pi.unit_price) / pi.qty as price
+        from resto.purchase_item pi
+        join resto.purchase pu on pu.id = pi.purchase_id
+       where pu.status = 'POSTADA' and pi.qty > 0;
+    """)
+    qexec("""
+    create or replace function resto.fn_price_history_refresh(p_products bigint[] default null)
+    returns void language plpgsql as $f$
+    begin
+      delete from resto.price_history  where p_products is null or product_id = any(p_products);
+      insert into resto.price_history(product_id, supplier_id, last_price, last_date, min_price, max_price,
+                                      avg_price, total_qty, total_value, qty_90d, value_90d, avg_90d,
+                                      n_purchases, refreshed_at)
+      select product_id, supplier_id,
+             (array_agg(price order by doc_date desc, id desc))[1], max(doc_date), min(price), max(price),
+             sum(value) / nullif(sum(qty),0), sum(qty), sum(value),
+             coalesce(sum(qty)   filter (where doc_date >= current_date - 90), 0),
+             coalesce(sum(value) filter (where doc_date >= current_date - 90), 0),
+             sum(value) filter (where doc_date >= current_date - 90)
+               / nullif(sum(qty) filter (where doc_date >= current_date - 90), 0),
+             count(*), now()
+        from resto.v_purchase_price
+       where p_products is null or product_id = any(p_products)
+       group by product_id, supplier_id;
+
+      delete from resto.price_series_monthly where p_products is null or product_id = any(p_products);
+      insert into resto.price_series_monthly(product_id, supplier_id, month, qty, value, avg_price, min_price, max_price)
+      select product_id, supplier_id, date_trunc('month', doc_date)::date,
+             sum(qty), sum(value), sum(value) / nullif(sum(qty),0), min(price), max(price)
+        from resto.v_purchase_price
+       where p_products is null or product_id = any(p_products)
+       group by 1, 2, 3;
+    end $f$;
+    """)
+    qexec("""
+    create or replace view resto.v_product_cost as
+      select product_id,
+             (array_agg(last_price order by last_date desc nulls last))[1] as last_price,
+             max(last_date)                                    as last_date,
+             min(min_price)                                    as min_price,
+             sum(total_value) / nullif(sum(total_qty),0)       as avg_price,
+             sum(value_90d)   / nullif(sum(qty_90d),0)         as avg_90d,
+             min(refreshed_at)                                 as refreshed_at
+        from resto.price_history
+       group by product_id;
+    """)
+    # compras já postadas antes do histórico existir (ou com a tabela vazia): carga inicial
+    qexec("""
+    select resto.fn_price_history_refresh(null)
+     where not exists (select 1 from resto.price_history)
+       and exists (select 1 from resto.v_purchase_price);
+    """)
+
+def refresh_price_history(product_ids: Optional[List[int]] = None) -> None:
+    """Recalcula o histórico (todos os produtos se product_ids for None)."""
+    qexec("select resto.fn_price_history_refresh(%s::bigint[]);",
+          (None if product_ids is None else [int(x) for x in product_ids],))
+
+def refresh_price_history_if_stale(max_age_hours: float = PRICE_HISTORY_REFRESH_HOURS) -> bool:
+    """Recalcula tudo se o histórico for mais velho que max_age_hours ou estiver vazio com compras postadas."""
+    r = qone("""
+        select case when count(*) = 0 then exists (select 1 from resto.v_purchase_price)
+                    else min(refreshed_at) < now() - make_interval(secs => %s) end as stale
+          from resto.price_history;
+    """, (float(max_age_hours) * 3600.0,))
+    if r and r.get("stale"):
+        refresh_price_history()
+        return True
+    return False
+
+def recipe_costs(basis: str = "last") -> Dict[int, Dict[str, Any]]:
+    """Custo de todas as fichas técnicas numa única consulta.
+       basis='last' usa product.last_cost; 'avg90' usa a média ponderada de 90 dias das compras
+       (cai no last_cost se o ingrediente não teve compra no período)."""
+    cost_expr = "coalesce(pc.avg_90d, p.last_cost, 0)" if basis == "avg90" else "coalesce(p.last_cost, 0)"
+    rows = qall(f"""
+        select r.product_id, r.yield_qty, r.overhead_pct, r.loss_pct, u.abbr as yield_unit,
+               coalesce(sum(ri.qty * coalesce(ri.conversion_factor,1) * {cost_expr}), 0) as ing_cost,
+               count(ri.id) as n_items
+          from resto.recipe r
+          left join resto.unit u         on u.id = (to_jsonb(r)->>'yield_unit_id')::bigint
+          join resto.recipe_item ri      on ri.recipe_id = r.id
+          join resto.product p           on p.id = ri.ingredient_id
+          left join resto.v_product_cost pc on pc.product_id = ri.ingredient_id
+         group by r.id, r.product_id, r.yield_qty, r.overhead_pct, r.loss_pct, u.abbr;
+    """) or []
+    out = {}
+    for r in rows:
+        yq = float(r["yield_qty"] or 0)
+        if yq <= 0 or not r["n_items"]:
+            continue
+        batch = (float(r["ing_cost"]) * (1 + float(r["overhead_pct"] or 0) / 100.0)
+                 * (1 + float(r["loss_pct"] or 0) / 100.0))
+        out[int(r["product_id"])] = {"unit_cost": batch / yq, "batch_cost": batch,
+                                     "yield_qty": yq, "yield_unit": r["yield_unit"]}
+    return out
+
+# ===================== Compras (pesquisa paginada) =====================
+PURCHASE_PAGE_SIZE = 50
+
+def _purchase_filters(dt_ini=None, dt_fim=None, statuses=None, supplier_id=None, text: str = ""):
+    where, params = [], []
+    if dt_ini and dt_fim:
+        where.append("p.doc_date between %s and %s")
+        params += [dt_ini, dt_fim]
+    if statuses:
+        where.append("p.status = any(%s)")
+        params.append(list(statuses))
+    if supplier_id:
+        where.append("p.supplier_id = %s")
+        params.append(int(supplier_id))
+    text = (text or "").strip()
+    if text:
+        like = f"%{text}%"
+        cond = "(p.doc_number ilike %s or s.name ilike %s"
+        params += [like, like]
+        if text.lstrip("#").isdigit():
+            cond += " or p.id = %s"
+            params.append(int(text.lstrip("#")))
+        where.append(cond + ")")
+    return where, params
+
+def purchase_count(**filters) -> int:
+    where, params = _purchase_filters(**filters)
+    r = qone(f"""
+        select count(*) as n
+          from resto.purchase p
+          join resto.supplier s on s.id = p.supplier_id
+         {('where ' + ' and '.join(where)) if where else ''};
+    """, tuple(params))
+    return int((r or {}).get("n") or 0)
+
+def purchase_page(cursor: Optional[Tuple[Any, int]] = None, page_size: int = PURCHASE_PAGE_SIZE,
+                  **filters) -> Tuple[List[Dict[str, Any]], bool]:
+    """Uma página de compras (doc_date desc, id desc) a partir do cursor (doc_date, id) da
+       última linha da página anterior. Retorna (linhas, tem_mais)."""
+    where, params = _purchase_filters(**filters)
+    if cursor:
+        where.append("(p.doc_date, p.id) < (%s, %s)")
+        params += [cursor[0], int(cursor[1])]
+    rows = qall(f"""
+        select p.id, p.doc_date, p.doc_number, p.status, p.total, s.name as supplier
+          from resto.purchase p
+          join resto.supplier s on s.id = p.supplier_id
+         {('where ' + ' and '.join(where)) if where else ''}
+         order by p.doc_date desc, p.id desc
+         limit %s;
+    """, tuple(params + [int(page_size) + 1])) or []
+    return rows[:page_size], len(rows) > page_size
+
+# ===================== Importação de NF-e (XML) =====================
+@st.cache_resource(show_spinner=False)
+def _ensure_nfe_schema():
+    qexec(r"""
+    do $$
+    begin
+      alter table resto.purchase add column if not exists nfe_key text;
+      create unique index if not exists purchase_nfe_key_uq on resto.purchase(nfe_key) where nfe_key is not null;
+
+      -- vínculo código do fornecedor / EAN → produto (factor converte a unidade da nota p/ a do estoque)
+      create table if not exists resto.supplier_product_map (
+        id            bigserial primary key,
+        supplier_id   bigint references resto.supplier(id) on delete cascade,
+        supplier_code text,
+        ean           text,
+        product_id    bigint not null references resto.product(id) on delete cascade,
+        factor        numeric(14,6) not null default 1,
+        created_at    timestamptz not null default now()
+      );
+      create unique index if not exists spm_sup_code_uq on resto.supplier_product_map(supplier_id, supplier_code)
+        where supplier_code is not null;
+      create index if not exists spm_ean_idx on resto.supplier_product_map(ean) where ean is not null;
+      alter table resto.supplier add column if not exists cnpj text;
+      alter table resto.supplier add column if not exists doc  varchar(32);   -- antes só no Estoque → Cadastro
+      create index if not exists supplier_cnpj_digits_idx
+        on resto.supplier((regexp_replace(coalesce(nullif(cnpj,''), doc, ''), '\D', '', 'g')));
+    end $$;
+    """)
+
+def nfe_resolve(invoices: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], pd.DataFrame]:
+    """Casa emitente (CNPJ → supplier.cnpj, ou doc) e itens (código do fornecedor, EAN do vínculo,
+       EAN do produto) em poucas consultas. Devolve as notas anotadas e os itens sem vínculo."""
+    ok = [inv for inv in invoices if not inv.get("error")]
+    cnpjs = sorted({inv["emit_cnpj"] for inv in ok if inv.get("emit_cnpj")})
+    keys = [inv["nfe_key"] for inv in ok if inv.get("nfe_key")]
+
+    sup_by_cnpj = {r["cnpj"]: r["id"] for r in (qall(r"""
+        select distinct on (1) regexp_replace(coalesce(nullif(cnpj,''), doc, ''), '\D', '', 'g') as cnpj, id
+          from resto.supplier
+         where regexp_replace(coalesce(nullif(cnpj,''), doc, ''), '\D', '', 'g') = any(%s)
+         order by 1, id;
+    """, (cnpjs,)) or [])} if cnpjs else {}
+    done = {r["nfe_key"]: r["id"] for r in (qall(
+        "select nfe_key, id from resto.purchase where nfe_key = any(%s);", (keys,)) or [])} if keys else {}
+
+    maps = qall("select supplier_id, supplier_code, ean, product_id, factor from resto.supplier_product_map;") or []
+    by_code = {(m["supplier_id"], m["supplier_code"]): m for m in maps if m["supplier_code"]}
+    by_ean = {m["ean"]: m for m in maps if m["ean"]}
+    prod_by_bar = {nfe.only_digits(r["barcode"]): r["id"] for r in (qall(
+        "select id, barcode from resto.product where coalesce(barcode,'') <> '';") or [])}
+    prod_unit = {r["id"]: r["unit_id"] for r in (qall("select id, unit_id from resto.product;") or [])}
+
+    missing, seen = [], set()
+    for inv in invoices:
+        if inv.get("error"):
+            inv["status"] = "erro"
+            continue
+        if not inv.get("nfe_key") or inv["nfe_key"] in seen:
+            inv["status"] = "sem chave" if not inv.get("nfe_key") else "duplicada no lote"
+            continue
+        seen.add(inv["nfe_key"])
+        inv["supplier_id"] = sup_by_cnpj.get(inv["emit_cnpj"])
+        inv["purchase_id"] = done.get(inv["nfe_key"])
+        unresolved = 0
+        for it in inv["items"]:
+            m = by_code.get((inv["supplier_id"], it["supplier_code"])) or (by_ean.get(it["ean"]) if it["ean"] else None)
+            pid = m["product_id"] if m else (prod_by_bar.get(it["ean"]) if it["ean"] else None)
+            it["product_id"] = pid
+            it["factor"] = float(m["factor"]) if m else 1.0
+            it["unit_id"] = prod_unit.get(pid)
+            if pid is None:
+                unresolved += 1
+                missing.append({"cnpj": inv["emit_cnpj"], "fornecedor": inv["emit_name"],
+                                "supplier_id": inv["supplier_id"], "supplier_code": it["supplier_code"],
+                                "ean": it["ean"], "description": it["description"], "unit": it["unit"]})
+        inv["unresolved"] = unresolved
+        inv["status"] = ("já importada" if inv["purchase_id"] else
+                         "sem fornecedor" if not inv["supplier_id"] else
+                         "itens sem vínculo" if unresolved else "pronta")
+
+    miss = pd.DataFrame(missing)
+    if not miss.empty:
+        miss = miss.drop_duplicates(["cnpj", "supplier_code", "ean"]).reset_index(drop=True)
+    return invoices, miss
+
+def nfe_create_suppliers(invoices: List[Dict[str, Any]]) -> int:
+    """Cadastra (nome + CNPJ) os emitentes ainda desconhecidos."""
+    new = {inv["emit_cnpj"]: inv["emit_name"] for inv in invoices
+           if not inv.get("error") and not inv.get("supplier_id") and inv.get("emit_cnpj")}
+    if not new:
+        return 0
+    return qexec("insert into resto.supplier(name, cnpj) select * from unnest(%s::text[], %s::text[]);",
+                 (list(new.values()), list(new.keys())))
+
+def nfe_save_mappings(rows: List[Dict[str, Any]]) -> int:
+    """Grava vínculos código/EAN → produto. Com fornecedor e código: upsert por fornecedor+código.
+       Sem isso, vale o EAN (atualiza o vínculo de EAN existente ou cria um). Sem fornecedor e sem EAN
+       não há como casar a próxima nota: a linha é ignorada. Retorna quantos vínculos foram gravados."""
+    by_code = [r for r in rows if r.get("supplier_id") and r.get("supplier_code")]
+    by_ean = [r for r in rows if not (r.get("supplier_id") and r.get("supplier_code")) and r.get("ean")]
+    if not by_code and not by_ean:
+        return 0
+    with qtx() as cur:
+        if by_code:
+            cur.executemany("""
+                insert into resto.supplier_product_map(supplier_id, supplier_code, ean, product_id, factor)
+                values (%s,%s,%s,%s,%s)
+                on conflict (supplier_id, supplier_code) where supplier_code is not null
+                do update set product_id = excluded.product_id, factor = excluded.factor,
+                              ean = coalesce(excluded.ean, resto.supplier_product_map.ean);
+            """, [(int(r["supplier_id"]), r["supplier_code"], r.get("ean"), int(r["product_id"]),
+                   float(r.get("factor") or 1)) for r in by_code])
+        if by_ean:
+            # NULL não conflita no índice único: atualiza o que houver antes de inserir
+            cur.executemany("""
+                with upd as (
+                  update resto.supplier_product_map
+                     set product_id = %(pid)s, factor = %(factor)s
+                   where supplier_code is null and ean = %(ean)s and supplier_id is not distinct from %(sup)s
+                  returning id
+                )
+                insert into resto.supplier_product_map(supplier_id, supplier_code, ean, product_id, factor)
+                select %(sup)s, null, %(ean)s, %(pid)s, %(factor)s
+                 where not exists (select 1 from upd);
+            """, [{"sup": int(r["supplier_id"]) if r.get("supplier_id") else None, "ean": r["ean"],
+                   "pid": int(r["product_id"]), "factor": float(r.get("factor") or 1)} for r in by_ean])
+    return len(by_code) + len(by_ean)
+
+def nfe_import(invoices: List[Dict[str, Any]], post: bool = False) -> List[int]:
+    """Cria compras + itens (um item por lote de <rastro>) de todas as notas 'pronta' numa
+       única transação, com inserts multi-linha. Retorna os ids das compras."""
+    ready = [inv for inv in invoices if inv.get("status") == "pronta"]
+    if not ready:
+        return []
+    with qtx() as cur:
+        cur.execute("""
+            insert into resto.purchase(supplier_id, doc_number, cfop_entrada, doc_date, freight_value,
+                                       other_costs, total, status, nfe_key)
+            select u.sup, u.num, u.cfop, u.dt, u.frete, u.outros, u.total, 'LANÇADA', u.chave
+              from unnest(%s::bigint[], %s::text[], %s::text[], %s::date[], %s::numeric[], %s::numeric[],
+                          %s::numeric[], %s::text[]) as u(sup, num, cfop, dt, frete, outros, total, chave)
+            on conflict (nfe_key) where nfe_key is not null do nothing
+            returning id, nfe_key;
+        """, ([int(inv["supplier_id"]) for inv in ready],
+              [inv.get("number") for inv in ready],
+              [nfe.entry_cfop(next((it["cfop"] for it in inv["items"] if it.get("cfop")), None)) for inv in ready],
+              [inv.get("issue_date") or date.today().isoformat() for inv in ready],
+              [float(inv["freight_value"]) for inv in ready],
+              [float(inv["other_costs"]) for inv in ready],
+              [round(sum(it["gross"] - it["discount"] for it in inv["items"]), 2) for inv in ready],
+              [inv.get("nfe_key") for inv in ready]))
+        pid_by_key = {r["nfe_key"]: int(r["id"]) for r in cur.fetchall()}
+
+        cols = {k: [] for k in ("pid", "prod", "qty", "unit", "price", "disc", "total", "lot", "exp")}
+        for inv in ready:
+            pid = pid_by_key.get(inv["nfe_key"])
+            if pid is None:   # importada em paralelo por outra sessão
+                continue
+            for it in inv["items"]:
+                base_qty = float(it["qty"]) or 1.0
+                for lot in it["lots"]:
+                    share = float(lot["qty"]) / base_qty
+                    cols["pid"].append(pid)
+                    cols["prod"].append(int(it["product_id"]))
+                    cols["qty"].append(round(float(lot["qty"]) * it["factor"], 3))
+                    cols["unit"].append(it.get("unit_id"))
+                    cols["price"].append(float(it["unit_price"]) / (it["factor"] or 1.0))
+                    cols["disc"].append(round(float(it["discount"]) * share, 2))
+                    cols["total"].append(round((float(it["gross"]) - float(it["discount"])) * share, 2))
+                    cols["lot"].append(lot.get("lot_number"))
+                    cols["exp"].append(lot.get("expiry_date"))
+        cur.execute("""
+            insert into resto.purchase_item(
+              purchase_id, product_id, qty, unit_id, unit_price, discount, total, lot_number, expiry_date)
+            select * from unnest(%s::bigint[], %s::bigint[], %s::numeric[], %s::bigint[], %s::numeric[],
+                                 %s::numeric[], %s::numeric[], %s::text[], %s::date[])
+            returning id, purchase_id, product_id, qty, unit_price, coalesce(expiry_date::text,'') as exp;
+        """, tuple(cols[k] for k in ("pid", "prod", "qty", "unit", "price", "disc", "total", "lot", "exp")))
+        rows = cur.fetchall()
+        if post:
+            by_purchase: Dict[int, List[Dict[str, Any]]] = {}
+            for r in rows:
+                by_purchase.setdefault(int(r["purchase_id"]), []).append(r)
+            for pid, its in by_purchase.items():
+                services.post_purchase_items(cur, pid, its)
+    return list(pid_by_key.values())
+
 def page_compras():
     import pandas as pd
     from datetime import date, timedelta
@@ -1070,6 +2233,9 @@ def page_compras():
           exception when duplicate_object then null;
           end;
 
+          create index if not exists purchase_date_id_idx on resto.purchase(doc_date desc, id desc);
+          create index if not exists purchase_supplier_idx on resto.purchase(supplier_id);
+
           -- Itens
           create table if not exists resto.purchase_item(
             id           bigserial primary key,
@@ -1086,46 +2252,96 @@ def page_compras():
         end $$;
         """)
 
-    def _post_purchase(purchase_id: int):
-        """Gera movimentos de estoque (IN) de todos os itens dessa compra."""
-        items = qall("""
-            select id, product_id, qty, unit_price, coalesce(expiry_date::text,'') as exp
-              from resto.purchase_item
-             where purchase_id=%s;
-        """, (int(purchase_id),)) or []
-        for it in items:
-            note = f"lote:{it['id']}" + (f";exp:{it['exp']}" if it["exp"] else "")
-            # registra IN por lote (reference_id = id do purchase_item)
-            qexec("select resto.sp_register_movement(%s,'IN',%s,%s,'purchase',%s,%s);",
-                  (int(it["product_id"]), float(it["qty"]), float(it["unit_price"]), int(it["id"]), note))
-        qexec("update resto.purchase set status='POSTADA', posted_at=now() where id=%s;", (int(purchase_id),))
-
-    def _unpost_purchase(purchase_id: int):
-        """Estorna (gera OUT) em todos os itens. Marca ESTORNADA."""
-        items = qall("""
-            select id, product_id, qty, unit_price
-              from resto.purchase_item
-             where purchase_id=%s;
-        """, (int(purchase_id),)) or []
-        for it in items:
-            note = f"revert:purchase:{purchase_id};lot:{it['id']}"
-            qexec("select resto.sp_register_movement(%s,'OUT',%s,%s,'purchase_revert',%s,%s);",
-                  (int(it["product_id"]), float(it["qty"]), float(it["unit_price"]), int(it["id"]), note))
-        qexec("update resto.purchase set status='ESTORNADA', estornado_em=now() where id=%s;", (int(purchase_id),))
-
     _ensure_purchase_schema()
 
     header("📥 Compras", "Lançar notas, editar/excluir, e postar/estornar no estoque.")
-    tabs = st.tabs(["🧾 Nova compra", "🗂️ Gerenciar compras"])
+    tabs = st.tabs(["🧾 Nova compra", "🗂️ Gerenciar compras", "📄 Importar NF-e (XML)"])
+
+    # ============================== Aba: Importar NF-e ==============================
+    # (renderizada primeiro: as outras abas usam return antecipado)
+    with tabs[2]:
+        card_start()
+        st.subheader("Importar XML de NF-e")
+        ups = st.file_uploader("Arquivos XML", type=["xml"], accept_multiple_files=True, key="nfe_ups")
+        if st.button("📖 Ler XMLs", disabled=not ups, key="nfe_read"):
+            st.session_state["nfe_parsed"] = nfe.parse_many([(u.name, u.getvalue()) for u in ups])
+
+        parsed = st.session_state.get("nfe_parsed")
+        if parsed:
+            invs, miss = nfe_resolve(parsed)
+            resumo = pd.DataFrame([{
+                "arquivo": i["file"], "status": i["status"], "nº": i.get("number"),
+                "emissão": i.get("issue_date"), "emitente": i.get("emit_name"), "cnpj": i.get("emit_cnpj"),
+                "itens": len(i.get("items") or []), "sem vínculo": i.get("unresolved", 0),
+                "total NF": i.get("total"), "obs": i.get("error") or "",
+            } for i in invs])
+            st.dataframe(resumo, use_container_width=True, hide_index=True)
+            st.caption(" • ".join(f"{k}: {v}" for k, v in resumo["status"].value_counts().items()))
+
+            if any(i["status"] == "sem fornecedor" for i in invs):
+                if st.button("🏢 Cadastrar emitentes desconhecidos como fornecedores", key="nfe_mk_sup"):
+                    n = nfe_create_suppliers(invs)
+                    st.success(f"✅ {n} fornecedor(es) cadastrado(s).")
+                    _rerun()
+
+            if not miss.empty:
+                st.markdown("#### Itens sem vínculo com produto")
+                prods_all = qall("select id, name from resto.product order by name;") or []
+                label_by_id = {p["id"]: f"{p['id']} • {p['name']}" for p in prods_all}
+                miss_ed = miss.copy()
+                miss_ed["produto"] = None
+                miss_ed["factor"] = 1.0
+                ed = st.data_editor(
+                    miss_ed[["fornecedor", "supplier_code", "ean", "description", "unit", "produto", "factor"]],
+                    use_container_width=True, hide_index=True, num_rows="fixed", key="nfe_map_editor",
+                    disabled=["fornecedor", "supplier_code", "ean", "description", "unit"],
+                    column_config={
+                        "fornecedor":    st.column_config.TextColumn("Fornecedor"),
+                        "supplier_code": st.column_config.TextColumn("Cód. fornecedor"),
+                        "ean":           st.column_config.TextColumn("EAN"),
+                        "description":   st.column_config.TextColumn("Descrição na nota"),
+                        "unit":          st.column_config.TextColumn("Un (nota)"),
+                        "produto":       st.column_config.SelectboxColumn("Produto", options=list(label_by_id.values())),
+                        "factor":        st.column_config.NumberColumn("Fator (un nota → estoque)", min_value=0.000001,
+                                                                       step=0.001, format="%.3f"),
+                    },
+                )
+                if st.button("🔗 Salvar vínculos", key="nfe_save_map"):
+                    id_by_label = {v: k for k, v in label_by_id.items()}
+                    rows = []
+                    for i, r in ed.iterrows():
+                        if r["produto"] and r["produto"] in id_by_label:
+                            rows.append({"supplier_id": int(miss.at[i, "supplier_id"]) if pd.notna(miss.at[i, "supplier_id"]) else None,
+                                         "supplier_code": _grid_py(r["supplier_code"]) or None,
+                                         "ean": _grid_py(r["ean"]) or None,
+                                         "product_id": id_by_label[r["produto"]], "factor": r["factor"]})
+                    try:
+                        n = nfe_save_mappings(rows)
+                    except Exception as e:
+                        st.error(f"Falha ao salvar vínculos: {e}")
+                    else:
+                        if n < len(rows):
+                            st.warning(f"✅ {n} vínculo(s) salvo(s) • {len(rows) - n} ignorado(s): sem fornecedor "
+                                       "cadastrado e sem EAN — cadastre o emitente antes de vincular pelo código.")
+                        else:
+                            st.success(f"✅ {n} vínculo(s) salvo(s).")
+                            _rerun()
+
+            prontas = [i for i in invs if i["status"] == "pronta"]
+            post_now = st.checkbox("Postar no estoque ao importar", value=False, key="nfe_post")
+            if st.button(f"📥 Importar {len(prontas)} nota(s) pronta(s)", disabled=not prontas, key="nfe_import"):
+                try:
+                    ids = nfe_import(invs, post=post_now)
+                    st.session_state.pop("nfe_parsed", None)
+                    st.success(f"✅ {len(ids)} compra(s) criada(s)" + (" e postada(s)." if post_now else "."))
+                except Exception as e:
+                    st.error(f"Falha na importação — nada foi gravado. {e}")
+        card_end()
 
     # ============================== Aba: Nova compra ==============================
     with tabs[0]:
-        suppliers = qall("select id, name from resto.supplier order by name;") or []
-        prods     = qall("select id, name, unit_id from resto.product order by name;") or []
         units     = qall("select id, abbr from resto.unit order by abbr;") or []
 
-        sup_opts  = [(s['id'], s['name']) for s in suppliers]
-        prod_opts = [(p['id'], p['name']) for p in prods]
         unit_opts = [(u['id'], u['abbr']) for u in units]
         unit_idx_by_id = {u['id']: i for i, u in enumerate(units)}  # p/ default do select
 
@@ -1136,7 +2352,8 @@ def page_compras():
         st.subheader("Cabeçalho")
         colh1, colh2 = st.columns([2,1])
         with colh1:
-            supplier = st.selectbox("Fornecedor *", options=sup_opts, format_func=lambda x: x[1] if isinstance(x, tuple) else x, key="comp_sup")
+            sup_row = supplier_picker("Fornecedor *", key="comp_sup")
+            supplier = (sup_row["id"], sup_row["name"]) if sup_row else None
             doc_number = st.text_input("Número do documento", key="comp_docnum")
             cfop_ent   = st.text_input("CFOP Entrada", value="1102", key="comp_cfop")
         with colh2:
@@ -1146,16 +2363,17 @@ def page_compras():
 
         st.markdown("### Itens da compra (cada item = **lote**)")
         with st.expander("➕ Adicionar item", expanded=False):
+            # busca fora do form: precisa de rerun a cada termo digitado
+            prow = product_picker("Produto", key="add_prod")
+            prod = (prow["id"], prow["name"]) if prow else None
             with st.form("form_add_item"):
                 pcol1, pcol2 = st.columns([2,1])
                 with pcol1:
-                    prod = st.selectbox("Produto", options=prod_opts, key="add_prod",
-                                        format_func=lambda x: x[1] if isinstance(x, tuple) else x)
+                    st.text_input("Produto", value=prod[1] if prod else "", disabled=True)
                 with pcol2:
                     # unidade default do produto (se tiver)
                     default_unit_index = 0
                     try:
-                        prow = next((r for r in prods if r["id"] == (prod[0] if isinstance(prod, tuple) else None)), None)
                         if prow and prow.get("unit_id") in unit_idx_by_id:
                             default_unit_index = unit_idx_by_id[prow["unit_id"]]
                     except Exception:
@@ -1222,31 +2440,16 @@ def page_compras():
                 st.error("Inclua ao menos 1 item.")
                 card_end(); return
 
-            pid = supplier[0]
-            row = qone("""
-                insert into resto.purchase(supplier_id, doc_number, cfop_entrada, doc_date, freight_value, other_costs, total, status)
-                values (%s,%s,%s,%s,%s,%s,%s,'LANÇADA')
-                returning id;
-            """, (int(pid), doc_number, cfop_ent, doc_date, float(freight), float(other), float(total_doc)))
-            purchase_id = row["id"]
-
-            # itens
-            for it in st.session_state["compra_itens"]:
-                qone("""
-                    insert into resto.purchase_item(
-                      purchase_id, product_id, qty, unit_id, unit_price, discount, total, lot_number, expiry_date
-                    ) values (%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                    returning id;
-                """, (int(purchase_id), int(it["product_id"]), float(it["qty"]), int(it["unit_id"]),
-                      float(it["unit_price"]), float(it["discount"]), float(it["total"]),
-                      (it["lot_number"] or None), (it["expiry_date"] or None)))
-
-            if salvar_postar:
-                try:
-                    _post_purchase(purchase_id)
-                except Exception:
-                    st.error("Falha ao postar no estoque (verifique a função resto.sp_register_movement).")
-                    card_end(); return
+            try:
+                purchase_id = save_purchase(
+                    {"supplier_id": supplier[0], "doc_number": doc_number, "cfop_entrada": cfop_ent,
+                     "doc_date": doc_date, "freight_value": freight, "other_costs": other},
+                    st.session_state["compra_itens"],
+                    post=bool(salvar_postar),
+                )
+            except Exception as e:
+                st.error(f"Falha ao salvar a compra — nada foi gravado. {e}")
+                card_end(); return
 
             st.session_state["compra_itens"] = []
             st.success(f"Compra #{purchase_id} salva" + (" e **POSTADA** no estoque." if salvar_postar else "."))
@@ -1268,40 +2471,67 @@ def page_compras():
             status_sel = st.multiselect("Status", ["RASCUNHO","LANÇADA","POSTADA","ESTORNADA","CANCELADA"],
                                         default=["LANÇADA","POSTADA","RASCUNHO"])
         with g4:
-            sup_f = st.selectbox("Fornecedor (filtro)",
-                                 options=[(0,"— todos —")] + [(s['id'], s['name']) for s in suppliers],
-                                 format_func=lambda x: x[1])
-
-        where = ["p.doc_date between %s and %s"]
-        params = [dt_ini, dt_fim]
-        if status_sel:
-            where.append("p.status = any(%s)")
-            params.append(status_sel)
-        if sup_f and isinstance(sup_f, tuple) and sup_f[0] != 0:
-            where.append("p.supplier_id = %s")
-            params.append(int(sup_f[0]))
-
-        sql_list = f"""
-            select p.id, p.doc_date, p.doc_number, p.status, p.total, s.name as supplier
-              from resto.purchase p
-              join resto.supplier s on s.id = p.supplier_id
-             where {' and '.join(where)}
-             order by p.doc_date desc, p.id desc
-             limit 500;
-        """
-        rows = qall(sql_list, tuple(params)) or []
-        df_list = pd.DataFrame(rows)
-        if df_list.empty:
+            sup_f_row = supplier_picker("Fornecedor (filtro)", key="pc_sup", placeholder="— todos —")
+            sup_f = (sup_f_row["id"], sup_f_row["name"]) if sup_f_row else (0, "— todos —")
+
+        q_txt = st.text_input("Buscar (nº do documento, fornecedor ou #id)", key="pc_q")
+        all_period = st.checkbox("Todo o período (ignorar datas)", value=False, key="pc_all")
+        filters = dict(
+            dt_ini=None if all_period else dt_ini, dt_fim=None if all_period else dt_fim,
+            statuses=status_sel,
+            supplier_id=(int(sup_f[0]) if isinstance(sup_f, tuple) and sup_f[0] != 0 else None),
+            text=q_txt,
+        )
+
+        # paginação por cursor (keyset); volta ao início quando os filtros mudam
+        sig = repr(sorted(filters.items(), key=lambda kv: kv[0]))
+        if st.session_state.get("pc_sig") != sig:
+            st.session_state["pc_sig"] = sig
+            st.session_state["pc_cursors"] = [None]
+        if st.session_state["pc_cursors"] == [None] or "pc_total" not in st.session_state:
+            st.session_state["pc_total"] = purchase_count(**filters)   # só recontado na 1ª página
+        cursors = st.session_state["pc_cursors"]
+        total_n = st.session_state["pc_total"]
+
+        rows, has_more = purchase_page(cursors[-1], **filters)
+        if not rows:
             st.caption("Nenhuma compra encontrada para os filtros.")
             card_end(); return
 
-        # seleção
-        sel = st.selectbox("Selecione a compra", options=[(r["id"], f"#{r['id']} • {r['doc_date']} • {r['supplier']} • {r['status']} • {money(r['total'])}") for r in rows],
-                           format_func=lambda x: x[1] if isinstance(x, tuple) else x)
-        if not sel:
+        page_no = len(cursors)
+        n_pages = max(1, -(-total_n // PURCHASE_PAGE_SIZE))
+        pg1, pg2, pg3 = st.columns([1, 2, 1])
+        with pg1:
+            if st.button("◀ Anterior", disabled=page_no == 1, key="pc_prev"):
+                cursors.pop()
+                _rerun()
+        with pg2:
+            st.caption(f"Página {page_no} de {n_pages} • {total_n} compra(s) encontradas")
+        with pg3:
+            if st.button("Próxima ▶", disabled=not has_more, key="pc_next"):
+                cursors.append((rows[-1]["doc_date"], rows[-1]["id"]))
+                _rerun()
+
+        # seleção (o detalhe só é carregado para a linha escolhida)
+        df_list = pd.DataFrame(rows)
+        pick = st.dataframe(
+            df_list, use_container_width=True, hide_index=True,
+            on_select="rerun", selection_mode="single-row", key=f"pc_list_{page_no}",
+            column_config={
+                "id":         st.column_config.NumberColumn("ID"),
+                "doc_date":   st.column_config.DateColumn("Data"),
+                "doc_number": st.column_config.TextColumn("Documento"),
+                "status":     st.column_config.TextColumn("Status"),
+                "total":      st.column_config.NumberColumn("Total", format="%.2f"),
+                "supplier":   st.column_config.TextColumn("Fornecedor"),
+            },
+        )
+        sel_rows = pick.selection.rows if pick and pick.selection else []
+        if not sel_rows:
+            st.caption("Selecione uma compra na lista para ver/editar.")
             card_end(); return
 
-        sel_id = int(sel[0])
+        sel_id = int(df_list.iloc[sel_rows[0]]["id"])
         head = qone("""
             select p.*, s.name as supplier_name
               from resto.purchase p
@@ -1322,12 +2552,12 @@ def page_compras():
 
         # --------- Header editável (se não POSTADA nem ESTORNADA/CANCELADA)
         can_edit = head["status"] in ("RASCUNHO","LANÇADA")
+        sup2_row = supplier_picker("Fornecedor *", key=f"edit_sup_{sel_id}",
+                                   selected_id=head["supplier_id"], disabled=not can_edit)
+        sup2 = (sup2_row["id"], sup2_row["name"]) if sup2_row else (head["supplier_id"], head["supplier_name"])
         with st.form(f"form_head_{sel_id}"):
             hc1, hc2, hc3 = st.columns([2,1,1])
             with hc1:
-                sup2 = st.selectbox("Fornecedor *", options=sup_opts,
-                                    index=next((i for i, t in enumerate(sup_opts) if t[0]==head["supplier_id"]), 0),
-                                    disabled=not can_edit, key=f"edit_sup_{sel_id}")
                 doc2 = st.text_input("Número do documento", value=head.get("doc_number") or "", disabled=not can_edit, key=f"edit_doc_{sel_id}")
             with hc2:
                 cf2 = st.text_input("CFOP Entrada", value=head.get("cfop_entrada") or "", disabled=not can_edit, key=f"edit_cfop_{sel_id}")
@@ -1377,10 +2607,9 @@ def page_compras():
                 apply_items = st.button("💾 Salvar alterações (itens)", disabled=not can_edit, key=f"btn_apply_items_{sel_id}")
             with ib:
                 with st.popover("➕ Adicionar item", disabled=not can_edit):
+                    nprod_row = product_picker("Produto", key=f"add_prod_exist_{sel_id}")
+                    nprod = (nprod_row["id"], nprod_row["name"]) if nprod_row else None
                     with st.form(f"form_add_item_exist_{sel_id}"):
-                        nprod = st.selectbox("Produto", options=prod_opts,
-                                             key=f"add_prod_exist_{sel_id}",
-                                             format_func=lambda x: x[1] if isinstance(x, tuple) else x)
                         nunit = st.selectbox("Unidade", options=unit_opts,
                                              key=f"add_unit_exist_{sel_id}",
                                              format_func=lambda x: x[1] if isinstance(x, tuple) else x)
@@ -1407,61 +2636,41 @@ def page_compras():
                 est_btn = st.button("↩️ Estornar", disabled=(head["status"]!="POSTADA"), key=f"btn_est_{sel_id}")
 
             if apply_items and can_edit:
-                # comparar e aplicar
-                orig = df_it.set_index("id")
-                new  = edited.set_index("id")
-
-                upd = 0; delc = 0; err = 0
-                # deletar
-                to_del = new.index[new["Excluir?"] == True].tolist()
-                for iid in to_del:
-                    try:
-                        qexec("delete from resto.purchase_item where id=%s;", (int(iid),))
-                        delc += 1
-                    except Exception:
-                        err += 1
-
-                # atualizar (recalcula total)
-                keep_ids = [i for i in new.index if i not in to_del]
-                for iid in keep_ids:
-                    a = orig.loc[iid]; b = new.loc[iid]
-                    changed = any(str(a.get(f,"")) != str(b.get(f,"")) for f in
-                                  ["qty","unit_price","discount","lot_number","expiry_date"])
-                    if not changed:
-                        continue
-                    try:
-                        new_total = float(b.get("qty") or 0)*float(b.get("unit_price") or 0) - float(b.get("discount") or 0)
-                        qexec("""
-                            update resto.purchase_item
-                               set qty=%s, unit_price=%s, discount=%s, total=%s, lot_number=%s, expiry_date=%s
-                             where id=%s;
-                        """, (float(b.get("qty") or 0), float(b.get("unit_price") or 0),
-                              float(b.get("discount") or 0), float(new_total),
-                              (b.get("lot_number") or None), (str(b.get("expiry_date")) if b.get("expiry_date") else None),
-                              int(iid)))
-                        upd += 1
-                    except Exception:
-                        err += 1
-
-                # atualiza total do cabeçalho
-                new_total_doc = qone("select coalesce(sum(total),0) s from resto.purchase_item where purchase_id=%s;", (sel_id,))["s"]
-                qexec("update resto.purchase set total=%s where id=%s;", (float(new_total_doc or 0), sel_id))
+                def _prep_item(b):
+                    qty, up, disc = (float(_grid_py(b.get(f)) or 0) for f in ("qty", "unit_price", "discount"))
+                    return {"qty": qty, "unit_price": up, "discount": disc, "total": qty * up - disc,
+                            "lot_number": _grid_py(b.get("lot_number")) or None,
+                            "expiry_date": _grid_py(b.get("expiry_date"))}
+
+                def _sync_total(cur):
+                    # atualiza total do cabeçalho
+                    cur.execute("""
+                        update resto.purchase
+                           set total = (select coalesce(sum(total),0) from resto.purchase_item where purchase_id=%s)
+                         where id=%s;
+                    """, (sel_id, sel_id))
 
-                st.success(f"Itens: ✅ {upd} atualizado(s) • 🗑️ {delc} removido(s) • ⚠️ {err} erro(s).")
-                _rerun()
+                res = grid_apply("resto.purchase_item", df_it, edited,
+                                 ["qty","unit_price","discount","lot_number","expiry_date"],
+                                 prepare=_prep_item, after=_sync_total)
+                if grid_feedback(res, "Itens"):
+                    _rerun()
 
             if post_btn and head["status"] != "POSTADA":
                 try:
-                    _post_purchase(sel_id)
+                    post_purchase(sel_id)
                     st.success("Compra postada no estoque.")
                     _rerun()
-                except Exception:
-                    st.error("Não foi possível postar. Verifique a função `resto.sp_register_movement`.")
+                except Exception as e:
+                    st.error(f"Não foi possível postar (nenhum item foi movimentado). {e}")
 
             if est_btn and head["status"] == "POSTADA":
-                _unpost_purchase(sel_id)
-                st.success("Compra estornada (estoque revertido).")
-                _rerun()
+                try:
+                    unpost_purchase(sel_id)
+                    st.success("Compra estornada (estoque revertido).")
+                    _rerun()
+                except Exception as e:
+                    st.error(f"Não foi possível estornar (nada foi alterado). {e}")
 
         # --------- Excluir / Cancelar
         st.divider()
@@ -1487,11 +2696,183 @@ def page_compras():
 
 
 #=====================================VENDAS =================================================================================
+# ===================== Vendas (fechamento atômico e idempotente) =====================
+@st.cache_resource(show_spinner=False)
+def _ensure_sale_schema():
+    qexec("""
+    do $$
+    begin
+      alter table resto.sale add column if not exists client_token uuid;
+      create unique index if not exists sale_client_token_uidx
+          on resto.sale(client_token) where client_token is not null;
+    end $$;
+    """)
+
+def close_sale(sale_date, items: List[Dict[str, Any]], client_token: str) -> Tuple[int, bool]:
+    """Venda + itens + baixa de estoque numa transação, idempotente pelo client_token.
+       Retorna (sale_id, criada_agora)."""
+    with qtx() as cur:
+        return services.close_sale(cur, sale_date, items, client_token)
+
+# ===================== Vendas: modo balcão (PDV) =====================
+SALE_CATALOG_TTL = 3600   # s — preço/cadastro alterado chega via NOTIFY; o TTL só cobre o listener fora do ar
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda f: f)
+
+def _rerun_fragment() -> None:
+    try:
+        st.rerun(scope="fragment")
+    except TypeError:   # Streamlit sem fragments
+        st.rerun()
+
+@invalidated_by("product")
+@st.cache_data(ttl=SALE_CATALOG_TTL, show_spinner=False)
+def sale_catalog() -> Dict[str, Any]:
+    """Produtos de venda em memória: por id (name, price) + índice código/EAN → id."""
+    rows = qall("""
+        select id, name, coalesce(sale_price,0)::float as price, code, barcode
+          from resto.product
+         where is_sale_item and coalesce(active, true)
+         order by name;
+    """) or []
+    index = {}
+    for r in rows:
+        for k in (r.get("barcode"), r.get("code")):
+            k = (k or "").strip().upper()
+            if k:
+                index.setdefault(k, r["id"])
+    names = rules.normalize(pd.Series([r["name"] for r in rows], dtype=object)).tolist()
+    return {"by_id": {r["id"]: r for r in rows},
+            "index": index,
+            "names": [(r["id"], n) for r, n in zip(rows, names)]}   # nome sem acento/maiúsculo, p/ a busca
+
+def pos_search(q: str, limit: int = SEARCH_LIMIT) -> List[Dict[str, Any]]:
+    """Top-N do catálogo em memória (sem ir ao banco): código/EAN exato ou prefixo, nome começando
+       com o termo, nome contendo o termo (sem acento)."""
+    cat = sale_catalog()
+    term = rules.normalize(pd.Series([q or ""], dtype=object)).iat[0]
+    if not term:
+        return list(cat["by_id"].values())[:limit]
+    ids = dict.fromkeys([cat["index"][term]] if term in cat["index"] else [])
+    ids.update(dict.fromkeys(pid for k, pid in cat["index"].items() if k.startswith(term)))
+    ids.update(dict.fromkeys(pid for pid, n in cat["names"] if n.startswith(term)))
+    ids.update(dict.fromkeys(pid for pid, n in cat["names"] if term in n))
+    return [cat["by_id"][pid] for pid in list(ids)[:limit]]
+
+def _pos_parse(entry: str) -> Tuple[float, str]:
+    """'3*7891234' / '3x7891234' → (3, '7891234'); sem multiplicador → (1, entrada)."""
+    m = re.match(r"^\s*(\d+(?:[.,]\d+)?)\s*[*xX]\s*(\S+)\s*$", entry or "")
+    if m:
+        return float(m.group(1).replace(",", ".")), m.group(2)
+    return 1.0, (entry or "").strip()
+
+def _pos_add(product_id: int, qty: float) -> None:
+    cat = sale_catalog()
+    if product_id not in cat["by_id"]:   # cadastrado depois do último carregamento do catálogo
+        sale_catalog.clear()
+        cat = sale_catalog()
+    p = cat["by_id"].get(product_id)
+    if p is None:   # deixou de ser item de venda ou foi desativado
+        st.session_state["pos_msg"] = ("warning", "Produto não está mais disponível para venda.")
+        return
+    cart = st.session_state["pos_cart"]
+    for it in cart:   # mesmo produto/preço → soma na linha existente
+        if it["product_id"] == product_id:
+            it["qty"] += qty
+            it["total"] = it["qty"] * it["unit_price"]
+            return
+    cart.append({"product_id": product_id, "product_name": p["name"], "qty": qty,
+                 "unit_price": p["price"], "total": qty * p["price"]})
+
+def _pos_on_scan() -> None:
+    """Callback do campo de código: resolve no catálogo em memória, sem consultar o banco."""
+    raw = st.session_state.get("pos_scan", "")
+    st.session_state["pos_scan"] = ""
+    if not raw.strip():
+        return
+    index = sale_catalog()["index"]
+    qty, code = (1.0, raw.strip()) if raw.strip().upper() in index else _pos_parse(raw)
+    pid = index.get(code.upper())
+    if pid is None:
+        st.session_state["pos_msg"] = ("warning", f"Código não encontrado: {code}")
+        return
+    _pos_add(pid, qty)
+    st.session_state["pos_msg"] = None
+
+@_fragment
+def _pos_sale():
+    """Carrinho do balcão: só este bloco reroda a cada leitura; a venda é gravada de uma vez no fechamento."""
+    st.session_state.setdefault("pos_cart", [])
+    st.session_state.setdefault("pos_token", str(uuid.uuid4()))
+    st.session_state.setdefault("pos_msg", None)
+
+    card_start()
+    c1, c2 = st.columns([3, 1])
+    with c1:
+        st.text_input("Código / EAN (use 3*código para quantidade)", key="pos_scan", on_change=_pos_on_scan)
+    with c2:
+        st.write("")
+        if st.button("🔄 Recarregar catálogo"):
+            sale_catalog.clear()
+
+    c3, c4, c5 = st.columns([3, 1, 1])
+    with c3:
+        q = st.text_input("🔎 Buscar produto", key="pos_prod_q", placeholder="nome, código ou EAN")
+        prod = _picker("Produto", "pos_prod", pos_search(q), lambda r: f"{r['name']} • {money(r['price'])}",
+                       None, "—", False)
+    with c4:
+        qty = st.number_input("Qtd", 0.001, 100_000.0, 1.0, 1.0, key="pos_qty")
+    with c5:
+        st.write("")
+        if st.button("➕ Adicionar", disabled=prod is None):
+            _pos_add(int(prod["id"]), float(qty))
+
+    if st.session_state["pos_msg"]:
+        kind, txt = st.session_state["pos_msg"]
+        getattr(st, kind)(txt)
+
+    cart = st.session_state["pos_cart"]
+    if cart:
+        st.dataframe(pd.DataFrame(cart)[["product_name", "qty", "unit_price", "total"]],
+                     use_container_width=True, hide_index=True)
+    total = sum(it["total"] for it in cart)
+    st.markdown(f"### Total: {money(total)}")
+
+    b1, b2, b3 = st.columns(3)
+    with b1:
+        if st.button("↩️ Remover último", disabled=not cart):
+            cart.pop()
+            _rerun_fragment()
+    with b2:
+        if st.button("🧹 Limpar", disabled=not cart):
+            cart.clear()
+            _rerun_fragment()
+    with b3:
+        close = st.button("✅ Fechar venda", type="primary", disabled=not cart)
+    card_end()
+
+    if close:
+        try:
+            sale_id, created = close_sale(date.today(), cart, st.session_state["pos_token"])
+        except Exception as e:
+            st.error(f"Falha ao fechar a venda (nada foi gravado): {e}")
+            return
+        st.session_state["pos_cart"] = []
+        st.session_state["pos_token"] = str(uuid.uuid4())
+        st.session_state["pos_msg"] = ("success", f"Venda #{sale_id} • {money(total)}" +
+                                       ("" if created else " (já gravada)"))
+        _rerun_fragment()
+
 def page_vendas():
-    header("🧾 Vendas (simples)", "Registre saídas e gere CMV.")
-    prods = qall("select id, name from resto.product where is_sale_item order by name;")
+    header("🧾 Vendas", "Registre saídas e gere CMV.")
+    modo = st.radio("Modo", ["⚡ Balcão (rápido)", "📝 Simples"], horizontal=True, key="sale_mode")
+    if modo.startswith("⚡"):
+        _pos_sale()
+        return
 
     card_start()
+    # busca fora do form: precisa de rerun a cada termo digitado
+    prow = product_picker("Produto", key="sale_prod", only_sale=True, only_active=True)
+    prod = (prow["id"], prow["name"]) if prow else None
     # Um ÚNICO formulário com DOIS botões de submit:
     #  - "Adicionar item" (atualiza a lista)
     #  - "Fechar venda..." (grava a venda e baixa estoque)
@@ -1500,10 +2881,11 @@ def page_vendas():
 
         if "sale_itens" not in st.session_state:
             st.session_state["sale_itens"] = []
+        if "sale_token" not in st.session_state:   # um token por carrinho → fechamento idempotente
+            st.session_state["sale_token"] = str(uuid.uuid4())
 
         with st.expander("Adicionar item", expanded=True):
-            prod = st.selectbox("Produto", options=[(p['id'], p['name']) for p in prods],
-                                format_func=lambda x: x[1] if isinstance(x, tuple) else x, key="sale_prod")
+            st.text_input("Produto", value=prod[1] if prod else "", disabled=True)
             qty = st.number_input("Quantidade", 0.0, 1_000_000.0, 1.0, 0.1, key="sale_qty")
             price = st.number_input("Preço unitário", 0.0, 1_000_000.0, 0.0, 0.01, key="sale_price")
 
@@ -1538,21 +2920,18 @@ def page_vendas():
         if df.empty:
             st.warning("Nenhum item no carrinho.")
             return
-        total = float(df["total"].sum())
-
-        row = qone("insert into resto.sale(date, total, status) values (%s,%s,'FECHADA') returning id;",
-                   (sale_date, total))
-        sale_id = row["id"]
-
-        for it in st.session_state["sale_itens"]:
-            qexec("insert into resto.sale_item(sale_id, product_id, qty, unit_price, total) values (%s,%s,%s,%s,%s);",
-                  (sale_id, it["product_id"], it["qty"], it["unit_price"], it["total"]))
-            # Saída usa CMP atual (sp cuidará); sem amarrar lote neste MVP de venda
-            qexec("select resto.sp_register_movement(%s,'OUT',%s,null,'sale',%s,%s);",
-                  (it["product_id"], it["qty"], sale_id, ''))
+        try:
+            sale_id, created = close_sale(sale_date, st.session_state["sale_itens"], st.session_state["sale_token"])
+        except Exception as e:
+            st.error(f"Falha ao fechar a venda (nada foi gravado): {e}")
+            return
 
         st.session_state["sale_itens"] = []  # limpa carrinho
-        st.success(f"Venda #{sale_id} fechada e estoque baixado!")
+        st.session_state["sale_token"] = str(uuid.uuid4())
+        if created:
+            st.success(f"Venda #{sale_id} fechada e estoque baixado!")
+        else:
+            st.info(f"Venda #{sale_id} já havia sido fechada (envio repetido ignorado).")
 
 # ===================== PRECIFICAÇÃO =====================
 def page_receitas_precos():
@@ -1566,111 +2945,37 @@ def page_receitas_precos():
             if hasattr(st, "experimental_rerun"):
                 st.experimental_rerun()
 
-    def _money(x):
-        try:
-            return money(x)
-        except Exception:
-            try:
-                v = float(x or 0)
-            except Exception:
-                v = 0.0
-            s = f"R$ {v:,.2f}"
-            # formata pt-BR
-            return s.replace(",", "X").replace(".", ",").replace("X", ".")
-
-    def _has_yield_unit_col() -> bool:
-        r = qone("""
-            select exists (
-                select 1 from information_schema.columns
-                 where table_schema='resto' and table_name='recipe' and column_name='yield_unit_id'
-            ) as ok;
-        """)
-        return bool(r and r.get("ok"))
-
     def _recipe_cost(product_id: int):
-        """Calcula custo estimado pelo last_cost dos ingredientes + overhead + perdas.
-           Retorna dict {'unit_cost': float, 'batch_cost': float, 'yield_qty': float, 'yield_unit': 'abbr' ou None}
-           ou None se não houver ficha técnica/ingredientes."""
-        recipe = qone("select * from resto.recipe where product_id=%s;", (product_id,))
-        if not recipe:
-            return None
-
-        items = qall("""
-            select ri.qty, coalesce(ri.conversion_factor,1) as conv, coalesce(p.last_cost,0) as last_cost
-              from resto.recipe_item ri
-              join resto.product p on p.id = ri.ingredient_id
-             where ri.recipe_id=%s;
-        """, (recipe["id"],)) or []
-
-        if not items:
-            return None
-
-        tot_ing = 0.0
-        for it in items:
-            try:
-                tot_ing += float(it["qty"]) * float(it["conv"]) * float(it["last_cost"])
-            except Exception:
-                pass
-
-        overhead = float(recipe.get("overhead_pct") or 0.0) / 100.0
-        loss     = float(recipe.get("loss_pct") or 0.0) / 100.0
-        yq       = float(recipe.get("yield_qty") or 0.0)
-        if yq <= 0:
-            return None
-
-        batch = tot_ing * (1 + overhead) * (1 + loss)
-        unit  = batch / yq if yq > 0 else 0.0
-
-        yabbr = None
-        if _has_yield_unit_col():
-            yu = recipe.get("yield_unit_id")
-            if yu:
-                r = qone("select abbr from resto.unit where id=%s;", (yu,))
-                yabbr = r["abbr"] if r else None
-
-        return {"unit_cost": unit, "batch_cost": batch, "yield_qty": yq, "yield_unit": yabbr}
+        """Custo estimado pela ficha técnica (ingredientes + overhead + perdas) na base escolhida.
+           Retorna dict {'unit_cost', 'batch_cost', 'yield_qty', 'yield_unit'} ou None sem ficha/ingredientes."""
+        return costs.get(int(product_id))
 
     header("💲 Precificação", "Simule preços e margens a partir da ficha técnica (ou último custo).")
     tabs = st.tabs(["🧮 Simulador", "📊 Tabela de preços"])
 
-    # Carrega produtos base
-    prods = qall("select id, name, unit, category, last_cost, active from resto.product order by name;") or []
-    if not prods:
-        st.warning("Cadastre produtos em **Estoque → Cadastro** antes.")
-        return
-
-    # ==================== Aba: Simulador ====================
-    with tabs[0]:
-        card_start()
-        st.subheader("Simulador de preço por produto")
-
-        prod = st.selectbox(
-            "Produto",
-            options=[(p["id"], p["name"]) for p in prods],
-            format_func=lambda x: x[1] if isinstance(x, tuple) else x,
-            key="prec_prod"
-        )
-        if not prod:
-            card_end()
-            return
+    basis = st.radio("Base de custo dos ingredientes", options=list(COST_BASIS), horizontal=True,
+                     format_func=COST_BASIS.get, key="prec_cost_basis")
+    if basis == "avg90":
+        refresh_price_history_if_stale()
+    costs = recipe_costs(basis)
 
-        pid = int(prod[0])
-        prow = next((r for r in prods if r["id"] == pid), None) or {}
-        est = _recipe_cost(pid)
+    def _simulador(prow):
+        """Custo base, preço sugerido e margem do produto escolhido (dict do product_picker)."""
+        est = _recipe_cost(prow["id"])
 
         base_cost = None
         base_label = ""
         if est:
             base_cost = float(est["unit_cost"])
             ytxt = f"{est['yield_qty']:.3f} {est['yield_unit']}" if est.get("yield_unit") else f"{est['yield_qty']:.3f}"
-            st.caption(f"Cálculo por ficha técnica • Rendimento: {ytxt} • Custo do lote: {_money(est['batch_cost'])}")
+            st.caption(f"Cálculo por ficha técnica • Rendimento: {ytxt} • Custo do lote: {money(est['batch_cost'])}")
             base_label = "Custo unitário estimado (ficha técnica)"
         else:
             base_cost = float(prow.get("last_cost") or 0.0)
             base_label = "Custo base (last_cost do produto)"
             st.caption("Sem ficha técnica com ingredientes → usando last_cost do produto.")
 
-        st.markdown(f"**{base_label}:** {_money(base_cost)}")
+        st.markdown(f"**{base_label}:** {money(base_cost)}")
 
         c1, c2, c3, c4 = st.columns(4)
         with c1:
@@ -1688,10 +2993,20 @@ def page_receitas_precos():
         margem_bruta = (receita_liq - base_cost) / preco_sugerido * 100 if preco_sugerido else 0.0
 
         st.markdown(
-            f"**Preço sugerido:** {_money(preco_sugerido)}  \n"
-            f"**Receita líquida estimada:** {_money(receita_liq)}  \n"
+            f"**Preço sugerido:** {money(preco_sugerido)}  \n"
+            f"**Receita líquida estimada:** {money(receita_liq)}  \n"
             f"**Margem bruta sobre preço sugerido:** {margem_bruta:.2f}%"
         )
+
+    # ==================== Aba: Simulador ====================
+    with tabs[0]:
+        card_start()
+        st.subheader("Simulador de preço por produto")
+        prod_row = product_picker("Produto", key="prec_prod")
+        if prod_row:
+            _simulador(prod_row)
+        else:
+            st.info("Nenhum produto encontrado para a busca.")
         card_end()
 
     # ==================== Aba: Tabela de preços ====================
@@ -1713,46 +3028,50 @@ def page_receitas_precos():
         with f5:
             base_imp = st.number_input("Impostos %", 0.0, 50.0, 8.0, 0.1, key="prec_tab_imp", format="%.2f")
 
-        # Monta dataframe
-        rows = []
-        for p in prods:
-            if f_only_active and not p.get("active"):
-                continue
-            if f_cat.strip() and (str(p.get("category") or "") != f_cat.strip()):
-                continue
+        # as abas rodam a cada interação: a tabela (catálogo filtrado) só é montada sob pedido
+        if not st.checkbox("Montar tabela", key="prec_tab_show"):
+            st.caption("Marque **Montar tabela** para calcular os preços dos produtos filtrados.")
+        else:
+            # Monta dataframe (filtros no banco)
+            prods = qall("""
+                select id, name, unit, category, coalesce(last_cost,0)::float as last_cost
+                  from resto.product
+                 where (not %(active)s or coalesce(active, true))
+                   and (%(cat)s = '' or coalesce(category,'') = %(cat)s)
+                 order by name;
+            """, {"active": bool(f_only_active), "cat": f_cat.strip()}) or []
+            rows = []
+            for p in prods:
+                est = _recipe_cost(p["id"])
+                if est:
+                    base_cost = float(est["unit_cost"])
+                else:
+                    base_cost = float(p.get("last_cost") or 0.0)
+
+                ps = base_cost * (1 + base_markup/100.0)
+                rl = ps * (1 - base_taxa/100.0) * (1 - base_imp/100.0)
+                mg = (rl - base_cost) / ps * 100 if ps else 0.0
+
+                rows.append({
+                    "Produto": p["name"],
+                    "Categoria": p.get("category") or "",
+                    "Un": p.get("unit") or "",
+                    "Custo base": base_cost,
+                    "Preço sugerido": ps,
+                    "Margem bruta %": mg
+                })
 
-            est = _recipe_cost(p["id"])
-            if est:
-                base_cost = float(est["unit_cost"])
+            df = pd.DataFrame(rows)
+            if df.empty:
+                st.caption("Nenhum produto para os filtros.")
             else:
-                base_cost = float(p.get("last_cost") or 0.0)
-
-            ps = base_cost * (1 + base_markup/100.0)
-            rl = ps * (1 - base_taxa/100.0) * (1 - base_imp/100.0)
-            mg = (rl - base_cost) / ps * 100 if ps else 0.0
-
-            rows.append({
-                "Produto": p["name"],
-                "Categoria": p.get("category") or "",
-                "Un": p.get("unit") or "",
-                "Custo base": base_cost,
-                "Preço sugerido": ps,
-                "Margem bruta %": mg
-            })
+                # Exibição amigável
+                df_show = df.copy()
+                df_show["Custo base"] = brl.fmt(df_show["Custo base"])
+                df_show["Preço sugerido"] = brl.fmt(df_show["Preço sugerido"])
+                df_show["Margem bruta %"] = df_show["Margem bruta %"].map(lambda x: f"{x:.2f}%")
 
-        df = pd.DataFrame(rows)
-        if df.empty:
-            st.caption("Nenhum produto para os filtros.")
-            card_end()
-            return
-
-        # Exibição amigável
-        df_show = df.copy()
-        df_show["Custo base"] = df_show["Custo base"].map(_money)
-        df_show["Preço sugerido"] = df_show["Preço sugerido"].map(_money)
-        df_show["Margem bruta %"] = df_show["Margem bruta %"].map(lambda x: f"{x:.2f}%")
-
-        st.dataframe(df_show, use_container_width=True, hide_index=True)
+                st.dataframe(df_show, use_container_width=True, hide_index=True)
         card_end()
 
 # ===================== PRODUÇÃO =====================
@@ -1866,24 +3185,14 @@ def page_producao():
 
     header("🍳 Produção", "Ordem de produção: consome ingredientes (por lote) e gera produto final.")
 
-    # Produtos ativos p/ seleção
-    prods = qall("select id, name, unit, last_cost from resto.product where active is true order by name;") or []
-    if not prods:
-        st.warning("Cadastre produtos em **Estoque → Cadastro** antes.")
-        return
-    prod_opts = [(p["id"], p["name"]) for p in prods]
-
     # Seleção do produto final (compartilhada entre as abas)
-    prod = st.selectbox(
-        "Produto final *",
-        options=prod_opts,
-        key="producao_prod_sel",
-        format_func=lambda x: x[1] if isinstance(x, tuple) else x
-    )
+    prod_sel = product_picker("Produto final *", key="producao_prod_sel", only_active=True)
+    prod = (prod_sel["id"], prod_sel["name"]) if prod_sel else None
     if not prod:
+        st.info("Nenhum produto ativo encontrado — cadastre em **Estoque → Cadastro** ou refaça a busca.")
         return
     prod_id = prod[0]
-    prod_row = next((r for r in prods if r["id"] == prod_id), {"unit": "un", "last_cost": 0})
+    prod_row = prod_sel
     tabs = st.tabs(["🛠️ Nova produção", "📜 Ficha técnica (receita)"])
  
     # ==================== Aba Ficha Técnica (FORMULÁRIO ÚNICO) ====================
@@ -1898,11 +3207,6 @@ def page_producao():
         abbr_by_id = {u["id"]: u["abbr"] for u in units_rows}
         id_by_abbr = {u["abbr"]: u["id"] for u in units_rows}
 
-        # ingredientes possíveis (exceto o próprio produto final)
-        ing_all = [(p["id"], p["name"]) for p in prods if p["id"] != prod_id]
-        name_by_id = {i: n for i, n in ing_all}
-        id_by_name = {n: i for i, n in ing_all}
-
         # receita atual (se houver)
         recipe = qone("select * from resto.recipe where product_id=%s;", (prod_id,))
         init_yield = float(recipe.get("yield_qty") if recipe else 1.0)
@@ -1915,7 +3219,7 @@ def page_producao():
         ing_rows = []
         if recipe:
             ing_rows = qall("""
-                select ri.id, p.name as ingrediente, ri.qty, ri.unit_id,
+                select ri.id, ri.ingredient_id, p.name as ingrediente, ri.qty, ri.unit_id,
                        coalesce(ri.conversion_factor, 1.0) as conversion_factor
                   from resto.recipe_item ri
                   join resto.product p on p.id = ri.ingredient_id
@@ -1923,15 +3227,16 @@ def page_producao():
                  order by p.name;
             """, (recipe["id"],)) or []
 
+        # o grid só troca entre os ingredientes da própria receita; novos entram pela busca abaixo
+        id_by_name = {r["ingrediente"]: r["ingredient_id"] for r in ing_rows}
+
         def _df_base():
             if ing_rows:
                 df = pd.DataFrame(ing_rows)
                 df["Un"] = df["unit_id"].map(abbr_by_id).fillna("")
                 df["Excluir?"] = False
                 return df[["id", "ingrediente", "qty", "Un", "conversion_factor", "Excluir?"]]
-            return pd.DataFrame([{
-                "id": None, "ingrediente": "", "qty": 0.0, "Un": "", "conversion_factor": 1.0, "Excluir?": False
-            }], columns=["id","ingrediente","qty","Un","conversion_factor","Excluir?"])
+            return pd.DataFrame(columns=["id","ingrediente","qty","Un","conversion_factor","Excluir?"])
 
         df_grid = _df_base()
 
@@ -1960,11 +3265,11 @@ def page_producao():
 
             note = st.text_area("Observações (opcional)", value=(init_note or ""), height=70)
 
-            st.markdown("#### Ingredientes (adicione/edite/remova no grid)")
+            st.markdown("#### Ingredientes (edite/remova no grid)")
             cfg_ing = {
                 "id":  st.column_config.TextColumn("ID", disabled=True),
                 "ingrediente": st.column_config.SelectboxColumn(
-                    "Ingrediente", options=[n for _, n in ing_all]
+                    "Ingrediente", options=list(id_by_name)
                 ),
                 "qty": st.column_config.NumberColumn("Qtd", step=0.001, format="%.3f"),
                 "Un":  st.column_config.SelectboxColumn("Un.", options=[""] + [u["abbr"] for u in units_rows]),
@@ -1975,7 +3280,7 @@ def page_producao():
                 df_grid,
                 column_config=cfg_ing,
                 hide_index=True,
-                num_rows="dynamic",
+                num_rows="fixed",
                 use_container_width=True,
                 key=f"ft_editor_{prod_id}"
             )
@@ -2082,6 +3387,38 @@ def page_producao():
                 _rerun()
 
 
+        # ---------- incluir ingrediente (busca) ----------
+        st.markdown("#### ➕ Incluir ingrediente")
+        a1, a2, a3 = st.columns([2, 1, 1])
+        with a1:
+            ing_row = product_picker("Ingrediente", key=f"ft_new_ing_{prod_id}", only_active=True, only_ingredient=True)
+        with a2:
+            ing_qty = st.number_input("Quantidade", min_value=0.001, step=0.001, value=1.000, format="%.3f",
+                                      key=f"ft_new_qty_{prod_id}")
+        with a3:
+            ing_un = st.selectbox("Un.", options=[""] + [u["abbr"] for u in units_rows], key=f"ft_new_un_{prod_id}")
+
+        if st.button("Adicionar à ficha", key=f"ft_btn_add_{prod_id}") and ing_row:
+            if int(ing_row["id"]) == int(prod_id):
+                st.error("O produto final não pode ser ingrediente da própria ficha.")
+            else:
+                try:
+                    if not recipe:
+                        recipe = qone("""
+                            insert into resto.recipe(product_id, yield_qty) values (%s, 1)
+                            on conflict (product_id) do update set updated_at = now()
+                            returning *;
+                        """, (prod_id,))
+                    qexec("""
+                        insert into resto.recipe_item(recipe_id, ingredient_id, qty, unit_id, conversion_factor)
+                        values (%s,%s,%s,%s,1.0);
+                    """, (int(recipe["id"]), int(ing_row["id"]), float(ing_qty), id_by_abbr.get(ing_un) if ing_un else None))
+                    st.success(f"✅ {ing_row['name']} incluído na ficha.")
+                    _rerun()
+                except Exception:
+                    st.error("Falha ao incluir ingrediente.")
+
+
         # ---------- Custos detalhados por ingrediente (explicativo, com conversão de unidade) ----------
         if recipe:
             rows = qall("""
@@ -2137,10 +3474,6 @@ def page_producao():
                 subtot = []
                 calc_txt = []
 
-                def _fmt_qty(val):
-                    s = f"{float(val):,.3f}"
-                    return s.replace(",", "X").replace(".", ",").replace("X", ".")
-
                 for _, r in df_det.iterrows():
                     un_item = (r.get("Un") or "").strip()           # ex.: g, kg, ml, L, un
                     un_cost = (r.get("prod_unit") or "").strip()    # unidade-base do custo do produto (p.unit)
@@ -2152,11 +3485,11 @@ def page_producao():
                     subtot.append(subtotal)
 
                     if changed:
-                        calc = f"{_fmt_qty(qeff)} {un_item or un_cost} → {_fmt_qty(q_in_cost)} {un_cost} × {money(last_cost)} = {money(subtotal)}"
+                        calc = f"{brl.number(qeff, 3)} {un_item or un_cost} → {brl.number(q_in_cost, 3)} {un_cost} × {money(last_cost)} = {money(subtotal)}"
                     else:
                         # se não mudou, mostra direto na unidade de custo (ou na do item, se não houver)
                         base_un = un_cost or un_item
-                        calc = f"{_fmt_qty(q_in_cost)} {base_un} × {money(last_cost)} = {money(subtotal)}"
+                        calc = f"{brl.number(q_in_cost, 3)} {base_un} × {money(last_cost)} = {money(subtotal)}"
                     calc_txt.append(calc)
 
                 df_det["subtotal"] = subtot
@@ -2264,82 +3597,15 @@ def page_producao():
             card_end()
             return
 
-        # Carrega ingredientes da receita
-        ingredients = qall("""
-            select ri.ingredient_id, p.name as ingrediente, ri.qty, ri.conversion_factor, ri.unit_id
-              from resto.recipe_item ri
-              join resto.product p on p.id = ri.ingredient_id
-             where ri.recipe_id=%s
-             order by p.name;
-        """, (recipe["id"],)) or []
-
-        if not ingredients:
-            st.error("Ficha técnica sem ingredientes.")
-            card_end()
-            return
-
-        # Escala e aloca por FIFO (usa sua função fifo_allocate no app)
-        scale = float(qty_out) / yield_qty
-        consumos = []   # [{ingredient_id, ingrediente, lot_id, qty, unit_cost, total}]
-        total_ing_cost = 0.0
-        faltantes = []
-
-        for it in ingredients:
-            need = float(it["qty"] or 0.0) * float(it.get("conversion_factor") or 1.0) * scale
-            allocs = fifo_allocate(it["ingredient_id"], need)  # -> lista de {lot_id, qty, unit_cost}
-            got = sum(a["qty"] for a in allocs)
-            if got + 1e-9 < need:
-                faltantes.append((it["ingrediente"], need, got))
-            for a in allocs:
-                total = float(a["qty"]) * float(a.get("unit_cost") or 0.0)
-                consumos.append({
-                    "ingredient_id": it["ingredient_id"],
-                    "ingrediente": it["ingrediente"],
-                    "lot_id": a["lot_id"],
-                    "qty": float(a["qty"]),
-                    "unit_cost": float(a.get("unit_cost") or 0.0),
-                    "total": total
-                })
-                total_ing_cost += total
-
-        if faltantes:
-            msg = "Estoque insuficiente:\n" + "\n".join(
-                f"- {n}: precisa {q:.3f}, alocado {al:.3f}" for n, q, al in faltantes
-            )
-            st.error(msg)
+        # Aloca por FIFO, grava produção + consumos e movimenta estoque numa transação
+        try:
+            res = produce(prod_id, float(qty_out), lot_final, expiry_final)
+        except ValueError as e:
+            st.error(str(e))
             card_end()
             return
-
-        # Custo do lote
-        overhead = float(recipe.get("overhead_pct") or 0.0) / 100.0
-        loss = float(recipe.get("loss_pct") or 0.0) / 100.0
-        batch_cost = total_ing_cost * (1 + overhead) * (1 + loss)
-        unit_cost_est = batch_cost / float(qty_out)
-
-        # Persiste produção
-        prow = qone("""
-            insert into resto.production(date, product_id, qty, unit_cost, total_cost, lot_number, expiry_date, note)
-            values (now(), %s, %s, %s, %s, %s, %s, %s)
-            returning id;
-        """, (prod_id, float(qty_out), float(unit_cost_est), float(batch_cost),
-              (lot_final or None), (str(expiry_final) if expiry_final else None), ""))
-        production_id = prow["id"]
-
-        # Saída dos ingredientes (OUT) por lote + rastreabilidade
-        for c in consumos:
-            pi = qone("""
-                insert into resto.production_item(production_id, ingredient_id, lot_id, qty, unit_cost, total_cost)
-                values (%s,%s,%s,%s,%s,%s)
-                returning id;
-            """, (production_id, c["ingredient_id"], c["lot_id"], c["qty"], c["unit_cost"], c["total"]))
-            note = f"production:{production_id};lot:{c['lot_id']}"
-            qexec("select resto.sp_register_movement(%s,'OUT',%s,%s,'production',%s,%s);",
-                  (c["ingredient_id"], c["qty"], c["unit_cost"], pi["id"], note))
-
-        # Entrada do produto final (IN)
-        note_final = f"production:{production_id}" + (f";lot:{lot_final}" if lot_final else "")
-        qexec("select resto.sp_register_movement(%s,'IN',%s,%s,'production',%s,%s);",
-              (prod_id, float(qty_out), float(unit_cost_est), production_id, note_final))
+        production_id, batch_cost, unit_cost_est = res["production_id"], res["batch_cost"], res["unit_cost"]
+        consumos = res["consumos"]
 
         st.success(f"Produção #{production_id} registrada.")
         st.markdown(f"**Custo do lote:** {money(batch_cost)} • **Custo unitário aplicado (CMP):** {money(unit_cost_est)}")
@@ -2468,7 +3734,7 @@ def page_estoque():
     _ensure_inventory_schema()
 
     header("📦 Estoque", "Saldos, movimentos e lotes/validade.")
-    tabs = st.tabs(["Saldos", "Movimentos", "Lotes & Validade", "Cadastro"])
+    tabs = st.tabs(["Saldos", "Movimentos", "Lotes & Validade", "Cadastro", "Reconciliação CMP"])
 
     # ============ Aba: Saldos ============
     with tabs[0]:
@@ -2497,23 +3763,33 @@ def page_estoque():
     with tabs[2]:
         card_start()
         st.subheader("Alertas de validade e saldos por lote")
+        refresh_expiry_alerts_if_stale()
+
+        # resumo por faixa de vencimento (somente lotes com saldo)
+        buckets = qall("""
+            select bucket, count(*) as lotes, coalesce(sum(saldo),0) as saldo,
+                   coalesce(sum(value_at_risk),0) as valor_em_risco
+              from resto.v_expiry_alert
+             where saldo > 0
+             group by bucket;
+        """) or []
+        if buckets:
+            dfb = pd.DataFrame(buckets)
+            dfb["ordem"] = dfb["bucket"].map({b: i for i, b in enumerate(_EXPIRY_BUCKETS)})
+            dfb = dfb.sort_values("ordem").drop(columns=["ordem"])
+            kcols = st.columns(len(dfb))
+            for kc, (_, b) in zip(kcols, dfb.iterrows()):
+                with kc:
+                    st.metric(f"{b['bucket']} ({int(b['lotes'])})", money(float(b["valor_em_risco"])))
+
         dias = st.slider("Dias até o vencimento", 7, 120, 30, 1)
         rows = qall("""
-            with cons as (
-              select reference_id as lot_id, coalesce(sum(qty),0) as qty_out
-                from resto.inventory_movement
-               where kind='OUT' and reference_id is not null
-               group by reference_id
-            )
-            select pi.id as lot_id, p.name, pi.qty as lote, coalesce(c.qty_out,0) as consumido,
-                   greatest(pi.qty - coalesce(c.qty_out,0),0) as saldo,
-                   pi.unit_price, pi.expiry_date, (pi.expiry_date - current_date) as dias_restantes
-              from resto.purchase_item pi
-              join resto.product p on p.id = pi.product_id
-              left join cons c on c.lot_id = pi.id
-             where pi.expiry_date is not null
-               and (pi.expiry_date - current_date) <= %s
-             order by pi.expiry_date asc;
+            select lot_id, product_name as name, lot_qty as lote, consumed as consumido, saldo,
+                   unit_price, value_at_risk as valor_em_risco, expiry_date,
+                   dias as dias_restantes, bucket as faixa
+              from resto.v_expiry_alert
+             where expiry_date <= current_date + %s
+             order by expiry_date asc;
         """, (dias,))
         df = pd.DataFrame(rows or [])
         if not df.empty:
@@ -2521,6 +3797,38 @@ def page_estoque():
             st.dataframe(df, use_container_width=True, hide_index=True)
         else:
             st.caption("Nenhum lote dentro do período selecionado.")
+
+        st.markdown("##### Lotes vencidos")
+        cw1, cw2, cw3 = st.columns([1, 1, 2])
+        with cw1:
+            do_refresh = st.button("🔄 Recalcular alertas", key="exp_refresh")
+        with cw2:
+            do_writeoff = st.button("🗑️ Baixar saldo vencido", key="exp_writeoff",
+                                    help="Gera saídas (OUT) de todo o saldo dos lotes já vencidos, numa única transação.")
+        with cw3:
+            wo_note = st.text_input("Observação da baixa (opcional)", key="exp_writeoff_note")
+        wo_conf = st.checkbox("Confirmo: todo o saldo dos lotes vencidos sai do estoque (uma saída por lote).",
+                              key="exp_writeoff_conf")
+
+        if do_refresh:
+            n = refresh_expiry_alerts()
+            st.success(f"Alertas recalculados ({n} lote(s) com validade).")
+            _rerun()
+
+        if do_writeoff and not wo_conf:
+            st.warning("Marque a confirmação para baixar os vencidos.")
+        elif do_writeoff:
+            try:
+                n, val = expiry_write_off(wo_note.strip())
+            except Exception:
+                st.error("Falha ao baixar vencidos (verifique a função resto.sp_register_movement). Nada foi gravado.")
+            else:
+                if n:
+                    refresh_expiry_alerts()   # a lista acima ainda mostra os lotes recém-baixados
+                    st.success(f"{n} lote(s) vencido(s) baixado(s) • {money(val)}.")
+                    _rerun()
+                else:
+                    st.info("Nenhum lote vencido com saldo.")
         card_end()
 
     # ============ Aba: Cadastro (Insumos & Fornecedores) ============
@@ -2588,36 +3896,16 @@ def page_estoque():
                 _rerun()
 
             if apply_sup:
-                orig = df_sup.set_index("id")
-                new  = edited_sup.set_index("id")
-                upd = 0; delc = 0; err = 0
-
-                # exclusões
-                to_del = new.index[new["Excluir?"] == True].tolist()
-                for sid in to_del:
-                    try:
-                        qexec("delete from resto.supplier where id=%s;", (sid,))
-                        delc += 1
-                    except Exception:
-                        err += 1
-
-                # updates
-                keep_ids = [i for i in new.index if i not in to_del]
-                for sid in keep_ids:
-                    a = orig.loc[sid]; b = new.loc[sid]
-                    if any(str(a.get(f,"")) != str(b.get(f,"")) for f in ["name","doc","phone","email","active"]):
-                        try:
-                            qexec("""
-                                update resto.supplier
-                                   set name=%s, doc=%s, phone=%s, email=%s, active=%s
-                                 where id=%s;
-                            """, (b["name"], b.get("doc"), b.get("phone"), b.get("email"),
-                                  bool(b.get("active")), int(sid)))
-                            upd += 1
-                        except Exception:
-                            err += 1
-                st.success(f"Fornecedor: ✅ {upd} atualizado(s) • 🗑️ {delc} excluído(s) • ⚠️ {err} erro(s).")
-                _rerun()
+                def _prep_sup_est(b):
+                    if not (b.get("name") or "").strip():
+                        raise ValueError("nome obrigatório")
+                    return {"name": b["name"].strip(), "doc": _grid_py(b.get("doc")), "phone": _grid_py(b.get("phone")),
+                            "email": _grid_py(b.get("email")), "active": bool(b.get("active"))}
+
+                res = grid_apply("resto.supplier", df_sup, edited_sup, ["name","doc","phone","email","active"],
+                                 prepare=_prep_sup_est)
+                if grid_feedback(res, "Fornecedor"):
+                    _rerun()
         else:
             st.caption("Nenhum fornecedor cadastrado.")
 
@@ -2776,49 +4064,383 @@ def page_estoque():
                 st.rerun()
 
             if apply_p:
-                orig = dfp.set_index("id")
-                new  = edited_p.set_index("id")
-                upd = delc = err = 0
+                res = grid_apply("resto.product", dfp, edited_p, PRODUCT_GRID_FIELDS, prepare=_prep_product_row)
+                if grid_feedback(res, "Produtos"):
+                    st.rerun()
+        else:
+            st.caption("Nenhum produto cadastrado.")
 
-                to_del = new.index[new["Excluir?"] == True].tolist()
-                for pid in to_del:
-                    try:
-                        qexec("delete from resto.product where id=%s;", (int(pid),))
-                        delc += 1
-                    except Exception:
-                        err += 1
+    # ============ Aba: Reconciliação CMP ============
+    with tabs[4]:
+        card_start()
+        st.subheader("Replay de estoque e CMP a partir das movimentações")
+        st.caption("Recalcula saldo e custo médio de todos os produtos pelo razão (inventory_movement) "
+                   "e compara com o cadastro. Nada é gravado até você aplicar.")
+        if st.button("🔎 Recalcular agora", key="replay_run"):
+            st.session_state["replay_df"] = replay_stock_and_avg_cost()
+
+        rdf = st.session_state.get("replay_df")
+        if rdf is not None:
+            div = rdf[rdf["divergente"]]
+            m1, m2, m3 = st.columns(3)
+            m1.metric("Produtos", len(rdf))
+            m2.metric("Divergentes", len(div))
+            m3.metric("Diferença de valor", money(float(div["drift_valor"].sum())))
+            only_div = st.checkbox("Mostrar só divergentes", value=True, key="replay_only_div")
+            st.dataframe(
+                (div if only_div else rdf)[["product_id", "name", "unit", "stock_qty", "replay_qty", "drift_qty",
+                                            "avg_cost", "replay_avg", "drift_avg", "drift_valor"]],
+                use_container_width=True, hide_index=True,
+                column_config={
+                    "product_id":  st.column_config.NumberColumn("ID"),
+                    "name":        st.column_config.TextColumn("Produto"),
+                    "unit":        st.column_config.TextColumn("Un"),
+                    "stock_qty":   st.column_config.NumberColumn("Estoque (cad.)", format="%.3f"),
+                    "replay_qty":  st.column_config.NumberColumn("Estoque (razão)", format="%.3f"),
+                    "drift_qty":   st.column_config.NumberColumn("Δ qtd", format="%.3f"),
+                    "avg_cost":    st.column_config.NumberColumn("CMP (cad.)", format="%.2f"),
+                    "replay_avg":  st.column_config.NumberColumn("CMP (razão)", format="%.2f"),
+                    "drift_avg":   st.column_config.NumberColumn("Δ CMP", format="%.2f"),
+                    "drift_valor": st.column_config.NumberColumn("Δ valor", format="%.2f"),
+                },
+            )
+            confirm = st.checkbox("Confirmo a correção de estoque/CMP dos divergentes", key="replay_confirm")
+            if st.button("✅ Aplicar correções", disabled=div.empty or not confirm, key="replay_apply"):
+                try:
+                    n = apply_stock_replay(rdf)
+                    st.session_state.pop("replay_df", None)
+                    st.success(f"✅ {n} produto(s) corrigido(s).")
+                except Exception as e:
+                    st.error(f"Falha ao aplicar correções (nada foi gravado): {e}")
+        card_end()
 
-                keep_ids = [i for i in new.index if i not in to_del]
-                for pid in keep_ids:
-                    a = orig.loc[pid]; b = new.loc[pid]
-                    changed = any(str(a.get(f,"")) != str(b.get(f,"")) for f in
-                                  ["code","name","unit","category","barcode","min_stock","last_cost",
-                                   "sale_price","is_sale_item","is_ingredient","default_markup","active"])
-                    if not changed:
-                        continue
-                    try:
-                        qexec("""
-                            update resto.product
-                               set code=%s, name=%s, unit=%s, category=%s, barcode=%s,
-                                   min_stock=%s, last_cost=%s, sale_price=%s,
-                                   is_sale_item=%s, is_ingredient=%s, default_markup=%s, active=%s
-                             where id=%s;
-                        """, (b.get("code"), b.get("name"), b.get("unit"), b.get("category"), b.get("barcode"),
-                              float(b.get("min_stock") or 0), float(b.get("last_cost") or 0), float(b.get("sale_price") or 0),
-                              bool(b.get("is_sale_item")), bool(b.get("is_ingredient")), float(b.get("default_markup") or 0),
-                              bool(b.get("active")), int(pid)))
-                        upd += 1
-                    except Exception:
-                        err += 1
 
-                st.success(f"Produtos: ✅ {upd} atualizado(s) • 🗑️ {delc} excluído(s) • ⚠️ {err} erro(s).")
-                st.rerun()
+# ===================== DRE (várias competências numa passada) =====================
+# Receita (vendas FECHADAS), CMV (saídas de estoque), despesas e outras receitas (livro caixa consolidado)
+# para N períodos numa única consulta; GROUPING SETS (período, conta) + (período) já devolve o resultado.
+# Mês fechado (resto.period_close) vem congelado do fechamento; intervalos que só cobrem meses fechados
+# ficam em memória no processo, com a data de fechamento de cada mês na chave (reabrir invalida sozinho).
+DRE_ACCOUNTS = ("v", "c", "d", "o")   # receita, cmv, despesas, outras receitas
+
+_DRE_SQL = """
+    with per as (
+        select t.ini, t.fim, t.idx
+          from unnest(%(ini)s::date[], %(fim)s::date[]) with ordinality as t(ini, fim, idx)
+    ), lim as (
+        select min(ini) as lo, max(fim) + 1 as hi from per
+    ), src as (
+        select s.date::date as dt, 'v' as conta, s.total as valor, 1 as sinal
+          from resto.sale s, lim
+         where s.status = 'FECHADA' and s.date >= lim.lo and s.date < lim.hi
+      union all
+        select m.move_date::date, 'c', m.total_cost, -1
+          from resto.inventory_movement m, lim
+         where m.kind = 'OUT' and m.move_date >= lim.lo and m.move_date < lim.hi
+      union all
+        select d.day, case when d.kind = 'OUT' then 'd' else 'o' end,
+               case when d.kind = 'OUT' then -d.amount else d.amount end,
+               case when d.kind = 'OUT' then -1 else 1 end
+          from resto.cashbook_daily d, lim
+         where d.day >= lim.lo and d.day < lim.hi
+    )
+    select p.idx, s.conta, grouping(s.conta) as is_total,
+           coalesce(sum(s.valor), 0)::float as valor,
+           coalesce(sum(s.sinal * s.valor), 0)::float as liquido
+      from src s
+      join per p on s.dt between p.ini and p.fim
+     group by grouping sets ((p.idx, s.conta), (p.idx));
+"""
+
+@st.cache_resource(show_spinner=False)
+def _dre_closed_store() -> Dict[str, Any]:
+    return {"lock": threading.Lock(), "data": {}}
+
+def _dre_query(periods: List[Tuple[date, date]], cur=None) -> Dict[Tuple[date, date], Dict[str, float]]:
+    """Uma consulta para todos os períodos → {(ini, fim): {v, c, d, o, resultado}}."""
+    params = {"ini": [p[0] for p in periods], "fim": [p[1] for p in periods]}
+    if cur is None:
+        rows = qall(_DRE_SQL, params) or []
+    else:
+        cur.execute(_DRE_SQL, params)
+        rows = cur.fetchall()
+    out = {p: {**dict.fromkeys(DRE_ACCOUNTS, 0.0), "resultado": 0.0} for p in periods}
+    for r in rows:
+        vals = out[periods[int(r["idx"]) - 1]]
+        if r["is_total"]:
+            vals["resultado"] = float(r["liquido"])
         else:
-            st.caption("Nenhum produto cadastrado.")
-
-        
+            vals[r["conta"]] = float(r["valor"])
+    return out
+
+def _months_in(ini: date, fim: date) -> List[date]:
+    out, m = [], ini.replace(day=1)
+    while m <= fim:
+        out.append(m)
+        m = (m.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return out
+
+def _month_end(m: date) -> date:
+    return (m.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+
+def dre_periods(periods: List[Tuple[date, date]]) -> pd.DataFrame:
+    """DRE lado a lado: uma linha por período (ini, fim, v, c, d, o, resultado, frozen).
+       Só períodos com algum mês aberto (ou ainda não calculados) vão ao banco, todos na mesma consulta."""
+    periods = [(ini, fim) for ini, fim in periods]
+    closed = closed_periods()
+    store = _dre_closed_store()
+    vals: Dict[Tuple[date, date], Dict[str, float]] = {}
+    keys: Dict[Tuple[date, date], Any] = {}
+    for p in dict.fromkeys(periods):
+        months = _months_in(*p)
+        if not months or not all(m in closed for m in months):   # ini > fim: sem mês, vai zerado ao banco
+            continue
+        if p == (months[0], _month_end(months[0])):   # mês cheio fechado: totais congelados
+            vals[p] = {k: closed[months[0]][k] for k in (*DRE_ACCOUNTS, "resultado")}
+        else:
+            keys[p] = (p, tuple(closed[m]["closed_at"] for m in months))
+    with store["lock"]:
+        vals.update({p: store["data"][k] for p, k in keys.items() if k in store["data"]})
+    missing = [p for p in dict.fromkeys(periods) if p not in vals]
+    fresh = _dre_query(missing) if missing else {}
+    with store["lock"]:
+        store["data"].update({keys[p]: v for p, v in fresh.items() if p in keys})
+    out = [{"ini": p[0], "fim": p[1], **(vals.get(p) or fresh[p]), "frozen": p in vals or p in keys}
+           for p in periods]
+    return pd.DataFrame(out, columns=["ini", "fim", *DRE_ACCOUNTS, "resultado", "frozen"])
+
+def _month_periods(n: int, ref: Optional[date] = None) -> List[Tuple[date, date]]:
+    """Últimos n meses civis até o mês de `ref` (inclusive), do mais antigo ao mais recente."""
+    first = (ref or date.today()).replace(day=1)
+    out = []
+    for _ in range(n):
+        out.append((first, _month_end(first)))
+        first = (first - timedelta(days=1)).replace(day=1)
+    return out[::-1]
+
+# ===================== Fechamento de competência =====================
+# Fechar um mês grava os totais finais (linhas da DRE, valor do estoque, totais por categoria/método) e
+# passa a recusar insert/update/delete em cashbook, inventory_movement, payroll_week e sale datados naquele mês.
+# Relatórios leem os totais congelados dos meses fechados e só calculam ao vivo o que está aberto.
+PERIOD_GUARDED = {"cashbook": "entry_date", "inventory_movement": "move_date", "payroll_week": "ref_date",
+                  "sale": "date"}
+
+@st.cache_resource(show_spinner=False)
+def _ensure_period_close_schema():
+    qexec("""
+    do $$
+    begin
+      create table if not exists resto.period_close (
+        month        date primary key check (month = date_trunc('month', month)::date),
+        closed_at    timestamptz not null default now(),
+        note         text,
+        revenue      numeric(14,2) not null default 0,
+        cmv          numeric(14,2) not null default 0,
+        expenses     numeric(14,2) not null default 0,
+        other_income numeric(14,2) not null default 0,
+        result       numeric(14,2) not null default 0,
+        stock_value  numeric(14,2) not null default 0
+      );
+      create table if not exists resto.period_close_category (
+        month        date    not null references resto.period_close(month) on delete cascade,
+        kind         text    not null,
+        category_id  bigint  not null default 0,
+        method       text    not null default '',
+        amount       numeric not null default 0,
+        n            integer not null default 0,
+        primary key (month, kind, category_id, method)
+      );
+    end $$;
+    """)
+    qexec("""
+    create or replace function resto.fn_period_guard() returns trigger language plpgsql as $$
+    declare d date;
+    begin
+      if TG_OP in ('UPDATE', 'DELETE') then
+        d := left(to_jsonb(old) ->> TG_ARGV[0], 10)::date;
+        if exists (select 1 from resto.period_close where month = date_trunc('month', d)::date) then
+          raise exception 'Competência %/% está fechada: % não pode ser alterado(a).',
+                extract(month from d), extract(year from d), TG_TABLE_NAME;
+        end if;
+      end if;
+      if TG_OP in ('INSERT', 'UPDATE') then
+        d := left(to_jsonb(new) ->> TG_ARGV[0], 10)::date;
+        if exists (select 1 from resto.period_close where month = date_trunc('month', d)::date) then
+          raise exception 'Competência %/% está fechada: não é possível lançar em %.',
+                extract(month from d), extract(year from d), TG_TABLE_NAME;
+        end if;
+      end if;
+      return coalesce(new, old);
+    end $$;
+    """)
+    for t in PERIOD_GUARDED:
+        install_period_guard(t)
+    # meses fechados com valores congelados; os abertos vêm do consolidado diário
+    qexec("""
+    create or replace view resto.v_cashbook_monthly as
+    select month, kind, category_id, method, amount, n, true as frozen
+      from resto.period_close_category
+    union all
+    select date_trunc('month', d.day)::date, d.kind, d.category_id, d.method, sum(d.amount), sum(d.n)::int, false
+      from resto.cashbook_daily d
+     where not exists (select 1 from resto.period_close pc where pc.month = date_trunc('month', d.day)::date)
+     group by 1, 2, 3, 4;
+    """)
 
+def install_period_guard(table: str) -> None:
+    """Trigger de competência fechada em resto.<table> (se a tabela já existir). Tabelas criadas depois,
+       na própria página (ex.: payroll_week), chamam de novo ao garantir o schema."""
+    col = PERIOD_GUARDED[table]
+    qexec(f"""
+    do $$ begin
+      if to_regclass('resto.{table}') is not null
+         and to_regprocedure('resto.fn_period_guard()') is not null and not exists (
+           select 1 from pg_trigger where tgname = 'trg_{table}_period_guard' and tgrelid = 'resto.{table}'::regclass) then
+        create trigger trg_{table}_period_guard
+          before insert or update or delete on resto.{table}
+          for each row execute function resto.fn_period_guard('{col}');
+      end if;
+    end $$;
+    """)
 
+@invalidated_by("period_close")
+@st.cache_data(ttl=3600, show_spinner=False)
+def closed_periods() -> Dict[date, Dict[str, Any]]:
+    """{mês: totais congelados} de todas as competências fechadas (v, c, d, o, resultado, stock_value, closed_at)."""
+    rows = qall("""
+        select month, closed_at, note, revenue::float as v, cmv::float as c, expenses::float as d,
+               other_income::float as o, result::float as resultado, stock_value::float as stock_value
+          from resto.period_close;
+    """) or []
+    return {r["month"]: r for r in rows}
+
+def close_period(month: date, note: str = "") -> Dict[str, Any]:
+    """Fecha a competência de `month`: calcula e grava os totais e, a partir daí, o mês fica imutável."""
+    month = month.replace(day=1)
+    fim = _month_end(month)
+    if fim >= date.today():
+        raise ValueError("Só é possível fechar meses já encerrados.")
+    with qtx() as cur:
+        # trava escrita no razão/estoque/vendas enquanto soma: nada entra no mês entre o cálculo e o fechamento
+        cur.execute("lock table resto.cashbook, resto.inventory_movement, resto.sale in share mode;")
+        cur.execute("select 1 from resto.period_close where month = %s;", (month,))
+        if cur.fetchone():
+            raise ValueError(f"Competência {month:%m/%Y} já está fechada.")
+        dre = _dre_query([(month, fim)], cur)[(month, fim)]
+        cur.execute("""
+            select coalesce(sum(case kind when 'IN' then total_cost when 'OUT' then -total_cost else 0 end), 0) as val
+              from resto.inventory_movement
+             where move_date < %s;
+        """, (fim + timedelta(days=1),))
+        stock_value = float(cur.fetchone()["val"] or 0)
+        cur.execute("""
+            insert into resto.period_close(month, note, revenue, cmv, expenses, other_income, result, stock_value)
+            values (%s, %s, %s, %s, %s, %s, %s, %s);
+        """, (month, note or None, dre["v"], dre["c"], dre["d"], dre["o"], dre["resultado"], stock_value))
+        cur.execute("""
+            insert into resto.period_close_category(month, kind, category_id, method, amount, n)
+            select %s, kind, category_id, method, sum(amount), sum(n)
+              from resto.cashbook_daily
+             where day between %s and %s
+             group by kind, category_id, method;
+        """, (month, month, fim))
+    closed_periods.clear()
+    return {**dre, "stock_value": stock_value}
+
+def reopen_period(month: date) -> bool:
+    """Reabre a competência (apaga os totais congelados). Retorna False se ela não estava fechada."""
+    n = qexec("delete from resto.period_close where month = %s;", (month.replace(day=1),))
+    closed_periods.clear()
+    return n > 0
+
+
+# ===================== Livro caixa (grade paginada) =====================
+CASHBOOK_PAGE_SIZE = 100
+# rótulo → expressão de ordenação (sem nulos: entra na chave do cursor junto com o id)
+CASHBOOK_SORTS = {
+    "Data":      "coalesce(cb.entry_date, date '1900-01-01')",
+    "Valor":     "coalesce(cb.amount, 0)",
+    "Descrição": "coalesce(cb.description, '')",
+    "Categoria": "coalesce(c.name, '')",
+    "Método":    "coalesce(cb.method, '')",
+}
+
+def _cashbook_filters(dt_ini=None, dt_fim=None, kind: Optional[str] = None, category_id: Optional[int] = None,
+                      method: Optional[str] = None, text: str = "") -> Tuple[List[str], List[Any]]:
+    where, params = [], []
+    if dt_ini and dt_fim:
+        where.append("cb.entry_date between %s and %s")
+        params += [dt_ini, dt_fim]
+    if kind:
+        where.append("cb.kind = %s")
+        params.append(kind)
+    if category_id:
+        where.append("cb.category_id = %s")
+        params.append(int(category_id))
+    if method:
+        where.append("cb.method = %s")
+        params.append(method)
+    if (text or "").strip():
+        where.append("cb.description ilike %s")
+        params.append(f"%{text.strip()}%")
+    return where, params
+
+def cashbook_summary(**filters) -> Dict[str, Any]:
+    """Nº de lançamentos e variação (entradas − saídas, pelo tipo) de tudo que passa nos filtros."""
+    where, params = _cashbook_filters(**filters)
+    r = qone(f"""
+        select count(*) as n,
+               coalesce(sum(case when cb.kind = 'IN' then abs(cb.amount) else -abs(cb.amount) end), 0)::float as signed
+          from resto.cashbook cb
+         {('where ' + ' and '.join(where)) if where else ''};
+    """, tuple(params)) or {}
+    return {"n": int(r.get("n") or 0), "signed": float(r.get("signed") or 0)}
+
+def cashbook_page(cursor: Optional[Tuple[Any, int]] = None, sort: str = "Data", descending: bool = True,
+                  page_size: int = CASHBOOK_PAGE_SIZE, **filters) -> Tuple[List[Dict[str, Any]], bool]:
+    """Uma página do livro caixa ordenada por CASHBOOK_SORTS[sort] + id, a partir do cursor (sort_key, id)
+       da última linha da página anterior. Retorna (linhas, tem_mais)."""
+    expr = CASHBOOK_SORTS.get(sort, CASHBOOK_SORTS["Data"])
+    where, params = _cashbook_filters(**filters)
+    if cursor:
+        where.append(f"({expr}, cb.id) {'<' if descending else '>'} (%s, %s)")
+        params += [cursor[0], int(cursor[1])]
+    direction = "desc" if descending else "asc"
+    rows = qall(f"""
+        select cb.id, cb.entry_date, cb.kind, cb.category_id,
+               case when c.id is not null then c.name || ' (' || c.kind || ')' else '' end as categoria,
+               cb.method, cb.description, cb.amount, {expr} as sort_key
+          from resto.cashbook cb
+          left join resto.cash_category c on c.id = cb.category_id
+         {('where ' + ' and '.join(where)) if where else ''}
+         order by {expr} {direction}, cb.id {direction}
+         limit %s;
+    """, tuple(params + [int(page_size) + 1])) or []
+    return rows[:page_size], len(rows) > page_size
+
+def cashbook_bulk_update(ids: Optional[List[int]] = None, filters: Optional[Dict[str, Any]] = None, *,
+                         category_id: Optional[int] = None, method: Optional[str] = None) -> int:
+    """Recategoriza e/ou troca o método num único UPDATE: nos ids informados ou em tudo que passa nos filtros.
+       Na recategorização, só linhas do mesmo tipo (IN/OUT) da categoria nova são alteradas."""
+    sets, sparams = [], []
+    if category_id:
+        sets.append("category_id = %s")
+        sparams.append(int(category_id))
+    if method:
+        sets.append("method = %s")
+        sparams.append(method)
+    if not sets:
+        return 0
+    if ids is not None:
+        where, params = ["cb.id = any(%s)"], [[int(i) for i in ids]]
+    else:
+        where, params = _cashbook_filters(**(filters or {}))
+    if category_id:
+        where.append("cb.kind = (select kind from resto.cash_category where id = %s)")
+        params.append(int(category_id))
+    return qexec(f"""
+        update resto.cashbook cb set {', '.join(sets)}
+         where {' and '.join(where) if where else 'true'};
+    """, tuple(sparams + params))
 
 
 # ===================== FINANCEIRO =====================
@@ -2882,14 +4504,14 @@ def page_financeiro():
     header("💰 Financeiro", "Entradas, Saídas e DRE.")
     # ADIÇÃO: mantive as 6 abas existentes e acrescentei a nova '🧾 A Pagar' no final
     tabs = st.tabs([
-        "💸 Entradas", "💳 Saídas", "📈 DRE", "⚙️ Gestão", "📊 Painel", "📆 Comparativo", "🧾 A Pagar"
+        "💸 Entradas", "💳 Saídas", "📈 DRE", "⚙️ Gestão", "📊 Painel", "📆 Comparativo", "🧾 A Pagar", "🔒 Fechamento"
     ])
 
     METHODS = ['— todas —', 'dinheiro', 'pix', 'cartão débito', 'cartão crédito', 'boleto', 'transferência', 'outro']
 
     # ---------- helpers ----------
     def _cat_options(kind_code: str):
-        rows = qall("select id, name, kind from resto.cash_category where kind=%s order by name;", (kind_code,))
+        rows = cash_categories(kind_code)
         return [(0, "— todas —")] + [(r["id"], r["name"]) for r in rows or []], {r["id"]: r["name"] for r in (rows or [])}
 
     def _filters_ui(prefix: str, kind_code: str):
@@ -2970,71 +4592,16 @@ def page_financeiro():
             dre_ini = st.date_input("De", value=date.today().replace(day=1), key="dre_dtini")
         with d2:
             dre_fim = st.date_input("Até", value=date.today(), key="dre_dtfim")
+        if dre_ini > dre_fim:
+            st.warning("A data inicial é maior que a final — o período fica vazio.")
 
-        # Calcula DRE (tenta completo; se não, fallback p/ livro-caixa)
-        v = c = d = o = 0.0  # receita, cmv, despesas, outras receitas
+        # Vendas + CMV + livro-caixa numa consulta (ver dre_periods)
         detalhamento = "Completo (vendas + CMV + livro-caixa)"
-        try:
-            dt_end_next = dre_fim + timedelta(days=1)
-            dre = qone("""
-                with
-                vendas as (
-                    select coalesce(sum(total),0) v
-                      from resto.sale
-                     where status='FECHADA'
-                       and date >= %s
-                       and date <  %s
-                ),
-                cmv as (
-                    select coalesce(sum(case when kind='OUT' then total_cost else 0 end),0) c
-                      from resto.inventory_movement
-                     where move_date >= %s
-                       and move_date <  %s
-                ),
-                caixa_desp as (
-                    select coalesce(sum(case when kind='OUT' then -amount else 0 end),0) d
-                      from resto.cashbook
-                     where entry_date >= %s
-                       and entry_date <  %s
-                ),
-
-                caixa_outros as (
-                    select coalesce(sum(case when kind='IN' then amount else 0 end),0) o
-                      from resto.cashbook
-                     where entry_date >= %s
-                       and entry_date <  %s
-                )
-                select v, c, d, o, (v + o - c - d) as resultado
-                  from vendas, cmv, caixa_desp, caixa_outros;
-            """, (dre_ini, dt_end_next, dre_ini, dt_end_next, dre_ini, dt_end_next, dre_ini, dt_end_next))
-            if dre:
-                v = float(dre["v"] or 0)
-                c = float(dre["c"] or 0)
-                d = float(dre["d"] or 0)
-                o = float(dre["o"] or 0)
-            else:
-                raise RuntimeError("sem dados")
-        except Exception:
-            # fallback simplificado (apenas livro-caixa)
-            detalhamento = "Simplificado (somente livro-caixa)"
-            v = float(qone("""
-                select coalesce(sum(amount),0) s
-                  from resto.cashbook
-                 where kind='IN' and entry_date between %s and %s
-            """, (dre_ini, dre_fim))["s"] or 0)
-            
-            # aqui a mágica: transforma as saídas negativas em despesa positiva
-            d = float(qone("""
-                select coalesce(sum(-amount),0) s
-                  from resto.cashbook
-                 where kind='OUT' and entry_date between %s and %s
-            """, (dre_ini, dre_fim))["s"] or 0)
-            
-            c = 0.0
-            o = 0.0
-
-
-        resultado = v + o - c - d
+        dre = dre_periods([(dre_ini, dre_fim)]).iloc[0]
+        v, c, d, o = (float(dre[k]) for k in DRE_ACCOUNTS)
+        resultado = float(dre["resultado"])
+        if dre["frozen"]:
+            detalhamento = "🔒 Competência(s) fechada(s) — totais congelados"
 
         # Métricas no topo
         k1, k2, k3, k4 = st.columns(4)
@@ -3076,6 +4643,22 @@ def page_financeiro():
         csv = df_dre.to_csv(index=False).encode("utf-8")
         st.download_button("⬇️ Exportar CSV (DRE)", data=csv, file_name="dre_periodo.csv", mime="text/csv")
 
+        st.divider()
+        if st.checkbox("📅 Mostrar DRE mês a mês (últimos 12 meses)", key="dre_mensal"):
+            dm = dre_periods(_month_periods(12, dre_fim))
+            dm["mes"] = dm["ini"].map(lambda x: x.strftime("%Y-%m"))
+            dm[["c", "d"]] = -dm[["c", "d"]]   # contas que subtraem aparecem negativas, como no grid acima
+            grid_m = dm.set_index("mes")[[*DRE_ACCOUNTS, "resultado"]].T
+            grid_m["Total"] = grid_m.sum(axis=1)
+            grid_m.index = ["Receita de Vendas", "(-) CMV", "(-) Despesas (Livro-Caixa)",
+                            "(+) Outras Receitas (Livro-Caixa)", "Resultado do Período"]
+            st.dataframe(grid_m, use_container_width=True,
+                         column_config={c: st.column_config.NumberColumn(c, format="%.2f") for c in grid_m.columns})
+            st.caption(f"{int(dm['frozen'].sum())} de {len(dm)} mês(es) fechado(s) (totais congelados); "
+                       "os demais calculados agora.")
+            st.download_button("⬇️ Exportar CSV (DRE mensal)", data=grid_m.to_csv().encode("utf-8"),
+                               file_name="dre_mensal.csv", mime="text/csv")
+
         card_end()
 
 
@@ -3102,7 +4685,7 @@ def page_financeiro():
         else:
             kind_filter = None
 
-        cats_all = qall("select id, name, kind from resto.cash_category order by name;") or []
+        cats_all = cash_categories()
         cat_labels = ["— todas —"] + [f"{c['name']} ({c['kind']})" for c in cats_all]
         cat_label_to_id = {"— todas —": 0}
         for c in cats_all:
@@ -3114,41 +4697,53 @@ def page_financeiro():
         with colf4:
             g_method = st.selectbox("Método", METHODS, key="gest_method")
         with colf5:
-            g_limit = st.number_input("Limite", 100, 5000, 1000, 100, key="gest_limit")
+            g_sort = st.selectbox("Ordenar por", list(CASHBOOK_SORTS), key="gest_sort")
+            g_desc_order = st.checkbox("Decrescente", value=True, key="gest_sort_desc")
 
         g_desc = st.text_input("Buscar texto na descrição", key="gest_desc")
 
-        wh = ["entry_date >= %s", "entry_date <= %s"]
-        pr = [g_dtini, g_dtfim]
-        if kind_filter:
-            wh.append("kind = %s"); pr.append(kind_filter)
-        if g_cat_label and cat_label_to_id[g_cat_label] != 0:
-            wh.append("category_id = %s"); pr.append(cat_label_to_id[g_cat_label])
-        if g_method and g_method != '— todas —':
-            wh.append("method = %s"); pr.append(g_method)
-        if g_desc and g_desc.strip():
-            wh.append("description ILIKE %s"); pr.append(f"%{g_desc.strip()}%")
-
-        sqlg = f"""
-            select id, entry_date, kind, category_id, description, amount, method
-              from resto.cashbook
-             where {' and '.join(wh)}
-             order by entry_date desc, id desc
-             limit %s;
-        """
-        prg = tuple(pr + [int(g_limit)])
-        rows_g = qall(sqlg, prg) or []
+        g_filters = dict(
+            dt_ini=g_dtini, dt_fim=g_dtfim, kind=kind_filter,
+            category_id=cat_label_to_id.get(g_cat_label) or None,
+            method=g_method if g_method and g_method != '— todas —' else None,
+            text=g_desc,
+        )
+
+        # paginação por cursor (keyset) no servidor; volta ao início quando filtros/ordem mudam
+        sig = repr((sorted(g_filters.items()), g_sort, g_desc_order))
+        if st.session_state.get("gest_sig") != sig:
+            st.session_state["gest_sig"] = sig
+            st.session_state["gest_cursors"] = [None]
+            st.session_state["gest_summary"] = cashbook_summary(**g_filters)
+        cursors = st.session_state["gest_cursors"]
+        summary = st.session_state["gest_summary"]
+        rows_g, has_more = cashbook_page(cursors[-1], g_sort, g_desc_order, **g_filters)
         df_g = pd.DataFrame(rows_g)
 
-        st.subheader("Grid editável")
+        page_no = len(cursors)
+        n_pages = max(1, -(-summary["n"] // CASHBOOK_PAGE_SIZE))
+        st.subheader(f"Grid editável — {summary['n']} lançamento(s)")
+        pg1, pg2, pg3 = st.columns([1, 2, 1])
+        with pg1:
+            if st.button("◀ Anterior", disabled=page_no == 1, key="gest_prev"):
+                cursors.pop()
+                st.rerun()
+        with pg2:
+            st.caption(f"Página {page_no} de {n_pages} • {CASHBOOK_PAGE_SIZE} por página")
+        with pg3:
+            if st.button("Próxima ▶", disabled=not has_more, key="gest_next"):
+                cursors.append((rows_g[-1]["sort_key"], rows_g[-1]["id"]))
+                st.rerun()
+
         if not df_g.empty:
             id_to_label = {c["id"]: f"{c['name']} ({c['kind']})" for c in cats_all}
             label_to_id = {v: k for k, v in id_to_label.items()}
 
-            df_g["categoria"] = df_g["category_id"].map(id_to_label).fillna("")
+            df_g["Selecionar"] = False
             df_g["Excluir?"] = False
 
             colcfg = {
+                "Selecionar": st.column_config.CheckboxColumn("☑", help="Seleciona para as ações em lote abaixo"),
                 "id": st.column_config.NumberColumn("ID", disabled=True),
                 "entry_date": st.column_config.DateColumn("Data"),
                 "kind": st.column_config.SelectboxColumn("Tipo", options=["IN", "OUT"]),
@@ -3160,32 +4755,21 @@ def page_financeiro():
             }
 
             edited = st.data_editor(
-                df_g[["id","entry_date","kind","categoria","method","description","amount","Excluir?"]],
+                df_g[["Selecionar","id","entry_date","kind","categoria","method","description","amount","Excluir?"]],
                 column_config=colcfg,
                 num_rows="fixed",
                 hide_index=True,
-                key="gest_editor",
+                key=f"gest_editor_{page_no}",
                 use_container_width=True
             )
 
-            # === NOVO BLOCO: conferência de saldo com o banco ===
-            # Usa exatamente os lançamentos filtrados acima (período, categoria, método, etc.)
-            df_calc = df_g.copy()
-            df_calc["amount"] = pd.to_numeric(df_calc["amount"], errors="coerce").fillna(0.0)
-            df_calc["kind"] = df_calc["kind"].astype(str).str.upper()
-            
-            # garante sinal correto independentemente de como veio do banco
-            df_calc["signed"] = df_calc.apply(
-                lambda r: abs(r["amount"]) if r["kind"] == "IN" else -abs(r["amount"]),
-                axis=1
-            )
-            
-            # variação dos lançamentos filtrados
-            variacao_periodo = float(df_calc["signed"].sum() or 0.0)
-            
+            # === conferência de saldo com o banco ===
+            # Usa todos os lançamentos filtrados (não só a página), somados no banco
+            variacao_periodo = summary["signed"]
+
             st.markdown("#### Conferência de saldo com o banco (usando os filtros acima)")
             st.caption("Informe o saldo inicial do período para bater com o saldo final do banco.")
-            
+
             c_s0, c_s1, c_s2, c_s3 = st.columns(4)
             with c_s0:
                 saldo_inicial = st.number_input(
@@ -3211,7 +4795,6 @@ def page_financeiro():
                 st.metric("Diferença (Banco - Sistema)", money(diff))
 
             st.divider()
-            # === FIM DO BLOCO NOVO ===
 
             colb1, colb2 = st.columns(2)
             with colb1:
@@ -3220,49 +4803,60 @@ def page_financeiro():
                 refresh = st.button("🔄 Atualizar", key="gest_refresh")
 
             if refresh:
-                _rerun()
+                st.session_state.pop("gest_sig", None)   # reconta e volta à 1ª página
+                st.rerun()
 
             if aplicar:
-                orig = df_g.set_index("id")
-                new = edited.set_index("id")
-
-                upd, del_ids, err = 0, 0, 0
-
-                # exclusões
-                to_delete = new.index[new["Excluir?"] == True].tolist()
-                for _id in to_delete:
-                    try:
-                        qexec("delete from resto.cashbook where id=%s;", (_id,))
-                        del_ids += 1
-                    except Exception:
-                        err += 1
-
-                # updates (somente linhas não marcadas para excluir)
-                keep_ids = [i for i in new.index if i not in to_delete]
-                for _id in keep_ids:
-                    a = orig.loc[_id]; b = new.loc[_id]
-
-                    changed = any(str(a.get(f, "")) != str(b.get(f, "")) for f in
-                                  ["entry_date","kind","categoria","method","description","amount"])
-                    if not changed:
-                        continue
-
-                    new_cat_id = label_to_id.get(b["categoria"]) or int(a["category_id"])
-                    new_kind = b["kind"] if b["kind"] in ("IN","OUT") else a["kind"]
+                cat_by_id = df_g.set_index("id")["category_id"]
+                kind_by_id = df_g.set_index("id")["kind"]
+
+                def _prep_cash(b):
+                    new_cat_id = label_to_id.get(b["categoria"]) or int(cat_by_id[b.name])
+                    new_kind = b["kind"] if b["kind"] in ("IN","OUT") else kind_by_id[b.name]
+                    return {"entry_date": _grid_py(b["entry_date"]), "kind": new_kind, "category_id": int(new_cat_id),
+                            "description": (_grid_py(b["description"]) or "")[:300],
+                            "amount": float(b["amount"]), "method": _grid_py(b["method"])}
+
+                res = grid_apply("resto.cashbook", df_g, edited,
+                                 ["entry_date","kind","categoria","method","description","amount"], prepare=_prep_cash)
+                if grid_feedback(res):
+                    st.session_state.pop("gest_sig", None)
+                    st.rerun()
 
+            # === ações em lote (um único UPDATE no banco) ===
+            st.markdown("#### Ações em lote")
+            sel_ids = edited.loc[edited["Selecionar"].fillna(False).astype(bool), "id"].astype(int).tolist()
+            escopo = st.radio("Aplicar em", [f"Selecionados nesta página ({len(sel_ids)})",
+                                             f"Todos os filtrados ({summary['n']})"],
+                              horizontal=True, key="gest_bulk_scope")
+            bl1, bl2, bl3 = st.columns([2, 1, 1])
+            with bl1:
+                bulk_cat = st.selectbox("Nova categoria", ["— manter —"] + list(label_to_id.keys()), key="gest_bulk_cat")
+            with bl2:
+                bulk_method = st.selectbox("Novo método", ["— manter —"] + METHODS[1:], key="gest_bulk_method")
+            with bl3:
+                st.write("")
+                do_bulk = st.button("⚡ Aplicar em lote", key="gest_bulk_apply")
+            if do_bulk:
+                todos = escopo.startswith("Todos")
+                new_cat = label_to_id.get(bulk_cat)
+                new_method = None if bulk_method == "— manter —" else bulk_method
+                if not new_cat and not new_method:
+                    st.warning("Escolha uma nova categoria e/ou um novo método.")
+                elif not todos and not sel_ids:
+                    st.warning("Marque ao menos um lançamento na coluna ☑.")
+                else:
                     try:
-                        qexec("""
-                            update resto.cashbook
-                               set entry_date=%s, kind=%s, category_id=%s, description=%s, amount=%s, method=%s
-                             where id=%s;
-                        """, (b["entry_date"], new_kind, int(new_cat_id),
-                              (b["description"] or "")[:300], float(b["amount"]), b["method"], int(_id)))
-                        upd += 1
-                    except Exception:
-                        err += 1
-
-                st.success(f"✅ {upd} atualizado(s) • 🗑️ {del_ids} excluído(s) • ⚠️ {err} com erro.")
-                _rerun()
+                        n = cashbook_bulk_update(None if todos else sel_ids, g_filters if todos else None,
+                                                 category_id=new_cat, method=new_method)
+                    except Exception as e:
+                        st.error(f"Falha na atualização em lote (nada foi gravado): {e}")
+                    else:
+                        alvo = summary["n"] if todos else len(sel_ids)
+                        st.success(f"✅ {n} lançamento(s) atualizado(s)"
+                                   + (f" • {alvo - n} ignorado(s) (tipo diferente da categoria)" if n < alvo else ""))
+                        st.session_state.pop("gest_sig", None)
+                        st.rerun()
         else:
             st.caption("Sem lançamentos para os filtros.")
 
@@ -3280,7 +4874,7 @@ def page_financeiro():
         with colp2:
             p_dtfim = st.date_input("Até", value=date.today(), key="painel_dtfim")
 
-        cats_all = qall("select id, name from resto.cash_category order by name;") or []
+        cats_all = cash_categories()
         cat_opts = [(c["id"], c["name"]) for c in cats_all]
         p_cats = st.multiselect(
             "Categorias (opcional)",
@@ -3290,7 +4884,7 @@ def page_financeiro():
         )
         sel_ids = [c[0] for c in p_cats] if p_cats else []
 
-        wh = ["cb.entry_date >= %s", "cb.entry_date <= %s"]
+        wh = ["cb.day >= %s", "cb.day <= %s"]
         pr = [p_dtini, p_dtfim]
         if sel_ids:
             wh.append("cb.category_id = ANY(%s)")
@@ -3301,7 +4895,7 @@ def page_financeiro():
                 coalesce(c.name, '(sem categoria)') as categoria,
                 sum(case when cb.kind='IN'  then cb.amount else 0 end)  as entradas_raw,
                 sum(case when cb.kind='OUT' then cb.amount else 0 end)  as saidas_raw
-            from resto.cashbook cb
+            from resto.cashbook_daily cb
             left join resto.cash_category c on c.id = cb.category_id
             where {' and '.join(wh)}
             group by categoria
@@ -3345,7 +4939,7 @@ def page_financeiro():
         with colc2:
             method = st.selectbox("Método", METHODS, key="cmp_method")
         with colc3:
-            cats_all = qall("select id, name from resto.cash_category order by name;") or []
+            cats_all = cash_categories()
             cat_opts = [(c["id"], c["name"]) for c in cats_all]
             cmp_cats = st.multiselect("Categorias (opcional)", options=cat_opts, format_func=lambda x: x[1], key="cmp_cats")
             cat_ids = [c[0] for c in cmp_cats] if cmp_cats else []
@@ -3371,12 +4965,12 @@ def page_financeiro():
                     )::date as m
                 ),
                 agg as (
-                    select date_trunc('month', cb.entry_date)::date as m,
+                    select cb.month as m,
                            sum(case when cb.kind='IN'  then cb.amount else 0 end)  as vin,
                            sum(case when cb.kind='OUT' then cb.amount else 0 end)  as vout
-                      from resto.cashbook cb
-                     where cb.entry_date >= (select min(m) from series)
-                       and cb.entry_date <  (date_trunc('month', current_date) + interval '1 month')
+                      from resto.v_cashbook_monthly cb
+                     where cb.month >= (select min(m) from series)
+                       and cb.month <  (date_trunc('month', current_date) + interval '1 month')
                        {(' and ' + ' and '.join(wh_extra)) if wh_extra else ''}
                   group by 1
                 )
@@ -3430,12 +5024,12 @@ def page_financeiro():
                     )::date as y
                 ),
                 agg as (
-                    select date_trunc('year', cb.entry_date)::date as y,
+                    select date_trunc('year', cb.month)::date as y,
                            sum(case when cb.kind='IN'  then cb.amount else 0 end)  as vin,
                            sum(case when cb.kind='OUT' then cb.amount else 0 end)  as vout
-                      from resto.cashbook cb
-                     where cb.entry_date >= (date_trunc('year', current_date) - interval '4 years')
-                       and cb.entry_date <  (date_trunc('year', current_date) + interval '1 year')
+                      from resto.v_cashbook_monthly cb
+                     where cb.month >= (date_trunc('year', current_date) - interval '4 years')
+                       and cb.month <  (date_trunc('year', current_date) + interval '1 year')
                        {(' and ' + ' and '.join(wh_extra)) if wh_extra else ''}
                   group by 1
                 )
@@ -3585,7 +5179,7 @@ def page_financeiro():
             # categoria padrão Compras/Estoque
             cat_out_default = _ensure_cash_category('OUT', 'Compras/Estoque')
             # permitir trocar (se quiser usar outra)
-            cats_out = qall("select id, name from resto.cash_category where kind='OUT' order by name;") or []
+            cats_out = cash_categories("OUT")
             # manter default como primeira opção visível
             cats_ordered = sorted(cats_out, key=lambda r: (0 if r["id"] == cat_out_default else 1, r["name"]))
             cat_sel = st.selectbox("Categoria (saída)", options=[(r["id"], r["name"]) for r in cats_ordered],
@@ -3601,23 +5195,10 @@ def page_financeiro():
 
         # ações
         if do_save:
-            orig = df_open.set_index("id")
-            new  = edited_open.set_index("id")
-            upd = 0; err = 0
-            for pid in new.index.tolist():
-                a = orig.loc[pid]; b = new.loc[pid]
-                if any(str(a.get(f,"")) != str(b.get(f,"")) for f in ["due_date","amount","note"]):
-                    try:
-                        qexec("""
-                            update resto.payable
-                               set due_date=%s, amount=%s, note=%s
-                             where id=%s and status='ABERTO';
-                        """, (b["due_date"], float(b["amount"]), (b.get("note") or None), int(pid)))
-                        upd += 1
-                    except Exception:
-                        err += 1
-            st.success(f"✅ {upd} título(s) atualizado(s) • ⚠️ {err} erro(s)")
-            _rerun()
+            res = grid_apply("resto.payable", df_open, edited_open, ["due_date","amount","note"],
+                             prepare=_prep_payable_row, delete_col=None, update_where="and status='ABERTO'")
+            if grid_feedback(res, "Títulos"):
+                _rerun()
 
         if do_del:
             new = edited_open.set_index("id")
@@ -3666,152 +5247,137 @@ def page_financeiro():
 
         card_end()
 
+    # ---------- Aba: 🔒 Fechamento de competência ----------
+    with tabs[7]:
+        card_start()
+        st.subheader("🔒 Fechamento de competência")
+        st.caption("Mês fechado: livro caixa, movimentos de estoque e folha daquele mês ficam bloqueados para "
+                   "alteração e os relatórios passam a usar os totais gravados no fechamento.")
+
+        closed = closed_periods()
+        if closed:
+            dfc = pd.DataFrame([{
+                "Competência": m.strftime("%m/%Y"), "Fechado em": r["closed_at"],
+                "Receita": r["v"], "CMV": r["c"], "Despesas": r["d"], "Outras receitas": r["o"],
+                "Resultado": r["resultado"], "Estoque (R$)": r["stock_value"], "Obs.": r["note"] or "",
+            } for m, r in sorted(closed.items(), reverse=True)])
+            st.dataframe(dfc, use_container_width=True, hide_index=True, column_config={
+                c: st.column_config.NumberColumn(c, format="%.2f")
+                for c in ("Receita", "CMV", "Despesas", "Outras receitas", "Resultado", "Estoque (R$)")})
+        else:
+            st.caption("Nenhuma competência fechada ainda.")
+
+        fc1, fc2 = st.columns(2)
+        with fc1:
+            st.markdown("#### Fechar mês")
+            abertos = [m for m, _ in _month_periods(24, date.today().replace(day=1) - timedelta(days=1))
+                       if m not in closed][::-1]
+            if abertos:
+                with st.form("form_period_close"):
+                    mes = st.selectbox("Competência", abertos, format_func=lambda m: m.strftime("%m/%Y"))
+                    obs = st.text_input("Observação")
+                    ok_close = st.form_submit_button("🔒 Fechar competência")
+                if ok_close:
+                    try:
+                        tot = close_period(mes, obs)
+                        st.success(f"✅ {mes:%m/%Y} fechada • resultado {money(tot['resultado'])} • "
+                                   f"estoque {money(tot['stock_value'])}")
+                        _rerun()
+                    except Exception as e:
+                        st.error(f"Não foi possível fechar: {e}")
+            else:
+                st.caption("Todos os meses dos últimos 2 anos já estão fechados.")
+        with fc2:
+            st.markdown("#### Reabrir mês")
+            if closed:
+                with st.form("form_period_reopen"):
+                    mes_r = st.selectbox("Competência", sorted(closed, reverse=True),
+                                         format_func=lambda m: m.strftime("%m/%Y"))
+                    conf = st.checkbox("Confirmo: os totais congelados serão descartados e o mês volta a aceitar lançamentos.")
+                    ok_reopen = st.form_submit_button("🔓 Reabrir")
+                if ok_reopen:
+                    if not conf:
+                        st.warning("Marque a confirmação para reabrir.")
+                    elif reopen_period(mes_r):
+                        st.success(f"✅ {mes_r:%m/%Y} reaberta.")
+                        _rerun()
+            else:
+                st.caption("Nenhuma competência fechada.")
 
+        card_end()
 
-# ===================== Importar Extrato (CSV C6 / genérico) =====================
-def _read_text_guess(raw: bytes) -> str:
-    for enc in ("utf-8-sig", "latin1"):
-        try:
-            return raw.decode(enc)
-        except Exception:
-            continue
-    return raw.decode("utf-8", errors="ignore")
-
-def _parse_brl_amount(x) -> float:
-    s = str(x or "").strip().replace("R$", "").replace(" ", "")
-    if s == "" or s.lower() in {"nan", "none"}:
-        return 0.0
-    if "." in s and "," in s:
-        s = s.replace(".", "").replace(",", ".")
-    elif "," in s and "." not in s:
-        s = s.replace(",", ".")
-    try:
-        return float(s)
-    except Exception:
-        return 0.0
-
-def _guess_sep(line: str) -> str:
-    best_sep, best_cols = ",", 1
-    for sep in [",", ";", "\t", "|"]:
-        cols = len(line.split(sep))
-        if cols > best_cols:
-            best_sep, best_cols = sep, cols
-    return best_sep
-
-def _load_c6_csv(raw: bytes) -> pd.DataFrame:
-    from io import StringIO
-    txt = _read_text_guess(raw)
-    lines = txt.splitlines()
-    marker = "Data Lançamento,Data Contábil,Título,Descrição,Entrada(R$),Saída(R$),Saldo do Dia(R$)"
-    start = next((i for i, ln in enumerate(lines) if marker in ln), None)
-    if start is None:
-        return pd.DataFrame()
-    csv_body = "\n".join(lines[start:])
-    df = pd.read_csv(StringIO(csv_body), sep=",", dtype=str, keep_default_na=False)
-
-    def _col(*names):
-        for n in names:
-            if n in df.columns:
-                return n
-        return None
-
-    col_date = _col("Data Lançamento", "Data Lancamento")
-    col_tit  = _col("Título", "Titulo", "Title")
-    col_desc = _col("Descrição", "Descricao", "Description")
-    col_ent  = _col("Entrada(R$)", "Credito", "Crédito", "Credit")
-    col_sai  = _col("Saída(R$)", "Saida(R$)", "Debito", "Débito", "Debit")
-
-    if not (col_date and col_ent and col_sai and (col_tit or col_desc)):
-        return pd.DataFrame()
-
-    out = pd.DataFrame({
-        "entry_date": pd.to_datetime(df[col_date], dayfirst=True, errors="coerce").dt.date,
-        "description_main": (df[col_desc].astype(str) if col_desc else ""),
-        "description_alt":  (df[col_tit].astype(str)  if col_tit  else ""),
-    })
-    out["description"] = (
-        out["description_alt"].str.strip() + " | " + out["description_main"].str.strip()
-    ).str.strip(" |")
-    out["amount"] = df[col_ent].apply(_parse_brl_amount) - df[col_sai].apply(_parse_brl_amount)
-    return out.dropna(subset=["entry_date"])
-
-def _load_csv_generic(raw: bytes) -> pd.DataFrame:
-    from io import StringIO
-    txt = _read_text_guess(raw)
-    if not txt:
-        return pd.DataFrame()
-    first = txt.splitlines()[0] if txt.splitlines() else ""
-    sep = _guess_sep(first)
-    df = pd.read_csv(StringIO(txt), sep=sep, dtype=str, keep_default_na=False)
-
-    cols = {c.lower(): c for c in df.columns}
-    entry_col = (cols.get("data") or cols.get("date") or cols.get("data lançamento")
-                 or cols.get("data lancamento") or cols.get("entry_date"))
-    if not entry_col:
-        return pd.DataFrame()
-
-    cand_main = ["descrição","descricao","description","histórico","historico","memo","narrativa"]
-    cand_alt  = ["título","titulo","title","detalhe","detalhes","complemento","observação","observacao"]
-    desc_col = next((cols[c] for c in cand_main if c in cols), None)
-    alt_col  = next((cols[c] for c in cand_alt  if c in cols and cols[c] != desc_col), None)
-    if not (desc_col or alt_col):
-        desc_col = alt_col or next((cols[c] for c in ("titulo","título","title","description") if c in cols), None)
-
-    base = pd.DataFrame({
-        "entry_date": pd.to_datetime(df[entry_col], dayfirst=True, errors="coerce").dt.date,
-        "description_main": df[desc_col].astype(str) if desc_col else "",
-        "description_alt":  df[alt_col].astype(str)  if alt_col  else "",
-    })
-    base["description"] = (
-        base["description_alt"].str.strip() + " | " + base["description_main"].str.strip()
-    ).str.strip(" |")
-
-    val_col = cols.get("valor") or cols.get("amount")
-    ent_col = (cols.get("entrada(r$)") or cols.get("credito") or cols.get("crédito") or cols.get("credit"))
-    sai_col = (cols.get("saída(r$)") or cols.get("saida(r$)") or cols.get("debito") or cols.get("débito") or cols.get("debit"))
-
-    if val_col:
-        base["amount"] = df[val_col].apply(_parse_brl_amount)
-    elif ent_col and sai_col:
-        base["amount"] = df[ent_col].apply(_parse_brl_amount) - df[sai_col].apply(_parse_brl_amount)
-    else:
-        return pd.DataFrame()
 
-    return base.dropna(subset=["entry_date"])
 
-def _load_bank_file(up) -> pd.DataFrame:
-    raw = up.read()
-    txt = _read_text_guess(raw)
-    if "Data Lançamento,Data Contábil,Título,Descrição,Entrada(R$),Saída(R$),Saldo do Dia(R$)" in txt:
-        df = _load_c6_csv(raw)
-        if not df.empty:
-            return df
-    return _load_csv_generic(raw)
+# ===================== Importar Extrato (CSV C6 / genérico / OFX) =====================
+STATEMENT_PREVIEW_ROWS = 200
 
-def _find_duplicates(df: pd.DataFrame) -> pd.Series:
-    if df.empty:
-        return pd.Series([], dtype=bool)
-    rows = qall("""
-        select entry_date, amount, description
-          from resto.cashbook
-         where entry_date >= (current_date - interval '365 days')
-    """)
-    base = pd.DataFrame(rows)
-    if base.empty:
-        return pd.Series([False]*len(df))
-
-    base["key"] = (
-        pd.to_datetime(base["entry_date"]).astype(str)
-        + "|" + base["amount"].astype(float).round(2).astype(str)
-        + "|" + base["description"].astype(str).str.lower().str.slice(0, 50)
-    )
-    df2 = df.copy()
-    df2["key"] = (
-        pd.to_datetime(df2["entry_date"]).astype(str)
-        + "|" + df2["amount"].astype(float).round(2).astype(str)
-        + "|" + df2["description"].astype(str).str.lower().str.slice(0, 50)
-    )
-    return df2["key"].isin(set(base["key"]))
+def _classify_bank_chunk(df: pd.DataFrame, sales_cat_id: int, out_cat_id: int, method: Optional[str],
+                         matcher: rules.Matcher) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Tipo pelo sinal; categoria/método/fornecedor pelas regras (uma passada pela coluna de descrição).
+       Sem regra: categoria padrão do tipo e método 'outro'; método forçado vale para todas as linhas.
+       Retorna (linhas classificadas, regra vencedora por campo)."""
+    out = df.copy()
+    out["kind"] = np.where(out["amount"].astype(float) >= 0, "IN", "OUT")
+    hit = matcher.apply(out["description"], out["kind"])
+    default_cat = pd.Series(np.where(out["kind"] == "IN", sales_cat_id, out_cat_id), index=out.index)
+    out["category_id"] = hit["category_id"].fillna(default_cat).astype(int)
+    out["method"] = method or hit["method"].fillna(rules.DEFAULT_METHOD)
+    out["supplier_id"] = hit["supplier_id"]
+    return out, hit
+
+def _statement_chunks(ups, sales_cat_id: int, out_cat_id: int, method: Optional[str], matcher: rules.Matcher,
+                      on_chunk=None):
+    """Arquivos enviados → (nº do arquivo, linhas classificadas), lidos em paralelo e em fluxo.
+       on_chunk(nº, pedaço classificado, regras vencedoras) vê cada pedaço antes de seguir p/ a staging."""
+    for i, df in bank.stream_statements(ups):
+        out, hit = _classify_bank_chunk(df, sales_cat_id, out_cat_id, method, matcher)
+        if on_chunk:
+            on_chunk(i, out, hit)
+        yield i, out[["entry_date", "description", "amount", "method", "category_id", "supplier_id"]].to_dict("records")
+
+def _scan_bank_files(ups, sales_cat_id: int, out_cat_id: int, method: Optional[str],
+                     matcher: rules.Matcher) -> Dict[str, Any]:
+    """Conferência sem guardar os extratos: cada arquivo passa em fluxo pela classificação e pela staging
+       (duplicados contra o livro caixa e entre arquivos). Na sessão ficam só contagens, linhas por regra e a
+       prévia; refeita quando mudam arquivos, categoria padrão, método ou regras."""
+    sig = (tuple(getattr(u, "file_id", None) or (u.name, u.size) for u in ups), out_cat_id, method,
+           tuple(matcher.rules))
+    cached = st.session_state.get("extrato_scan")
+    if cached and cached["sig"] == sig:
+        return cached
+
+    seen: Dict[int, int] = {}
+    preview, stats = [], []
+    hits = dict.fromkeys(rules.FIELDS, 0)
+
+    def _acc(i, out, hit):
+        n = seen.get(i, 0)
+        seen[i] = n + len(out)
+        if n < STATEMENT_PREVIEW_ROWS:
+            head = out.head(STATEMENT_PREVIEW_ROWS - n)
+            preview.append(head.assign(file_no=i, ord=np.arange(n, n + len(head))))
+        stats.append(matcher.stats(hit))
+        for f in rules.FIELDS:
+            hits[f] += int(hit[f"{f}_rule"].notna().sum())
+
+    with qtx() as cur:
+        scan = services.scan_statement_batch(
+            cur, _statement_chunks(ups, sales_cat_id, out_cat_id, method, matcher, _acc), STATEMENT_PREVIEW_ROWS)
+
+    files = [{"name": u.name, **bank.statement_info(u), "rows": scan[i]["rows"] if i in scan else 0,
+              "duplicates": scan[i]["duplicates"] if i in scan else 0} for i, u in enumerate(ups)]
+    prev = pd.concat(preview, ignore_index=True) if preview else pd.DataFrame(columns=["file_no", "ord"])
+    dup_at = {(src, o) for src, f in scan.items() for o in f["preview_dups"]}
+    prev["duplicado?"] = [(f, o) in dup_at for f, o in zip(prev["file_no"], prev["ord"])]
+    stats = [x for x in stats if not x.empty]
+    cached = {
+        "sig": sig, "files": files, "hits": hits,
+        "preview": prev.sort_values(["file_no", "ord"]).head(STATEMENT_PREVIEW_ROWS).reset_index(drop=True),
+        "stats": (pd.concat(stats).groupby(["regra", "padrão"], sort=False, as_index=False).sum()
+                  if stats else pd.DataFrame()),
+    }
+    st.session_state["extrato_scan"] = cached
+    return cached
 
 # ---------- NOVOS HELPERS (categoria fixa para ENTRADAS = VENDAS) ----------
 def _ensure_cash_category(kind: str, name: str) -> int:
@@ -3833,39 +5399,36 @@ def _sales_import_category_id() -> int:
     """Categoria fixa para entradas importadas tratadas como VENDAS."""
     return _ensure_cash_category('IN', 'Vendas (Importadas)')
 
-def _guess_method_from_desc(desc: str) -> str:
-    s = (desc or "").lower()
-    if "pix" in s: return "pix"
-    if "débito" in s or "debito" in s: return "cartão débito"
-    if "crédito" in s or "credito" in s: return "cartão crédito"
-    if "boleto" in s: return "boleto"
-    if "ted" in s or "doc" in s or "transfer" in s: return "transferência"
-    if "dinheiro" in s or "cash" in s: return "dinheiro"
-    return "outro"
-
 def page_importar_extrato():
-    header("🏦 Importar Extrato (CSV)", "Modelo C6 ou CSV genérico com data/descrição/valor.")
+    header("🏦 Importar Extrato", "CSV do C6, CSV genérico com data/descrição/valor ou OFX/QFX — vários arquivos de uma vez.")
     card_start()
-    st.subheader("1) Selecione o arquivo")
-    up = st.file_uploader("CSV do banco", type=["csv"])
-    if not up:
-        st.info("Dica: o CSV do C6 com cabeçalho 'Data Lançamento, Data Contábil, ...' é detectado automaticamente.")
+    st.subheader("1) Selecione os arquivos")
+    ups = st.file_uploader("Extratos do banco (um ou mais; contas diferentes ou períodos sobrepostos)",
+                           type=["csv", "txt", "ofx", "qfx"], accept_multiple_files=True)
+    if not ups:
+        st.info("Dica: o CSV do C6 com cabeçalho 'Data Lançamento, Data Contábil, ...' e arquivos OFX/QFX "
+                "são detectados automaticamente. Lançamentos repetidos entre arquivos entram uma vez só.")
         card_end()
+        _cash_rules_section()
+        _statement_batches_section()
         return
 
-    df = _load_bank_file(up)
-    if df.empty or not set(df.columns) >= {"entry_date","description","amount"}:
-        st.error("Não consegui reconhecer o layout (preciso de: data, descrição, valor).")
+    infos = [bank.statement_info(u) for u in ups]
+    for u, info in zip(ups, infos):
+        if not info["layout"]:
+            st.error(f"{u.name}: não reconheci o layout (preciso de: data, descrição, valor — ou um OFX).")
+    ups = [u for u, info in zip(ups, infos) if info["layout"]]
+    if not ups:
         card_end()
+        _cash_rules_section()
+        _statement_batches_section()
         return
-
-    st.success(f"Arquivo reconhecido. {len(df)} linhas.")
-    st.dataframe(df.head(100), use_container_width=True, hide_index=True)
+    msg = st.empty()
 
     st.subheader("2) Ajustes e classificação")
 
     # Buscamos categorias atuais (mas vamos FIXAR ENTRADAS como 'Vendas (Importadas)')
-    cats = qall("select id, name, kind from resto.cash_category order by name;") or []
+    cats = cash_categories()
     out_cats = [(c['id'], f"{c['name']} ({c['kind']})") for c in cats if c['kind']=='OUT']
 
     # fallback defensivo caso não haja nenhuma OUT cadastrada
@@ -3875,7 +5438,8 @@ def page_importar_extrato():
 
     col1, col2 = st.columns(2)
     with col1:
-        st.info("Entradas importadas serão categorizadas automaticamente como **Vendas (Importadas)**.")
+        st.info("Categoria pelas **regras de categorização** (abaixo); sem regra, entradas vão para "
+                "**Vendas (Importadas)** e saídas para a categoria padrão ao lado.")
     with col2:
         default_cat_out = st.selectbox(
             "Categoria padrão para SAÍDAS",
@@ -3887,76 +5451,188 @@ def page_importar_extrato():
         "Método (opcional — deixe em auto p/ detectar por descrição)",
         ['— auto por descrição —','dinheiro','pix','cartão débito','cartão crédito','boleto','transferência','outro']
     )
+    method_force = None if method == "— auto por descrição —" else method
 
-    # Define coluna kind
-    out = df.copy()
-    out["kind"] = out["amount"].apply(lambda v: "IN" if float(v) >= 0 else "OUT")
-
-    # Categoria por linha:
+    matcher = rule_matcher()
     sales_cat_id = _sales_import_category_id()
-    out["category_id"] = out["kind"].apply(lambda k: sales_cat_id if k == "IN" else default_cat_out[0])
-
-    # Método por linha (auto por descrição) + override opcional
     try:
-        out["method"] = out["description"].apply(_guess_method_from_desc)
-    except Exception:
-        out["method"] = "outro"
-    if method != "— auto por descrição —":
-        out["method"] = method
-
-    # Duplicados (últimos 12 meses)
-    out["duplicado?"] = _find_duplicates(out)
-
+        with st.spinner("Lendo e conferindo os extratos…"):
+            scan = _scan_bank_files(ups, sales_cat_id, int(default_cat_out[0]), method_force, matcher)
+    except Exception as e:
+        st.error(f"Falha ao ler os extratos: {e}")
+        card_end()
+        _cash_rules_section()
+        _statement_batches_section()
+        return
+    files = scan["files"]
+    for f in files:
+        if not f["rows"]:
+            st.error(f"{f['name']}: nenhuma linha reconhecida (preciso de: data, descrição, valor — ou um OFX).")
+    n_rows = sum(f["rows"] for f in files)
+    if not n_rows:
+        card_end()
+        _cash_rules_section()
+        _statement_batches_section()
+        return
+    msg.success(f"{sum(1 for f in files if f['rows'])} arquivo(s) reconhecido(s) • {n_rows} linhas.")
+
+    hits = scan["hits"]
+    n_cat = hits["category_id"]
+    st.caption(f"Regras: categoria definida em **{n_cat}** de {n_rows} linha(s) • "
+               f"método em **{hits['method']}** • fornecedor em **{hits['supplier_id']}**. "
+               f"Sem regra de categoria: {n_rows - n_cat} (categoria padrão).")
+    if not scan["stats"].empty:
+        with st.expander("📊 Linhas por regra", expanded=False):
+            st.dataframe(scan["stats"], use_container_width=True, hide_index=True)
+
+    # Duplicados contra o livro caixa e entre os arquivos (vale a 1ª ocorrência, na ordem dos arquivos)
     st.subheader("3) Conferência")
-    st.dataframe(out.head(100), use_container_width=True, hide_index=True)
-    st.info(f"Detectados **{int(out['duplicado?'].sum())}** possíveis duplicados (mesma data, valor e início da descrição). Eles não serão importados.")
+    resumo = pd.DataFrame([{
+        "arquivo": f["name"], "layout": (f["layout"] or "").upper(), "codificação": f["encoding"],
+        "linhas": f["rows"], "duplicados": f["duplicates"],
+    } for f in files])
+    st.dataframe(resumo, use_container_width=True, hide_index=True)
+    prev = scan["preview"]
+    cat_names = {int(c["id"]): c["name"] for c in cats}
+    prev = prev.assign(arquivo=prev["file_no"].map(lambda i: files[int(i)]["name"]),
+                       categoria=prev["category_id"].map(cat_names))
+    st.dataframe(prev.drop(columns=["file_no", "ord"]), use_container_width=True, hide_index=True)
+    if n_rows > len(prev):
+        st.caption(f"Prévia das primeiras {len(prev)} de {n_rows} linhas.")
+    n_dup = sum(f["duplicates"] for f in files)
+    st.info(f"Detectados **{n_dup}** possíveis duplicados (mesma data, tipo, valor e descrição — no livro caixa "
+            "ou em outro arquivo). Eles não serão importados.")
 
     st.subheader("4) Importar")
-    prontos = out[~out["duplicado?"]].copy()
-    st.markdown(f"Prontos para importar: **{len(prontos)}**")
+    st.markdown(f"Prontos para importar: **{n_rows - n_dup}** (um lote, que pode ser desfeito abaixo)")
 
     with st.form("form_import"):
         confirma = st.checkbox("Confirmo que revisei os dados e desejo importar os lançamentos.")
-        go = st.form_submit_button(f"🚀 Importar {len(prontos)} lançamentos")
+        go = st.form_submit_button(f"🚀 Importar {n_rows - n_dup} lançamentos")
 
     if go and confirma:
-        inserted, skipped_dup, skipped_err = 0, 0, 0
-
-        for _, r in prontos.iterrows():
-            entry_date = str(r["entry_date"])
-            kind       = str(r["kind"])
-            category   = int(r["category_id"])
-            desc       = (str(r["description"]) if r.get("description") is not None else "")[:300]
-            amount     = round(float(r["amount"]), 2)
-            method_row = r.get("method") or 'outro'
-
-            sql = """
-            insert into resto.cashbook(entry_date, kind, category_id, description, amount, method)
-            select %s, %s, %s, %s, %s, %s
-            where not exists (
-                select 1
-                  from resto.cashbook c
-                 where c.entry_date = %s
-                   and c.kind        = %s
-                   and c.description = %s
-                   and c.amount      = %s
-            );
-            """
-            params = (
-                entry_date, kind, category, desc, amount, method_row,
-                entry_date, kind, desc, amount
-            )
+        # lê de novo, em fluxo, direto p/ a staging do lote (os extratos não ficam na sessão)
+        keep = [i for i, f in enumerate(files) if f["rows"]]
+        try:
+            with qtx() as cur:
+                res = services.import_statement_batch(
+                    cur, [files[i] for i in keep], out_category_id=int(default_cat_out[0]),
+                    chunks=_statement_chunks([ups[i] for i in keep], sales_cat_id, int(default_cat_out[0]),
+                                             method_force, matcher))
+        except Exception as e:
+            st.error(f"Falha na importação (nada foi gravado): {e}")
+        else:
+            st.session_state.pop("extrato_scan", None)
+            st.success(f"✅ Lote #{res['batch_id']} importado: {res['inserted']} inseridos • "
+                       f"{res['duplicates']} duplicados ignorados • {len(res['files'])} arquivo(s).")
+    card_end()
+    _cash_rules_section()
+    _statement_batches_section()
 
+def _cash_rules_section():
+    """Cadastro das regras de categorização (padrão na descrição → categoria/método/fornecedor)."""
+    card_start()
+    st.subheader("5) Regras de categorização")
+    st.caption("Texto simples casa se estiver contido na descrição (sem acento/maiúsculas); regex para casos "
+               "avançados. Menor prioridade vence. As regras de método embutidas (PIX, TED, boleto...) valem "
+               "depois de todas as cadastradas.")
+    lst = cash_rules()
+    if lst:
+        st.dataframe(pd.DataFrame([{
+            "id": r["id"], "prioridade": r["priority"], "padrão": r["pattern"], "regex": r["is_regex"],
+            "categoria": f"{r['category']} ({r['kind']})" if r["category_id"] else "", "método": r["method"] or "",
+            "fornecedor": r["supplier"] or "", "ativa": r["active"],
+        } for r in lst]), use_container_width=True, hide_index=True)
+
+    METHODS = ['—', 'dinheiro', 'pix', 'cartão débito', 'cartão crédito', 'boleto', 'transferência', 'outro']
+    with st.expander("➕ Nova regra", expanded=not lst):
+        c1, c2, c3 = st.columns([3, 1, 1])
+        pattern = c1.text_input("Padrão na descrição", key="rule_pattern", placeholder="ex.: posto ipiranga")
+        is_regex = c2.checkbox("Regex", key="rule_regex")
+        priority = c3.number_input("Prioridade", value=100, step=10, key="rule_priority")
+        c1, c2 = st.columns(2)
+        cats = [(None, "—")] + [(c["id"], f"{c['name']} ({c['kind']})") for c in cash_categories()]
+        cat = c1.selectbox("Categoria", cats, format_func=lambda x: x[1], key="rule_cat")
+        method = c2.selectbox("Método", METHODS, key="rule_method")
+        sup = supplier_picker("Fornecedor (opcional)", "rule_supplier", placeholder="—")
+        if st.button("💾 Salvar regra", key="rule_save"):
             try:
-                rc = qexec(sql, params)  # se seu qexec não retorna rowcount, tudo bem: cairá no else e contará como duplicado
-                if rc and rc > 0:
-                    inserted += 1
-                else:
-                    skipped_dup += 1
-            except Exception:
-                skipped_err += 1
+                if not pattern.strip():
+                    raise ValueError("Informe o padrão.")
+                rules.rule_regex(pattern.strip(), is_regex)
+                if cat[0] is None and method == '—' and not sup:
+                    raise ValueError("Escolha ao menos categoria, método ou fornecedor.")
+                qexec("""
+                    insert into resto.cash_rule(pattern, is_regex, category_id, method, supplier_id, priority)
+                    values (%s, %s, %s, %s, %s, %s);
+                """, (pattern.strip(), bool(is_regex), cat[0], None if method == '—' else method,
+                      int(sup["id"]) if sup else None, int(priority)))
+                cash_rules.clear()
+                st.success("✅ Regra salva.")
+                st.rerun()
+            except ValueError as e:
+                st.error(str(e))
+
+    if lst:
+        c1, c2, c3 = st.columns([3, 1, 1])
+        opts = {f"#{r['id']} • {r['pattern']}" + ("" if r["active"] else " (inativa)"): r for r in lst}
+        sel = opts[c1.selectbox("Regra", list(opts.keys()), key="rule_sel")]
+        if c2.button("⏯️ Ativar/Desativar", use_container_width=True, key="rule_toggle"):
+            qexec("update resto.cash_rule set active = not active where id = %s;", (int(sel["id"]),))
+            cash_rules.clear()
+            st.rerun()
+        if c3.button("🗑️ Excluir", use_container_width=True, key="rule_del"):
+            qexec("delete from resto.cash_rule where id = %s;", (int(sel["id"]),))
+            cash_rules.clear()
+            st.rerun()
+    card_end()
 
-        st.success(f"Importação finalizada: {inserted} inseridos • {skipped_dup} ignorados (duplicados) • {skipped_err} com erro.")
+def _statement_batches_section():
+    """Lotes de extrato já importados, com opção de desfazer (apaga os lançamentos do lote)."""
+    card_start()
+    st.subheader("6) Lotes importados")
+    batches = qall("""
+        select b.id, b.imported_at, b.rows, b.inserted, b.duplicates, b.rolled_back_at,
+               string_agg(f.file_name, ', ' order by f.file_no) as files
+          from resto.statement_import_batch b
+          left join resto.statement_import_file f on f.batch_id = b.id
+         group by b.id
+         order by b.id desc
+         limit 50;
+    """) or []
+    if not batches:
+        st.caption("Nenhum lote de extrato importado ainda.")
+        card_end()
+        return
+    st.dataframe(pd.DataFrame([{
+        "lote": b["id"], "importado em": f"{b['imported_at']:%d/%m/%Y %H:%M}", "arquivos": b["files"],
+        "linhas": b["rows"], "inseridos": b["inserted"], "duplicados": b["duplicates"],
+        "desfeito em": f"{b['rolled_back_at']:%d/%m/%Y %H:%M}" if b["rolled_back_at"] else "",
+    } for b in batches]), use_container_width=True, hide_index=True)
+
+    ativos = {f"#{b['id']} • {b['files']} ({b['inserted']} lançamento(s))": b["id"]
+              for b in batches if not b["rolled_back_at"]}
+    if not ativos:
+        card_end()
+        return
+    with st.form("form_batch_rollback"):
+        sel = st.selectbox("Lote para desfazer", list(ativos.keys()))
+        conf = st.checkbox("Confirmo: os lançamentos inseridos por este lote serão apagados do livro caixa.")
+        ok_undo = st.form_submit_button("↩️ Desfazer lote")
+    if ok_undo:
+        if not conf:
+            st.warning("Marque a confirmação para desfazer o lote.")
+        else:
+            try:
+                with qtx() as cur:
+                    n = services.rollback_statement_batch(cur, int(ativos[sel]))
+            except Exception as e:
+                st.error(f"Não foi possível desfazer o lote: {e}")
+            else:
+                st.success(f"✅ Lote #{ativos[sel]} desfeito • {n} lançamento(s) removido(s) do livro caixa.")
+                _rerun()
+    st.caption("⚠️ Remove os lançamentos inseridos pelo lote, mesmo que recategorizados depois. "
+               "Meses fechados precisam ser reabertos antes.")
     card_end()
 
     
@@ -4207,7 +5883,7 @@ def page_agenda_contas():
         pay_method = st.selectbox("Método", METHODS, key="ag_pay_method")
     with b3:
         cat_out_default = _ensure_cash_category('OUT', 'Compras/Estoque')
-        cats_out = qall("select id, name from resto.cash_category where kind='OUT' order by name;") or []
+        cats_out = cash_categories("OUT")
         cats_ordered = sorted(cats_out, key=lambda r: (0 if r["id"] == cat_out_default else 1, r["name"]))
         pay_cat = st.selectbox("Categoria (saída)", options=[(r["id"], r["name"]) for r in cats_ordered],
                                format_func=lambda x: x[1] if isinstance(x, tuple) else x,
@@ -4215,23 +5891,10 @@ def page_agenda_contas():
 
     # aplicar edições básicas (due_date, amount, note)
     if do_save:
-        orig = df.set_index("id")
-        new  = edited.set_index("id")
-        upd = err = 0
-        for pid in new.index.tolist():
-            a, b = orig.loc[pid], new.loc[pid]
-            if any(str(a.get(f,"")) != str(b.get(f,"")) for f in ["due_date","amount","note"]):
-                try:
-                    qexec("""
-                        update resto.payable
-                           set due_date=%s, amount=%s, note=%s
-                         where id=%s and status='ABERTO';
-                    """, (b["due_date"], float(b["amount"]), (b.get("note") or None), int(pid)))
-                    upd += 1
-                except Exception:
-                    err += 1
-        st.success(f"✅ {upd} atualizado(s) • ⚠️ {err} erro(s)")
-        _rerun()
+        res = grid_apply("resto.payable", df, edited, ["due_date","amount","note"],
+                         prepare=_prep_payable_row, delete_col=None, update_where="and status='ABERTO'")
+        if grid_feedback(res):
+            _rerun()
 
     # cancelar selecionados
     if do_cancel:
@@ -4289,14 +5952,6 @@ def page_relatorios():
     from datetime import date
     from io import BytesIO
 
-    def _brl(v: float) -> str:
-        try:
-            n = float(v or 0)
-        except Exception:
-            n = 0.0
-        s = f"R$ {n:,.2f}"
-        return s.replace(",", "X").replace(".", ",").replace("X", ".")
-
     def _ensure_reportlab_runtime() -> bool:
         try:
             import reportlab  # noqa
@@ -4340,7 +5995,7 @@ def page_relatorios():
         # Totais (tabela pequena)
         tot_data = [
             ["Entradas (período)", "Saídas (período)", "Resultado (E − S)"],
-            [_brl(tot_e), _brl(tot_s), _brl(tot_res)]
+            [money(tot_e), money(tot_s), money(tot_res)]
         ]
         tot_tbl = Table(tot_data, colWidths=[220, 220, 220])
         tot_tbl.setStyle(TableStyle([
@@ -4357,8 +6012,8 @@ def page_relatorios():
 
         # Grid por categoria
         data = [["Categoria", "Entradas", "Saídas", "Saldo"]] + [
-            [r["categoria"], _brl(r["entradas"]), _brl(r["saidas"]), _brl(r["saldo"])]
-            for _, r in df_show.iterrows()
+            list(r) for r in zip(df_show["categoria"], brl.fmt(df_show["entradas"]), brl.fmt(df_show["saidas"]),
+                                 brl.fmt(df_show["saldo"]))
         ]
         tbl = Table(data, colWidths=[300, 150, 150, 150])
         tbl.setStyle(TableStyle([
@@ -4394,7 +6049,7 @@ def page_relatorios():
         # Totais
         tot_data = [
             ["Entradas (período)", "Saídas (período)", "Resultado (E − S)"],
-            [_brl(tot_e), _brl(tot_s), _brl(tot_res)]
+            [money(tot_e), money(tot_s), money(tot_res)]
         ]
         tot_tbl = Table(tot_data, colWidths=[220, 220, 220])
         tot_tbl.setStyle(TableStyle([
@@ -4413,14 +6068,10 @@ def page_relatorios():
         first_col = df_show.columns[0]  # "periodo" ou "ano"
         label_periodo = "Período" if str(first_col).lower() in ("periodo", "ano") else str(first_col)
 
-        data = [[label_periodo, "Entradas", "Saídas", "Saldo"]]
-        for _, r in df_show.iterrows():
-            data.append([
-                str(r[first_col]),
-                _brl(r["entradas"]),
-                _brl(r["saidas"]),
-                _brl(r["saldo"]),
-            ])
+        data = [[label_periodo, "Entradas", "Saídas", "Saldo"]] + [
+            list(r) for r in zip(df_show[first_col].astype(str), brl.fmt(df_show["entradas"]),
+                                 brl.fmt(df_show["saidas"]), brl.fmt(df_show["saldo"]))
+        ]
 
         tbl = Table(data, colWidths=[180, 150, 150, 150])
         tbl.setStyle(TableStyle([
@@ -4456,7 +6107,7 @@ def page_relatorios():
         with c2:
             dt_fim = st.date_input("Até", value=date.today(), key="rel_fin_dtfim")
 
-        cats = qall("select id, name from resto.cash_category order by name;") or []
+        cats = cash_categories()
         cat_opts = [(c["id"], c["name"]) for c in cats]
         sel_cats = st.multiselect(
             "Categorias (opcional)",
@@ -4467,7 +6118,7 @@ def page_relatorios():
         sel_ids = [c[0] for c in sel_cats] if sel_cats else []
 
         # Consulta (sem exibir na tela)
-        wh = ["cb.entry_date >= %s", "cb.entry_date <= %s"]
+        wh = ["cb.day >= %s", "cb.day <= %s"]
         pr = [dt_ini, dt_fim]
         if sel_ids:
             wh.append("cb.category_id = ANY(%s)")
@@ -4478,7 +6129,7 @@ def page_relatorios():
                 coalesce(c.name, '(sem categoria)') as categoria,
                 sum(case when cb.kind='IN'  then cb.amount else 0 end)  as entradas_raw,
                 sum(case when cb.kind='OUT' then cb.amount else 0 end)  as saidas_raw
-            from resto.cashbook cb
+            from resto.cashbook_daily cb
             left join resto.cash_category c on c.id = cb.category_id
             where {' and '.join(wh)}
             group by categoria
@@ -4549,7 +6200,7 @@ def page_relatorios():
         with colc2:
             method = st.selectbox("Método", METHODS, key="rel_cmp_method")
         with colc3:
-            cats_all = qall("select id, name from resto.cash_category order by name;") or []
+            cats_all = cash_categories()
             cat_opts = [(c["id"], c["name"]) for c in cats_all]
             cmp_cats = st.multiselect(
                 "Categorias (opcional)",
@@ -4583,12 +6234,12 @@ def page_relatorios():
                     )::date as m
                 ),
                 agg as (
-                    select date_trunc('month', cb.entry_date)::date as m,
+                    select cb.month as m,
                            sum(case when cb.kind='IN'  then cb.amount else 0 end)  as vin,
                            sum(case when cb.kind='OUT' then cb.amount else 0 end)  as vout
-                      from resto.cashbook cb
-                     where cb.entry_date >= (select min(m) from series)
-                       and cb.entry_date <  (date_trunc('month', current_date) + interval '1 month')
+                      from resto.v_cashbook_monthly cb
+                     where cb.month >= (select min(m) from series)
+                       and cb.month <  (date_trunc('month', current_date) + interval '1 month')
                        {(' and ' + ' and '.join(wh_extra)) if wh_extra else ''}
                   group by 1
                 )
@@ -4669,12 +6320,12 @@ def page_relatorios():
                     )::date as y
                 ),
                 agg as (
-                    select date_trunc('year', cb.entry_date)::date as y,
+                    select date_trunc('year', cb.month)::date as y,
                            sum(case when cb.kind='IN'  then cb.amount else 0 end)  as vin,
                            sum(case when cb.kind='OUT' then cb.amount else 0 end)  as vout
-                      from resto.cashbook cb
-                     where cb.entry_date >= (date_trunc('year', current_date) - interval '4 years')
-                       and cb.entry_date <  (date_trunc('year', current_date) + interval '1 year')
+                      from resto.v_cashbook_monthly cb
+                     where cb.month >= (date_trunc('year', current_date) - interval '4 years')
+                       and cb.month <  (date_trunc('year', current_date) + interval '1 year')
                        {(' and ' + ' and '.join(wh_extra)) if wh_extra else ''}
                   group by 1
                 )
@@ -4940,75 +6591,39 @@ def page_producao_cancelar():
             _rerun()
 
         if do_save_items:
-            orig = df.set_index("id")
-            new  = edited.set_index("id")
-            upd = delc = err = 0
-
-            # deletar marcados
-            to_del = new.index[new["Excluir?"] == True].tolist()
-            for iid in to_del:
-                try:
-                    qexec("delete from resto.production_item where id=%s;", (int(iid),))
-                    delc += 1
-                except Exception:
-                    err += 1
-
-            # atualizar alterados
-            keep = [i for i in new.index if i not in to_del]
-            for iid in keep:
-                a = orig.loc[iid]; b = new.loc[iid]
-                changed = (float(a.get("qty") or 0) != float(b.get("qty") or 0)) or \
-                          (float(a.get("unit_cost") or 0) != float(b.get("unit_cost") or 0))
-                if not changed:
-                    continue
-                try:
-                    qty   = float(b.get("qty") or 0.0)
-                    ucost = float(b.get("unit_cost") or 0.0)
-                    tcost = round(qty * ucost, 2)  # total sempre em 2 casas
-                    qexec("""
-                        update resto.production_item
-                           set qty=%s, unit_cost=%s, total_cost=%s
-                         where id=%s;
-                    """, (qty, ucost, tcost, int(iid)))
-                    upd += 1
-                except Exception:
-                    err += 1
-
-            # recalcula cabeçalho preservando fator de overhead/perdas
-            hdr = qone("select coalesce(total_cost,0) as tot, coalesce(qty,0) as qty from resto.production where id=%s;", (sel_id,))
-            prev_total   = float((hdr or {}).get("tot") or 0.0)
-            prev_ing_sum = float(orig_sum or 0.0)
-            factor = (prev_total / prev_ing_sum) if prev_ing_sum > 0 else 1.0
-
-            new_sum_row = qone("select coalesce(sum(total_cost),0) s from resto.production_item where production_id=%s;", (sel_id,))
-            new_sum   = float((new_sum_row or {}).get("s") or 0.0)
-            new_total = new_sum * factor
-            qty_final = float((hdr or {}).get("qty") or 0.0)
-            new_unit  = (new_total / qty_final) if qty_final > 0 else 0.0
-
-            try:
-                qexec("update resto.production set total_cost=%s, unit_cost=%s where id=%s;", (new_total, new_unit, sel_id))
-            except Exception:
-                pass
-
-            st.success(f"Itens: ✅ {upd} atualizado(s) • 🗑️ {delc} excluído(s) • ⚠️ {err} erro(s).")
-            _rerun()
+            def _prep_prod_item(b):
+                qty   = float(_grid_py(b.get("qty")) or 0.0)
+                ucost = float(_grid_py(b.get("unit_cost")) or 0.0)
+                return {"qty": qty, "unit_cost": ucost, "total_cost": round(qty * ucost, 2)}  # total sempre em 2 casas
+
+            def _sync_header(cur):
+                # recalcula cabeçalho preservando fator de overhead/perdas
+                cur.execute("select coalesce(total_cost,0) as tot, coalesce(qty,0) as qty from resto.production where id=%s;",
+                            (sel_id,))
+                hdr = cur.fetchone() or {}
+                prev_total   = float(hdr.get("tot") or 0.0)
+                prev_ing_sum = float(orig_sum or 0.0)
+                factor = (prev_total / prev_ing_sum) if prev_ing_sum > 0 else 1.0
+
+                cur.execute("select coalesce(sum(total_cost),0) s from resto.production_item where production_id=%s;",
+                            (sel_id,))
+                new_total = float((cur.fetchone() or {}).get("s") or 0.0) * factor
+                qty_final = float(hdr.get("qty") or 0.0)
+                new_unit  = (new_total / qty_final) if qty_final > 0 else 0.0
+                cur.execute("update resto.production set total_cost=%s, unit_cost=%s where id=%s;",
+                            (new_total, new_unit, sel_id))
+
+            res = grid_apply("resto.production_item", df, edited, ["qty","unit_cost"],
+                             prepare=_prep_prod_item, after=_sync_header)
+            if grid_feedback(res, "Itens"):
+                _rerun()
 
     # ---------- adicionar novo item ao lote ----------
     st.markdown("### ➕ Adicionar item ao lote")
-    prods_ing = qall("""
-        select id, name, unit
-          from resto.product
-         where coalesce(is_ingredient,true) is true and coalesce(active,true) is true
-         order by name;
-    """) or qall("select id, name, unit from resto.product order by name;") or []
-    opts_ing = [(r["id"], f"{r['name']} [{r.get('unit') or 'un'}]") for r in prods_ing]
-
     c1, c2, c3 = st.columns([2,1,1])
     with c1:
-        novo_ing = st.selectbox("Ingrediente", options=opts_ing,
-                                format_func=lambda x: x[1] if isinstance(x, tuple) else x,
-                                key=f"new_ing_{sel_id}")
+        ing_row = product_picker("Ingrediente", key=f"new_ing_{sel_id}", only_active=True, only_ingredient=True)
+        novo_ing = (ing_row["id"], ing_row["name"]) if ing_row else None
     with c2:
         novo_qty = st.number_input("Quantidade", min_value=0.001, step=0.001, value=1.000, format="%.3f",
                                    key=f"new_qty_{sel_id}")
@@ -5058,6 +6673,251 @@ def page_producao_cancelar():
     card_end()
 
 
+# =================================== CUSTOS (histórico de preços) ===================================
+def page_custos():
+    header("📈 Custos de compra", "Histórico de preços por fornecedor • tendência mensal • variação vs. média de 90 dias.")
+
+    c1, c2 = st.columns([3, 1])
+    with c2:
+        st.write("")
+        if st.button("🔄 Recalcular histórico"):
+            refresh_price_history()
+            st.success("Histórico recalculado.")
+        elif refresh_price_history_if_stale():
+            st.caption("Histórico atualizado (janela de 90 dias).")
+
+    tabs = st.tabs(["🔎 Por produto", "📊 Variação de custo"])
+
+    # -------- Por produto --------
+    with tabs[0]:
+        card_start()
+        prods = qall("""
+            select p.id, p.name, p.unit
+              from resto.product p
+             where exists (select 1 from resto.price_history h where h.product_id = p.id)
+             order by p.name;
+        """) or []
+        if not prods:
+            st.info("Nenhuma compra postada ainda.")
+            card_end()
+        else:
+            with c1:
+                prod = st.selectbox("Produto", options=[(r["id"], f"{r['name']} ({r.get('unit') or '—'})") for r in prods],
+                                    format_func=lambda x: x[1], key="custos_prod")
+            pid = int(prod[0])
+
+            serie = pd.DataFrame(qall("""
+                select m.month as mes, s.name as fornecedor, m.avg_price
+                  from resto.price_series_monthly m
+                  join resto.supplier s on s.id = m.supplier_id
+                 where m.product_id = %s
+                 order by m.month;
+            """, (pid,)) or [])
+            if not serie.empty:
+                serie["avg_price"] = serie["avg_price"].astype(float)
+                st.markdown("**Preço médio mensal por fornecedor**")
+                st.line_chart(serie.pivot_table(index="mes", columns="fornecedor", values="avg_price"))
+
+            hist = pd.DataFrame(qall("""
+                select s.name as fornecedor, h.last_price as ultimo, h.last_date as data_ultimo,
+                       h.min_price as minimo, h.max_price as maximo, h.avg_price as medio,
+                       h.avg_90d as medio_90d, h.total_qty as qtd_total, h.n_purchases as compras
+                  from resto.price_history h
+                  join resto.supplier s on s.id = h.supplier_id
+                 where h.product_id = %s
+                 order by h.last_date desc;
+            """, (pid,)) or [])
+            st.dataframe(hist, use_container_width=True, hide_index=True)
+            card_end()
+
+    # -------- Variação --------
+    with tabs[1]:
+        card_start()
+        min_var = st.number_input("Variação mínima (|%|)", 0.0, 1000.0, 5.0, 0.5, key="custos_min_var")
+        var = pd.DataFrame(qall("""
+            select p.name as produto, p.unit, c.last_price as ultimo, c.last_date as data_ultimo,
+                   c.avg_90d as medio_90d, p.last_cost as custo_cadastro,
+                   (c.last_price / nullif(c.avg_90d,0) - 1) * 100 as var_pct
+              from resto.v_product_cost c
+              join resto.product p on p.id = c.product_id
+             where c.avg_90d is not null;
+        """) or [])
+        if var.empty:
+            st.info("Sem compras nos últimos 90 dias.")
+        else:
+            var["var_pct"] = var["var_pct"].astype(float)
+            var = var[var["var_pct"].abs() >= float(min_var)]
+            var = var.reindex(var["var_pct"].abs().sort_values(ascending=False).index)
+            m1, m2 = st.columns(2)
+            m1.metric("Em alta", int((var["var_pct"] > 0).sum()))
+            m2.metric("Em queda", int((var["var_pct"] < 0).sum()))
+            st.dataframe(var, use_container_width=True, hide_index=True,
+                         column_config={"var_pct": st.column_config.NumberColumn("Var. % (último × 90d)", format="%.1f%%")})
+        card_end()
+
+# =================================== RASTREABILIDADE ===================================
+def page_rastreabilidade():
+    header("🧭 Rastreabilidade", "Lote de compra → produções • Produção → lotes de fornecedor (recall).")
+
+    c1, c2, c3 = st.columns([1, 1, 1])
+    with c1:
+        max_depth = st.number_input("Níveis máx.", 1, 20, TRACE_MAX_DEPTH, 1)
+    with c2:
+        shelf_days = st.number_input("Validade padrão de intermediários (dias)", 1, 365, TRACE_SHELF_DAYS, 1,
+                                     help="Usada quando a produção intermediária não tem validade cadastrada.")
+    with c3:
+        st.write("")
+        if st.button("🔄 Limpar cache"):
+            trace_lot_forward.clear()
+            trace_production_backward.clear()
+
+    tabs = st.tabs(["➡️ Lote de compra → produções", "⬅️ Produção → lotes de fornecedor"])
+
+    # -------- Para frente --------
+    with tabs[0]:
+        card_start()
+        q = st.text_input("Buscar lote (nº do lote, produto ou fornecedor)", key="trace_lot_q")
+        lots = qall("""
+            select pi.id, pr.name as produto, coalesce(pi.lot_number,'—') as lot_number, pi.expiry_date,
+                   s.name as fornecedor, pu.doc_number, pu.doc_date
+              from resto.purchase_item pi
+              join resto.product pr  on pr.id = pi.product_id
+              join resto.purchase pu on pu.id = pi.purchase_id
+              join resto.supplier s  on s.id = pu.supplier_id
+             where %s::text = '' or pi.lot_number ilike %s or pr.name ilike %s or s.name ilike %s
+             order by pu.doc_date desc, pi.id desc
+             limit 200;
+        """, (q.strip(), f"%{q.strip()}%", f"%{q.strip()}%", f"%{q.strip()}%")) or []
+        if not lots:
+            st.info("Nenhum lote encontrado.")
+        else:
+            lot_opts = [(r["id"], f"#{r['id']} • {r['produto']} • lote {r['lot_number']} • {r['fornecedor']} "
+                                  f"• NF {r.get('doc_number') or '—'} ({r['doc_date']})") for r in lots]
+            lot_sel = st.selectbox("Lote de compra", options=lot_opts, format_func=lambda x: x[1])
+            df = trace_lot_forward(int(lot_sel[0]), int(max_depth), int(shelf_days))
+            if df.empty:
+                st.caption("Este lote não foi consumido em nenhuma produção.")
+            else:
+                ativos = df[df["status"] != "CANCELADA"]
+                m1, m2, m3 = st.columns(3)
+                m1.metric("Produções afetadas", len(ativos))
+                m2.metric("Produtos finais", ativos["produto"].nunique())
+                m3.metric("Níveis", int(df["nivel"].max()))
+                st.dataframe(df, use_container_width=True, hide_index=True)
+                st.download_button("⬇️ Exportar CSV", df.to_csv(index=False).encode("utf-8"),
+                                   file_name=f"rastreio_lote_{lot_sel[0]}.csv", mime="text/csv")
+        card_end()
+
+    # -------- Para trás --------
+    with tabs[1]:
+        card_start()
+        prods = qall("""
+            select p.id, p.date, pr.name as produto, coalesce(p.lot_number,'—') as lot_number,
+                   coalesce(p.status,'FECHADA') as status
+              from resto.production p
+              join resto.product pr on pr.id = p.product_id
+             order by p.date desc
+             limit 500;
+        """) or []
+        if not prods:
+            st.info("Nenhuma produção registrada.")
+        else:
+            prod_opts = [(r["id"], f"#{r['id']} • {r['produto']} • lote {r['lot_number']} • "
+                                   f"{pd.to_datetime(r['date']).strftime('%d/%m/%Y')} • {r['status']}") for r in prods]
+            prod_sel = st.selectbox("Produção", options=prod_opts, format_func=lambda x: x[1])
+            df = trace_production_backward(int(prod_sel[0]), int(max_depth), int(shelf_days))
+            if df.empty:
+                st.caption("Sem lotes de compra vinculados a esta produção.")
+            else:
+                m1, m2 = st.columns(2)
+                m1.metric("Lotes de fornecedor", len(df))
+                m2.metric("Fornecedores", df["fornecedor"].nunique())
+                st.dataframe(df, use_container_width=True, hide_index=True)
+                st.download_button("⬇️ Exportar CSV", df.to_csv(index=False).encode("utf-8"),
+                                   file_name=f"rastreio_producao_{prod_sel[0]}.csv", mime="text/csv")
+        card_end()
+
+# =================================== REPOSIÇÃO (min_stock × consumo) ===================================
+# Motivos de saída que não representam consumo (estornos e baixas por validade).
+_REORDER_IGNORED_REASONS = ("purchase_revert", "production_revert", "expiry_writeoff")
+_REORDER_WHOLE_UNITS = {"un", "cx", "pct"}
+
+def reorder_suggestions(window_days: int = 28, target_cover_days: float = 14.0,
+                        lookback_days: int = 90) -> pd.DataFrame:
+    """Sugere reposição por produto ativo.
+       consumo/dia = média móvel (window_days) das saídas diárias; cobertura = estoque ÷ consumo/dia.
+       Propõe o necessário p/ cobrir target_cover_days (nunca abaixo do min_stock), descontando
+       o que já está em aberto na lista de compras."""
+    window_days = max(int(window_days), 1)
+    lookback_days = max(int(lookback_days), window_days)
+
+    prods = pd.DataFrame(qall("""
+        select p.id as product_id, p.name, coalesce(p.unit,'un') as unit,
+               p.supplier_id, coalesce(s.name,'— sem fornecedor —') as supplier,
+               coalesce(p.stock_qty,0) as stock_qty, coalesce(p.min_stock,0) as min_stock,
+               coalesce(p.last_cost,0) as last_cost,
+               coalesce((select sum(si.qty) from resto.shopping_item si
+                          where si.product_id = p.id and si.checked is false),0) as pending
+          from resto.product p
+          left join resto.supplier s on s.id = p.supplier_id
+         where coalesce(p.active,true) is true;
+    """) or [])
+    if prods.empty:
+        return prods
+
+    daily = pd.DataFrame(qall("""
+        select product_id, move_date::date as d, sum(qty) as q
+          from resto.inventory_movement
+         where kind='OUT'
+           and move_date >= current_date - %s::int
+           and coalesce(reason,'') <> all(%s)
+         group by 1, 2;
+    """, (lookback_days, list(_REORDER_IGNORED_REASONS))) or [])
+
+    if daily.empty:
+        rate = pd.Series(0.0, index=prods["product_id"])
+    else:
+        today = pd.Timestamp(date.today())
+        days = pd.date_range(today - pd.Timedelta(days=lookback_days), today, freq="D")
+        daily["d"] = pd.to_datetime(daily["d"])
+        daily["q"] = daily["q"].astype(float)
+        mat = (daily.pivot_table(index="d", columns="product_id", values="q", aggfunc="sum")
+                    .reindex(days, fill_value=0.0).fillna(0.0))
+        rate = mat.rolling(window_days, min_periods=1).mean().iloc[-1]
+
+    for c in ("stock_qty", "min_stock", "last_cost", "pending"):
+        prods[c] = prods[c].astype(float)
+    prods["consumo_dia"] = prods["product_id"].map(rate).fillna(0.0).astype(float)
+    prods["cobertura_dias"] = np.where(prods["consumo_dia"] > 0,
+                                       prods["stock_qty"] / prods["consumo_dia"].where(prods["consumo_dia"] > 0),
+                                       np.inf)
+    alvo = np.maximum(prods["consumo_dia"] * float(target_cover_days), prods["min_stock"])
+    falta = alvo - prods["stock_qty"] - prods["pending"]
+    whole = prods["unit"].str.lower().isin(_REORDER_WHOLE_UNITS)
+    prods["sugerido"] = np.where(whole, np.ceil(falta), np.ceil(falta * 1000) / 1000).clip(min=0)
+    prods["custo_estimado"] = (prods["sugerido"] * prods["last_cost"]).round(2)
+
+    out = prods[prods["sugerido"] > 0].copy()
+    return out.sort_values(["supplier", "cobertura_dias", "name"]).reset_index(drop=True)
+
+def reorder_to_shopping_list(df: pd.DataFrame) -> int:
+    """Grava as sugestões na lista de compras com um único insert multi-linha."""
+    if df is None or df.empty:
+        return 0
+    notes = [
+        f"Reposição • {sup} • cobertura {cob:.1f} d" if np.isfinite(cob) else f"Reposição • {sup} • sem consumo"
+        for sup, cob in zip(df["supplier"], df["cobertura_dias"].astype(float))
+    ]
+    return qexec("""
+        insert into resto.shopping_item(product_id, supplier_id, name, qty, unit, note)
+        select * from unnest(%s::bigint[], %s::bigint[], %s::text[], %s::numeric[], %s::text[], %s::text[]);
+    """, ([int(x) for x in df["product_id"]],
+          [int(x) if pd.notna(x) else None for x in df["supplier_id"]],
+          [str(x) for x in df["name"]],
+          [float(x) for x in df["sugerido"]],
+          [str(x) for x in df["unit"]],
+          notes))
+
 # =================================== LISTA DE COMPRAS ===================================
 def page_lista_compras():
     import pandas as pd
@@ -5087,6 +6947,7 @@ def page_lista_compras():
             note        text,
             created_at  timestamptz not null default now()
           );
+          alter table resto.shopping_item add column if not exists supplier_id bigint references resto.supplier(id);
           create index if not exists shop_checked_idx on resto.shopping_item(checked);
           create index if not exists shop_created_idx on resto.shopping_item(created_at);
         end $$;
@@ -5166,14 +7027,12 @@ def page_lista_compras():
     card_start()
     st.subheader("➕ Adicionar item")
 
-    # Carrega produtos (opcional, para autopreencher nome/unidade)
-    prods = qall("select id, name, unit from resto.product where coalesce(active,true) is true order by name;") or []
-    prod_opts = [(p["id"], f"{p['name']} [{p.get('unit') or 'un'}]") for p in prods]
-
+    # Produto (opcional, para autopreencher nome/unidade)
     c1, c2 = st.columns([2, 1])
     with c1:
-        prod_sel = st.selectbox("Produto (opcional)", options=[(0, "— usar nome livre —")] + prod_opts,
-                                format_func=lambda x: x[1] if isinstance(x, tuple) else x)
+        prow_sel = product_picker("Produto (opcional)", key="shop_prod", only_active=True,
+                                  placeholder="— usar nome livre —")
+        prod_sel = (prow_sel["id"], prow_sel["name"]) if prow_sel else (0, "— usar nome livre —")
     with c2:
         nome_livre = st.text_input("Nome livre (se não usar produto)")
 
@@ -5183,12 +7042,8 @@ def page_lista_compras():
     with c4:
         # unidade padrão do produto, se houver
         default_unit = ""
-        if isinstance(prod_sel, tuple) and prod_sel[0] != 0:
-            try:
-                prow = next((r for r in prods if r["id"] == prod_sel[0]), None)
-                default_unit = (prow or {}).get("unit") or ""
-            except Exception:
-                pass
+        if prow_sel:
+            default_unit = prow_sel.get("unit") or ""
         unit_new = st.text_input("Unidade", value=default_unit)
     with c5:
         note_new = st.text_input("Observação", value="")
@@ -5198,8 +7053,7 @@ def page_lista_compras():
         if (isinstance(prod_sel, tuple) and prod_sel[0] != 0):
             # via produto
             pid = int(prod_sel[0])
-            prow = next((r for r in prods if r["id"] == pid), {})
-            name = prow.get("name") or nome_livre or ""
+            name = prow_sel.get("name") or nome_livre or ""
             if not name:
                 st.warning("Informe um nome para o item.")
             else:
@@ -5223,6 +7077,66 @@ def page_lista_compras():
 
     card_end()
 
+    # -------- Sugestão de reposição --------
+    card_start()
+    with st.expander("🤖 Sugestão de reposição (min_stock × consumo)", expanded=False):
+        st.caption("Consumo/dia = média móvel das saídas (sem estornos e baixas de validade). "
+                   "Já desconta o que está em aberto nesta lista.")
+        r1, r2, r3 = st.columns(3)
+        with r1:
+            rp_window = st.number_input("Janela da média (dias)", 1, 180, 28, 1)
+        with r2:
+            rp_cover = st.number_input("Cobertura alvo (dias)", 1, 120, 14, 1)
+        with r3:
+            rp_look = st.number_input("Histórico (dias)", 7, 365, 90, 1)
+
+        sug = reorder_suggestions(int(rp_window), float(rp_cover), int(rp_look))
+        if sug.empty:
+            st.info("Nada a repor: estoques cobrem o alvo (ou acima do mínimo).")
+        else:
+            view = sug[["product_id", "supplier_id", "supplier", "name", "unit", "stock_qty", "min_stock",
+                        "pending", "consumo_dia", "cobertura_dias", "sugerido", "last_cost"]].copy()
+            view["cobertura_dias"] = view["cobertura_dias"].replace(np.inf, np.nan)
+            view.insert(0, "incluir", True)
+            ed = st.data_editor(
+                view,
+                use_container_width=True,
+                hide_index=True,
+                disabled=["supplier", "name", "unit", "stock_qty", "min_stock", "pending",
+                          "consumo_dia", "cobertura_dias", "last_cost"],
+                column_config={
+                    "incluir":        st.column_config.CheckboxColumn("Incluir?"),
+                    "product_id":     None,
+                    "supplier_id":    None,
+                    "supplier":       st.column_config.TextColumn("Fornecedor"),
+                    "name":           st.column_config.TextColumn("Produto"),
+                    "unit":           st.column_config.TextColumn("Un"),
+                    "stock_qty":      st.column_config.NumberColumn("Estoque", format="%.3f"),
+                    "min_stock":      st.column_config.NumberColumn("Mínimo", format="%.3f"),
+                    "pending":        st.column_config.NumberColumn("Na lista", format="%.3f"),
+                    "consumo_dia":    st.column_config.NumberColumn("Consumo/dia", format="%.3f"),
+                    "cobertura_dias": st.column_config.NumberColumn("Cobertura (d)", format="%.1f"),
+                    "sugerido":       st.column_config.NumberColumn("Sugerido", step=0.001, format="%.3f"),
+                    "last_cost":      st.column_config.NumberColumn("Últ. custo", format="%.2f"),
+                },
+                key="reorder_editor",
+            )
+            sel = ed[(ed["incluir"] == True) & (ed["sugerido"].astype(float) > 0)].copy()
+            sel["cobertura_dias"] = sel["cobertura_dias"].fillna(np.inf)
+            sel["custo"] = sel["sugerido"].astype(float) * sel["last_cost"].astype(float)
+            if not sel.empty:
+                tot = sel.groupby("supplier", as_index=False)["custo"].sum().sort_values("custo", ascending=False)
+                st.markdown("**Estimativa por fornecedor:** " + " • ".join(
+                    f"{r.supplier}: {money(r.custo)}" for r in tot.itertuples()))
+            if st.button(f"➕ Adicionar {len(sel)} item(ns) à lista", disabled=sel.empty):
+                try:
+                    n = reorder_to_shopping_list(sel)
+                    st.success(f"✅ {n} item(ns) adicionados à lista.")
+                    _rerun()
+                except Exception as e:
+                    st.error(f"Falha ao gravar sugestões: {e}")
+    card_end()
+
     # -------- Grid de edição / checklist --------
     card_start()
     st.subheader("Lista atual")
@@ -5290,46 +7204,20 @@ def page_lista_compras():
             st.caption("Dica: marque ✓ para itens comprados (fica registrado).")
 
         if do_save:
-            orig = df.set_index("id")
-            new  = edited.set_index("id")
-            upd = 0; err = 0
-            for iid in new.index.tolist():
-                a = orig.loc[iid]; b = new.loc[iid]
-                changed = any([
-                    bool(a.get("checked")) != bool(b.get("checked")),
-                    str(a.get("name","")) != str(b.get("name","")),
-                    float(a.get("qty") or 0) != float(b.get("qty") or 0),
-                    str(a.get("unit","")) != str(b.get("unit","")),
-                    str(a.get("note","")) != str(b.get("note",""))
-                ])
-                if not changed:
-                    continue
-                try:
-                    qexec("""
-                        update resto.shopping_item
-                           set checked=%s, name=%s, qty=%s, unit=%s, note=%s
-                         where id=%s;
-                    """, (bool(b.get("checked")), str(b.get("name") or ""),
-                          float(b.get("qty") or 0.0), (str(b.get("unit") or "") or None),
-                          (str(b.get("note") or "") or None), int(iid)))
-                    upd += 1
-                except Exception:
-                    err += 1
-            st.success(f"✅ {upd} atualizado(s) • ⚠️ {err} erro(s).")
-            _rerun()
+            def _prep_shop(b):
+                return {"checked": bool(b.get("checked")), "name": str(_grid_py(b.get("name")) or ""),
+                        "qty": float(_grid_py(b.get("qty")) or 0.0), "unit": _grid_py(b.get("unit")) or None,
+                        "note": _grid_py(b.get("note")) or None}
+
+            res = grid_apply("resto.shopping_item", df, edited, ["checked","name","qty","unit","note"],
+                             prepare=_prep_shop, delete_col=None)
+            if grid_feedback(res):
+                _rerun()
 
         if do_del:
-            new = edited.set_index("id")
-            to_del = [int(i) for i in new.index.tolist() if bool(new.loc[i, "Excluir?"])]
-            ok = bad = 0
-            for iid in to_del:
-                try:
-                    qexec("delete from resto.shopping_item where id=%s;", (iid,))
-                    ok += 1
-                except Exception:
-                    bad += 1
-            st.success(f"🗑️ {ok} removido(s) • ⚠️ {bad} erro(s).")
-            _rerun()
+            res = grid_apply("resto.shopping_item", df, edited, [])
+            if grid_feedback(res):
+                _rerun()
 
         if do_clear:
             qexec("delete from resto.shopping_item;", ())
@@ -5590,6 +7478,7 @@ def page_folha():
           exception when undefined_column then null; end;
         end $$;
         """)
+        install_period_guard("payroll_week")   # banco novo: a tabela nasce aqui, depois das migrações
 
     def _week_range(d: date):
         """Retorna (inicio, fim) da semana (segunda a domingo) contendo a data d."""
@@ -5794,52 +7683,20 @@ def page_folha():
                 _rerun()
 
             if apply:
-                orig = df.set_index("id")
-                new  = edited.set_index("id")
-                upd = delc = err = 0
-
-                # excluir marcados
-                to_del = new.index[new["Excluir?"] == True].tolist()
-                for fid in to_del:
-                    try:
-                        qexec("delete from resto.employee where id=%s;", (int(fid),))
-                        delc += 1
-                    except Exception:
-                        err += 1
-
-                # atualizar demais
-                keep_ids = [i for i in new.index if i not in to_del]
-                for fid in keep_ids:
-                    a = orig.loc[fid]; b = new.loc[fid]
-                    changed = any(str(a.get(f,"")) != str(b.get(f,"")) for f in
-                                  ["name","cpf","role","admission_date","dismissal_date",
-                                   "weekly_salary","active","payment_method"])
-                    if not changed:
-                        continue
-                    try:
-                        qexec("""
-                            update resto.employee
-                               set name=%s,
-                                   cpf=%s,
-                                   role=%s,
-                                   admission_date=%s,
-                                   dismissal_date=%s,
-                                   weekly_salary=%s,
-                                   active=%s,
-                                   payment_method=%s
-                             where id=%s;
-                        """, (b.get("name"), b.get("cpf") or None, b.get("role") or None,
-                              b.get("admission_date"), b.get("dismissal_date"),
-                              float(b.get("weekly_salary") or 0),
-                              bool(b.get("active")),
-                              b.get("payment_method") or None,
-                              int(fid)))
-                        upd += 1
-                    except Exception:
-                        err += 1
-
-                st.success(f"Funcionários: ✅ {upd} atualizado(s) • 🗑️ {delc} excluído(s) • ⚠️ {err} erro(s).")
-                _rerun()
+                def _prep_emp(b):
+                    return {"name": _grid_py(b.get("name")), "cpf": _grid_py(b.get("cpf")) or None,
+                            "role": _grid_py(b.get("role")) or None,
+                            "admission_date": _grid_py(b.get("admission_date")),
+                            "dismissal_date": _grid_py(b.get("dismissal_date")),
+                            "weekly_salary": float(_grid_py(b.get("weekly_salary")) or 0),
+                            "active": bool(b.get("active")),
+                            "payment_method": _grid_py(b.get("payment_method")) or None}
+
+                res = grid_apply("resto.employee", df, edited,
+                                 ["name","cpf","role","admission_date","dismissal_date",
+                                  "weekly_salary","active","payment_method"], prepare=_prep_emp)
+                if grid_feedback(res, "Funcionários"):
+                    _rerun()
         else:
             st.caption("Nenhum funcionário cadastrado ainda.")
 
@@ -6064,8 +7921,6 @@ def page_folha():
 
 # ===================== PÁGINA: IMPORTAÇÕES IFOOD =====================
 def page_importar_ifood():
-    import pandas as pd
-    import json
     from datetime import datetime
 
     _ensure_ifood_schema()
@@ -6096,56 +7951,13 @@ def page_importar_ifood():
             disabled=(st.session_state.get("ifood_df") is None)
         )
 
-    def _detect_ifood_tipo(df: pd.DataFrame) -> str | None:
-        cols = set(df.columns)
-        # Relatório de conciliação (arquivo 2025-11.xlsx)
-        if "competencia" in cols and "pedido_associado_ifood" in cols:
-            return "conciliacao"
-        # Relatório de pedidos (arquivo relatorio-pedidos_....xlsx)
-        if "ID COMPLETO DO PEDIDO" in cols or "ID CURTO DO PEDIDO" in cols:
-            return "pedidos"
-        return None
-
-    def _load_ifood_file(file_obj):
-        name = (file_obj.name or "").lower()
-
-        if name.endswith(".csv"):
-            # Caso algum relatório venha em CSV; se precisar, ajuste separador/decimal
-            df_tmp = pd.read_csv(file_obj)
-            tipo = _detect_ifood_tipo(df_tmp) or "desconhecido"
-            return df_tmp, tipo
-
-        # Padrão: XLSX com abas
-        xls = pd.ExcelFile(file_obj)
-        df_detectado = None
-        tipo_detectado = None
-
-        # tenta em todas as abas até encontrar um layout conhecido
-        for sheet in xls.sheet_names:
-            df_tmp = xls.parse(sheet)
-            t = _detect_ifood_tipo(df_tmp)
-            if t:
-                df_detectado = df_tmp
-                tipo_detectado = t
-                break
-
-        if df_detectado is None:
-            # fallback: primeira aba
-            df_detectado = xls.parse(xls.sheet_names[0])
-            tipo_detectado = _detect_ifood_tipo(df_detectado) or "desconhecido"
-
-        # remove linhas totalmente vazias
-        df_detectado = df_detectado.dropna(how="all")
-
-        return df_detectado, tipo_detectado
-
     # ========== CARREGAR ARQUIVO ==========
     if btn_carregar:
         if not uploaded:
             st.warning("Selecione um arquivo primeiro.")
         else:
             try:
-                df, tipo = _load_ifood_file(uploaded)
+                df, tipo = ifood.load_ifood_file(uploaded, uploaded.name)
                 st.session_state["ifood_df"] = df
                 st.session_state["ifood_tipo"] = tipo
                 st.session_state["ifood_nome"] = uploaded.name
@@ -6176,55 +7988,8 @@ def page_importar_ifood():
             st.warning("Nenhum arquivo carregado. Leia o arquivo primeiro.")
         else:
             try:
-                # cria o "lote" da importação
-                row = qone(
-                    "insert into resto.ifood_import_batch(file_name, file_type) "
-                    "values (%s, %s) returning id;",
-                    (nome_arquivo, tipo_arquivo)
-                )
-                batch_id = row["id"]
-
-                def _row_to_dict(row):
-                    d = {}
-                    for col, val in row.items():
-                        if pd.isna(val):
-                            continue
-                        # converte datas / timestamps pra string ISO
-                        if isinstance(val, (pd.Timestamp, datetime)):
-                            d[col] = val.isoformat()
-                        else:
-                            d[col] = val
-                    return d
-
-                def _extract_order_id(row, tipo: str):
-                    if tipo == "conciliacao":
-                        for k in ["pedido_associado_ifood", "pedido_associado_ifood_curto"]:
-                            if k in row.index and not pd.isna(row[k]):
-                                return str(row[k])
-                    else:  # 'pedidos' ou outros
-                        for k in ["ID COMPLETO DO PEDIDO", "ID CURTO DO PEDIDO"]:
-                            if k in row.index and not pd.isna(row[k]):
-                                return str(row[k])
-                    return None
-
-                inserted = 0
-                for i, r in df.iterrows():
-                    row_dict = _row_to_dict(r)
-                    if not row_dict:
-                        continue
-                    order_id = _extract_order_id(r, tipo_arquivo)
-                    json_str = json.dumps(row_dict, ensure_ascii=False, default=str)
-
-                    try:
-                        qexec(
-                            "insert into resto.ifood_import_row(batch_id, row_number, order_id, data) "
-                            "values (%s, %s, %s, %s::jsonb);",
-                            (batch_id, int(i) + 1, order_id, json_str)
-                        )
-                        inserted += 1
-                    except Exception:
-                        # se alguma linha der erro, apenas pula e segue
-                        continue
+                with qtx() as cur:
+                    _, inserted = ifood.save_import(cur, df, tipo_arquivo, nome_arquivo)
 
                 st.success(
                     f"Importação salva com sucesso: **{inserted} linha(s)** "
@@ -6383,18 +8148,8 @@ def page_conciliacao_ifood():
         card_end()
         return
 
-    # Função para converter "R$ 1.234,56" em número
-    def _to_number(s: pd.Series) -> pd.Series:
-        return pd.to_numeric(
-            s.astype(str)
-             .str.replace("R$", "", regex=False)
-             .str.replace(".", "", regex=False)
-             .str.replace(",", ".", regex=False)
-             .str.strip(),
-            errors="coerce",
-        ).fillna(0.0)
-
-    df_ef["_valor_repasse"] = _to_number(df_ef["valor"])
+    # "R$ 1.234,56" (ou já numérico) → float
+    df_ef["_valor_repasse"] = brl.parse(df_ef["valor"])
 
     # Agrupa iFood por data de repasse
     df_ifood_dia = (
@@ -6512,7 +8267,6 @@ def page_conciliacao_ifood():
     import pandas as pd
     from datetime import date, timedelta
     import streamlit as st
-    from pandas.api.types import is_numeric_dtype
 
     header(
         "📊 Conciliação iFood x Banco",
@@ -6605,20 +8359,8 @@ def page_conciliacao_ifood():
         card_end()
         return
 
-    # --------- Converter valores corretamente ---------
-    def _to_number(s: pd.Series) -> pd.Series:
-        # se já é numérico (caso do seu arquivo), só garante float
-        if is_numeric_dtype(s):
-            return s.astype(float).fillna(0.0)
-
-        # se veio como texto tipo "R$ 1.234,56"
-        txt = s.astype(str).str.strip().str.replace("R$", "", regex=False)
-        if txt.str.contains(",", na=False).any():
-            # padrão brasileiro
-            txt = txt.str.replace(".", "", regex=False).str.replace(",", ".", regex=False)
-        return pd.to_numeric(txt, errors="coerce").fillna(0.0)
-
-    df_ef["_valor_repasse"] = _to_number(df_ef["valor"])
+    # --------- Converter valores corretamente ("R$ 1.234,56" ou já numérico) ---------
+    df_ef["_valor_repasse"] = brl.parse(df_ef["valor"])
 
     # Agrupa iFood por data de repasse
     df_ifood_dia = (
@@ -6758,6 +8500,7 @@ def main():
     if not ensure_ping():
         st.stop()
     ensure_migrations()
+    _start_cache_listener()
 
     #header("🍝 Restô ERP Lite", "Financeiro • Fiscal-ready • Estoque • Ficha técnica • Preços • Produção")
     header(
@@ -6767,7 +8510,7 @@ def main():
             # logo="https://seu-dominio.com/logo.png",  # URL externa
             logo_height=92
         )
-    page = st.sidebar.radio("Menu", ["PAINEL", "CADASTROS", "COMPRAS","LISTA DE COMPRAS", "VENDAS", "PREÇOS", "PRODUÇÃO", "MANIPULAR PRODUÇÃO","ESTOQUE", "FINANCEIRO","CONCILIAÇÃO IFOOD","AGENDA DE CONTAS A PAGAR","RH/FOLHA","RELATÓRIOS","IMPORTAÇÕES BANCÁRIAS","IMPORTAÇÕES IFOOD"], index=0)
+    page = st.sidebar.radio("Menu", ["PAINEL", "CADASTROS", "COMPRAS","LISTA DE COMPRAS", "VENDAS", "PREÇOS", "PRODUÇÃO", "MANIPULAR PRODUÇÃO","RASTREABILIDADE","CUSTOS","ESTOQUE", "FINANCEIRO","CONCILIAÇÃO IFOOD","AGENDA DE CONTAS A PAGAR","RH/FOLHA","RELATÓRIOS","IMPORTAÇÕES BANCÁRIAS","IMPORTAÇÕES IFOOD"], index=0)
 
     if page == "PAINEL": page_dashboard()
     elif page == "CADASTROS": page_cadastros()
@@ -6777,6 +8520,8 @@ def main():
     elif page == "PREÇOS": page_receitas_precos()
     elif page == "PRODUÇÃO": page_producao()
     elif page == "MANIPULAR PRODUÇÃO": page_producao_cancelar()
+    elif page == "RASTREABILIDADE": page_rastreabilidade()
+    elif page == "CUSTOS": page_custos()
     elif page == "ESTOQUE": page_estoque()
     elif page == "FINANCEIRO": page_financeiro()
     elif page == "CONCILIAÇÃO IFOOD": page_conciliacao_ifood()
@@ -0,0 +1 @@
+"""Rotinas do SISGET que não dependem do Streamlit (podem rodar em outros processos)."""
@@ -0,0 +1,183 @@
+"""Linha de comando do SISGET para cargas em lote (cron / terminal), sem abrir o Streamlit.
+
+    python -m sisget import-bank extrato.csv [extrato.ofx ...] [--out-category-id N] [--method pix] [--dry-run]
+    python -m sisget import-ifood relatorio.xlsx [...] [--dry-run]
+    python -m sisget import-products planilha_olaclick.xlsx [--dry-run]
+    python -m sisget post-purchases [--status LANÇADA] [--limit N] [--dry-run]
+
+Conexão pelas variáveis DB_* (ver sisget.db). Códigos de saída:
+    0 tudo certo • 1 algum arquivo/compra falhou (os demais foram gravados) • 2 uso/configuração inválidos
+"""
+import argparse
+import os
+import sys
+import time
+from typing import List, Optional
+
+EXIT_OK, EXIT_PARTIAL, EXIT_USAGE = 0, 1, 2
+
+
+def _log(msg: str) -> None:
+    print(f"[{time.strftime('%H:%M:%S')}] {msg}", flush=True)
+
+
+def _import_bank(args) -> int:
+    from sisget import bank, rules
+
+    matcher = rules.compile_rules()   # sem banco (dry-run): só as regras de método embutidas
+    if not args.dry_run:
+        from sisget import db
+        with db.qtx() as cur:
+            matcher = rules.compile_rules(rules.load_rules(cur))
+
+    def _records(path):
+        for df in bank.iter_bank_chunks(path):
+            hit = matcher.apply(df["description"], df["amount"].map(lambda a: "IN" if a >= 0 else "OUT"))
+            df["category_id"] = hit["category_id"]
+            df["supplier_id"] = hit["supplier_id"]
+            df["method"] = args.method or hit["method"].fillna(rules.DEFAULT_METHOD)
+            yield df[["entry_date", "description", "amount", "method", "category_id", "supplier_id"]].to_dict("records")
+
+    failed = 0
+    for path in args.files:
+        try:
+            info = bank.statement_info(path)
+            if not info["layout"]:
+                raise ValueError("arquivo vazio")
+            if args.dry_run:
+                n = sum(len(df) for df in bank.iter_bank_chunks(path))
+                if not n:
+                    raise ValueError("layout não reconhecido (preciso de: data, descrição, valor)")
+                _log(f"{path}: {info['layout']} ({info['encoding']}) • {n} linha(s) reconhecida(s) "
+                     "(dry-run, nada gravado)")
+                continue
+            from sisget import db, services
+            with db.qtx() as cur:   # o arquivo entra inteiro ou nada
+                res = services.import_statement_chunks(cur, _records(path), out_category_id=args.out_category_id)
+            if not res["inserted"] and not res["duplicates"]:
+                raise ValueError("layout não reconhecido (preciso de: data, descrição, valor)")
+            _log(f"{path}: {info['layout']} • {res['inserted']} inserido(s) • "
+                 f"{res['duplicates']} duplicado(s) ignorado(s)")
+        except Exception as e:
+            failed += 1
+            _log(f"{path}: ERRO — {e}")
+    return EXIT_PARTIAL if failed else EXIT_OK
+
+
+def _import_ifood(args) -> int:
+    from sisget import ifood
+
+    failed = 0
+    for path in args.files:
+        try:
+            df, tipo = ifood.load_ifood_file(path, os.path.basename(path))
+            if args.dry_run:
+                _log(f"{path}: tipo {tipo}, {len(df)} linha(s) (dry-run, nada gravado)")
+                continue
+            from sisget import db
+            with db.qtx() as cur:
+                batch_id, n = ifood.save_import(cur, df, tipo, os.path.basename(path))
+            _log(f"{path}: tipo {tipo} • {n} linha(s) no lote #{batch_id}")
+        except Exception as e:
+            failed += 1
+            _log(f"{path}: ERRO — {e}")
+    return EXIT_PARTIAL if failed else EXIT_OK
+
+
+def _import_products(args) -> int:
+    from sisget import products
+
+    try:
+        rows = products.olaclick_rows(products.read_olaclick(args.file, args.file))
+    except Exception as e:
+        _log(f"{args.file}: ERRO — {e}")
+        return EXIT_PARTIAL
+    if args.dry_run:
+        _log(f"{args.file}: {len(rows)} produto(s) reconhecido(s) (dry-run, nada gravado)")
+        return EXIT_OK
+    from sisget import db
+    try:
+        with db.qtx() as cur:
+            res = products.upsert_olaclick(cur, rows)
+    except Exception as e:
+        _log(f"{args.file}: ERRO — {e}")
+        return EXIT_PARTIAL
+    _log(f"{args.file}: {res['inserted']} incluído(s) • {res['updated']} atualizado(s) • "
+         f"{res['unchanged']} sem alteração")
+    return EXIT_OK
+
+
+def _post_purchases(args) -> int:
+    from sisget import db, services
+
+    rows = db.qall("""
+        select id from resto.purchase where status = %s order by doc_date, id limit %s;
+    """, (args.status, args.limit))
+    total = len(rows)
+    _log(f"{total} compra(s) com status {args.status}")
+    ok = failed = 0
+    for n, r in enumerate(rows, 1):
+        if args.dry_run:
+            continue
+        try:
+            with db.qtx() as cur:   # uma transação por compra: uma falha não desfaz as anteriores
+                items = services.post_purchase(cur, int(r["id"]))
+            ok += 1
+            if n % 25 == 0 or n == total:
+                _log(f"{n}/{total} • última #{r['id']} ({items} item(ns))")
+        except Exception as e:
+            failed += 1
+            _log(f"#{r['id']}: ERRO — {e}")
+    if not args.dry_run:
+        _log(f"postadas: {ok} • com erro: {failed}")
+    return EXIT_PARTIAL if failed else EXIT_OK
+
+
+def build_parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser(prog="python -m sisget", description="Cargas em lote do SISGET")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("import-bank", help="importa extratos (CSV C6/genérico, OFX/QFX) no livro caixa")
+    p.add_argument("files", nargs="+")
+    p.add_argument("--out-category-id", type=int, default=None,
+                   help="categoria das saídas (padrão: 'Despesas (Importadas)')")
+    p.add_argument("--method", default=None, help="força o método (padrão: detecta pela descrição)")
+    p.add_argument("--dry-run", action="store_true")
+    p.set_defaults(func=_import_bank)
+
+    p = sub.add_parser("import-ifood", help="importa relatórios do iFood (.xlsx/.csv)")
+    p.add_argument("files", nargs="+")
+    p.add_argument("--dry-run", action="store_true")
+    p.set_defaults(func=_import_ifood)
+
+    p = sub.add_parser("import-products", help="carga/atualização de produtos pela planilha do OLACLICK")
+    p.add_argument("file")
+    p.add_argument("--dry-run", action="store_true")
+    p.set_defaults(func=_import_products)
+
+    p = sub.add_parser("post-purchases", help="posta no estoque as compras com o status informado")
+    p.add_argument("--status", default="LANÇADA")
+    p.add_argument("--limit", type=int, default=None)
+    p.add_argument("--dry-run", action="store_true")
+    p.set_defaults(func=_post_purchases)
+    return ap
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    try:
+        if not args.dry_run or args.cmd == "post-purchases":
+            from sisget import db
+            db.pool()   # falha de configuração aborta antes de processar qualquer arquivo
+    except (RuntimeError, ImportError) as e:   # variáveis DB_* ausentes / driver não instalado
+        _log(f"ERRO — {e}")
+        return EXIT_USAGE
+    try:
+        return args.func(args)
+    finally:
+        if "sisget.db" in sys.modules:
+            sys.modules["sisget.db"].close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+"""API HTTP local (JSON) sobre sisget.services, para PDVs e integrações sem passar pelo Streamlit.
+
+    python -m sisget.api --host 127.0.0.1 --port 8765
+
+Cada requisição roda numa thread e numa transação própria, com conexão do pool (sisget.db).
+Se SISGET_API_TOKEN estiver definido, exige o cabeçalho "Authorization: Bearer <token>".
+
+    GET  /health
+    POST /sales                       {"date", "client_token", "items": [{"product_id", "qty", "unit_price"}]}
+    POST /purchases                   {"head": {...}, "items": [...], "post": false}
+    POST /purchases/<id>/post
+    POST /purchases/<id>/unpost
+    POST /productions                 {"product_id", "qty", "lot_number", "expiry_date", "note"}
+    POST /statements                  {"rows": [{"entry_date", "description", "amount", "method"}],
+                                       "out_category_id", "method"}
+"""
+import argparse
+import hmac
+import json
+import os
+import re
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Tuple
+
+from sisget import db, services
+
+MAX_BODY = 10 * 1024 * 1024   # extratos grandes cabem; acima disso é engano
+
+
+def _sale(body: Dict[str, Any]) -> Dict[str, Any]:
+    if not body.get("client_token"):
+        raise ValueError("client_token é obrigatório (idempotência).")
+    with db.qtx() as cur:
+        sale_id, created = services.close_sale(cur, body.get("date") or date.today(), body.get("items") or [],
+                                               str(body["client_token"]))
+    return {"sale_id": sale_id, "created": created}
+
+
+def _purchase(body: Dict[str, Any]) -> Dict[str, Any]:
+    with db.qtx() as cur:
+        pid = services.save_purchase(cur, body.get("head") or {}, body.get("items") or [], bool(body.get("post")))
+    return {"purchase_id": pid}
+
+
+def _purchase_post(body: Dict[str, Any], purchase_id: str) -> Dict[str, Any]:
+    with db.qtx() as cur:
+        return {"purchase_id": int(purchase_id), "items": services.post_purchase(cur, int(purchase_id))}
+
+
+def _purchase_unpost(body: Dict[str, Any], purchase_id: str) -> Dict[str, Any]:
+    with db.qtx() as cur:
+        return {"purchase_id": int(purchase_id), "items": services.unpost_purchase(cur, int(purchase_id))}
+
+
+def _production(body: Dict[str, Any]) -> Dict[str, Any]:
+    if not body.get("product_id"):
+        raise ValueError("product_id é obrigatório.")
+    with db.qtx() as cur:
+        return services.produce(cur, int(body["product_id"]), float(body.get("qty") or 0),
+                                body.get("lot_number"), body.get("expiry_date"), body.get("note") or "")
+
+
+def _statement(body: Dict[str, Any]) -> Dict[str, Any]:
+    with db.qtx() as cur:
+        return services.import_statement(cur, body.get("rows") or [], body.get("out_category_id"), body.get("method"))
+
+
+ROUTES: List[Tuple[str, "re.Pattern[str]", Callable[..., Dict[str, Any]]]] = [
+    ("POST", re.compile(r"^/sales$"), _sale),
+    ("POST", re.compile(r"^/purchases$"), _purchase),
+    ("POST", re.compile(r"^/purchases/(\d+)/post$"), _purchase_post),
+    ("POST", re.compile(r"^/purchases/(\d+)/unpost$"), _purchase_unpost),
+    ("POST", re.compile(r"^/productions$"), _production),
+    ("POST", re.compile(r"^/statements$"), _statement),
+]
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = "sisget-api"
+    protocol_version = "HTTP/1.1"   # keep-alive: o PDV reaproveita a conexão TCP
+
+    def _send(self, status: int, payload: Dict[str, Any]) -> None:
+        data = json.dumps(payload, default=str, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _authorized(self) -> bool:
+        token = os.getenv("SISGET_API_TOKEN")
+        if not token:
+            return True
+        return hmac.compare_digest(self.headers.get("Authorization", ""), f"Bearer {token}")
+
+    def _reject(self, status: int, error: str) -> None:
+        """Resposta sem ler o corpo: fecha a conexão, senão o resto do corpo viraria a próxima requisição."""
+        self.close_connection = True
+        self._send(status, {"error": error})
+
+    def _dispatch(self, method: str) -> None:
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            if length < 0:
+                raise ValueError(length)
+        except ValueError:
+            return self._reject(400, "Content-Length inválido")
+        if not self._authorized():
+            return self._reject(401, "não autorizado")
+        path = self.path.split("?", 1)[0].rstrip("/") or "/"
+        if method == "GET" and path == "/health":
+            if length > MAX_BODY:
+                return self._reject(413, "corpo grande demais")
+            self.rfile.read(length)   # corpo ignorado, mas consumido (keep-alive)
+            try:
+                db.qone("select 1;")
+            except Exception as e:
+                self.log_error("health: %r", e)
+                return self._send(503, {"ok": False, "error": str(e)})
+            return self._send(200, {"ok": True})
+        for m, rx, fn in ROUTES:
+            hit = rx.match(path)
+            if m == method and hit:
+                break
+        else:
+            return self._reject(404, f"rota inexistente: {method} {path}")
+
+        if length > MAX_BODY:
+            return self._reject(413, "corpo grande demais")
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}") if length else {}
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            return self._send(400, {"error": f"JSON inválido: {e}"})
+        try:
+            return self._send(200, fn(body, *hit.groups()))
+        except (ValueError, KeyError, TypeError) as e:
+            return self._send(422, {"error": str(e)})
+        except Exception as e:
+            self.log_error("%s %s: %r", method, path, e)
+            return self._send(500, {"error": str(e)})
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+
+def serve(host: str = "127.0.0.1", port: int = 8765) -> None:
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    db.pool()   # abre o pool já na subida: erro de configuração aparece aqui, não no 1º PDV
+    print(f"SISGET API em http://{host}:{port}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        db.close()
+
+
+def main(argv=None) -> None:
+    ap = argparse.ArgumentParser(description="API HTTP local do SISGET")
+    ap.add_argument("--host", default=os.getenv("SISGET_API_HOST", "127.0.0.1"))
+    ap.add_argument("--port", type=int, default=int(os.getenv("SISGET_API_PORT", "8765")))
+    args = ap.parse_args(argv)
+    serve(args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
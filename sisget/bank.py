@@ -0,0 +1,275 @@
+"""Leitura de extratos bancários (CSV do C6, CSV genérico com data/descrição/valor, OFX/QFX).
+
+Leitura em fluxo: a codificação é detectada no primeiro bloco, o layout é identificado pelo cabeçalho e
+o arquivo é devolvido em pedaços normalizados (entry_date, description, amount) de até BANK_CHUNK_ROWS
+linhas — extratos de vários anos entram com memória limitada.
+
+Usado pela página de importação do app e pela linha de comando (python -m sisget import-bank).
+"""
+import codecs
+import csv
+import io
+import os
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+
+from sisget import brl
+
+BANK_CHUNK_ROWS = 5000
+PARSE_WORKERS = 4
+SNIFF_BYTES = 64 * 1024
+C6_MARKER = "Data Lançamento,Data Contábil,Título,Descrição,Entrada(R$),Saída(R$),Saldo do Dia(R$)"
+COLUMNS = ["entry_date", "description", "amount"]
+
+
+def _guess_sep(line: str) -> str:
+    best_sep, best_cols = ",", 1
+    for sep in [",", ";", "\t", "|"]:
+        cols = len(line.split(sep))
+        if cols > best_cols:
+            best_sep, best_cols = sep, cols
+    return best_sep
+
+
+# ---------- codificação e layout (só o primeiro bloco) ----------
+def detect_encoding(head: bytes) -> str:
+    """utf-8(-sig) se o bloco decodifica (o último caractere pode estar cortado); senão cp1252/latin1.
+       OFX declara o charset no cabeçalho (CHARSET:1252)."""
+    if head.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    return "cp1252" if re.search(rb"CHARSET:\s*1252", head) else "latin1"
+
+
+def sniff_layout(head: str) -> Optional[str]:
+    """'ofx' | 'c6' | 'csv' (None se o bloco estiver vazio)."""
+    if not head.strip():
+        return None
+    up = head.upper()
+    if "OFXHEADER" in up or "<OFX>" in up:
+        return "ofx"
+    if C6_MARKER in head:
+        return "c6"
+    return "csv"
+
+
+@contextmanager
+def open_statement(fh):
+    """Arquivo binário (caminho, UploadedFile, BytesIO...) → (texto em fluxo, layout, encoding)."""
+    own = isinstance(fh, (str, os.PathLike))
+    if own:
+        fh = open(fh, "rb")
+    elif isinstance(fh, bytes):
+        fh = io.BytesIO(fh)
+    try:
+        if not fh.seekable():
+            fh = io.BytesIO(fh.read())
+        fh.seek(0)
+        head = fh.read(SNIFF_BYTES)
+        enc = detect_encoding(head)
+        fh.seek(0)
+        tw = io.TextIOWrapper(fh, encoding=enc, errors="replace", newline="")
+        try:
+            yield tw, sniff_layout(head.decode(enc, errors="ignore")), enc
+        finally:
+            tw.detach()   # não fecha o arquivo de quem chamou
+    finally:
+        if own:
+            fh.close()
+
+
+# ---------- normalização por pedaço ----------
+def _description(main: pd.Series, alt: pd.Series) -> pd.Series:
+    return (alt.astype(str).str.strip() + " | " + main.astype(str).str.strip()).str.strip(" |")
+
+
+def _dates(s: pd.Series) -> pd.Series:
+    return pd.to_datetime(s, dayfirst=True, errors="coerce").dt.date
+
+
+def _finish(out: pd.DataFrame) -> pd.DataFrame:
+    return out.dropna(subset=["entry_date"])[COLUMNS].reset_index(drop=True)
+
+
+def _pick(cols: Dict[str, str], *names: str) -> Optional[str]:
+    return next((cols[n] for n in names if n in cols), None)
+
+
+def _unique(names: List[str]) -> List[str]:
+    """Nomes de coluna repetidos ganham sufixo .1, .2... (como o pandas faz ao ler o cabeçalho)."""
+    seen: Dict[str, int] = {}
+    out = []
+    for n in names:
+        k = seen.get(n, 0)
+        out.append(n if not k else f"{n}.{k}")
+        seen[n] = k + 1
+    return out
+
+
+def _csv_mapping(header: List[str]) -> Optional[Dict[str, Optional[str]]]:
+    """Cabeçalho → colunas de data, descrição (principal/alternativa) e valor (único ou entrada/saída)."""
+    cols = {c.strip().lower(): c for c in header}
+    m = {"date": _pick(cols, "data", "date", "data lançamento", "data lancamento", "entry_date")}
+    if not m["date"]:
+        return None
+    m["desc"] = _pick(cols, "descrição", "descricao", "description", "histórico", "historico", "memo", "narrativa")
+    m["alt"] = next((cols[c] for c in ("título", "titulo", "title", "detalhe", "detalhes", "complemento",
+                                        "observação", "observacao") if c in cols and cols[c] != m["desc"]), None)
+    m["value"] = _pick(cols, "valor", "amount")
+    m["in"] = _pick(cols, "entrada(r$)", "credito", "crédito", "credit")
+    m["out"] = _pick(cols, "saída(r$)", "saida(r$)", "debito", "débito", "debit")
+    if not (m["desc"] or m["alt"]) or not (m["value"] or (m["in"] and m["out"])):
+        return None
+    return m
+
+
+def _normalize_csv(df: pd.DataFrame, m: Dict[str, Optional[str]]) -> pd.DataFrame:
+    empty = pd.Series("", index=df.index)
+    out = pd.DataFrame({"entry_date": _dates(df[m["date"]])})
+    out["description"] = _description(df[m["desc"]] if m["desc"] else empty, df[m["alt"]] if m["alt"] else empty)
+    if m["value"]:
+        out["amount"] = brl.parse(df[m["value"]])
+    else:
+        out["amount"] = brl.parse(df[m["in"]]) - brl.parse(df[m["out"]])
+    return _finish(out)
+
+
+# ---------- leitores em fluxo ----------
+def _iter_csv(tw, chunk_rows: int, header_line: Optional[str] = None) -> Iterator[pd.DataFrame]:
+    """CSV a partir da linha de cabeçalho (a próxima do fluxo, ou header_line já lida)."""
+    header_line = header_line if header_line is not None else tw.readline()
+    if not header_line.strip():
+        return
+    header_line = header_line.rstrip("\r\n")
+    sep = _guess_sep(header_line)
+    header = _unique(next(csv.reader([header_line], delimiter=sep)))
+    m = _csv_mapping(header)
+    if not m:
+        return
+    reader = pd.read_csv(tw, sep=sep, header=None, names=header, dtype=str, keep_default_na=False,
+                         chunksize=chunk_rows, index_col=False, on_bad_lines="skip")
+    for df in reader:
+        out = _normalize_csv(df, m)
+        if not out.empty:
+            yield out
+
+
+def _iter_c6(tw, chunk_rows: int) -> Iterator[pd.DataFrame]:
+    """C6: pula o preâmbulo (dados da conta/período) até o cabeçalho das colunas."""
+    for line in tw:
+        if C6_MARKER in line:
+            yield from _iter_csv(tw, chunk_rows, header_line=line[line.index(C6_MARKER):])
+            return
+
+
+_OFX_TRN = re.compile(r"<STMTTRN>(.*?)</STMTTRN>", re.S | re.I)
+_OFX_TAG = re.compile(r"<(\w+)>([^<\r\n]*)")
+
+
+def _ofx_row(block: str) -> Optional[Tuple[date, str, str]]:
+    tags = {k.upper(): v.strip() for k, v in _OFX_TAG.findall(block)}
+    dt = re.match(r"(\d{4})(\d{2})(\d{2})", tags.get("DTPOSTED", ""))
+    if not dt:
+        return None
+    desc = " | ".join(x for x in (tags.get("NAME", ""), tags.get("MEMO", "")) if x)
+    return (date(int(dt[1]), int(dt[2]), int(dt[3])), desc or tags.get("TRNTYPE", ""),
+            tags.get("TRNAMT", ""))
+
+
+def _iter_ofx(tw, chunk_rows: int, block_chars: int = SNIFF_BYTES) -> Iterator[pd.DataFrame]:
+    """OFX/QFX (SGML 1.x ou XML 2.x): lê em blocos e extrai cada <STMTTRN> completo."""
+    buf, rows = "", []
+    while True:
+        part = tw.read(block_chars)
+        buf += part
+        last = 0
+        for hit in _OFX_TRN.finditer(buf):
+            row = _ofx_row(hit.group(1))
+            if row:
+                rows.append(row)
+            last = hit.end()
+        buf = buf[last:]
+        if len(buf) > 4 * block_chars:   # lixo sem transação (cabeçalho/saldos): não acumula
+            buf = buf[-block_chars:]
+        while len(rows) >= chunk_rows or (rows and not part):
+            df = pd.DataFrame(rows[:chunk_rows], columns=COLUMNS)
+            df["amount"] = brl.parse(df["amount"])
+            yield df
+            rows = rows[chunk_rows:]
+        if not part:
+            return
+
+
+_READERS = {"c6": _iter_c6, "csv": _iter_csv, "ofx": _iter_ofx}
+
+
+def iter_bank_chunks(fh, chunk_rows: int = BANK_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    """Extrato → pedaços (entry_date, description, amount) de até chunk_rows linhas, em ordem do arquivo."""
+    with open_statement(fh) as (tw, layout, _enc):
+        if layout:
+            yield from _READERS[layout](tw, chunk_rows)
+
+
+def statement_info(fh) -> Dict[str, Optional[str]]:
+    """Só o sniff: {'layout', 'encoding'} sem ler o arquivo inteiro."""
+    with open_statement(fh) as (_tw, layout, enc):
+        return {"layout": layout, "encoding": enc}
+
+
+def stream_statements(files: List, chunk_rows: int = BANK_CHUNK_ROWS,
+                      max_workers: int = PARSE_WORKERS) -> Iterator[Tuple[int, pd.DataFrame]]:
+    """Vários extratos lidos em paralelo (pool de threads; o pandas solta o GIL no parse do CSV), em fluxo:
+       devolve (nº do arquivo, pedaço) conforme ficam prontos — em ordem dentro de cada arquivo, intercalados
+       entre arquivos. A fila é limitada: se quem consome (ex.: COPY p/ staging) atrasa, os leitores esperam,
+       e a memória fica em poucos pedaços por vez. files: caminhos, bytes ou arquivos binários."""
+    if not files:
+        return
+    workers = max(1, min(max_workers, len(files)))
+    q: "queue.Queue[Tuple[int, object]]" = queue.Queue(maxsize=2 * workers)
+    stop = threading.Event()
+
+    def _put(item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read(i: int, fh) -> None:
+        try:
+            for df in iter_bank_chunks(fh, chunk_rows):
+                if not _put((i, df)):
+                    return
+            _put((i, None))   # fim do arquivo
+        except Exception as e:
+            _put((i, e))
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for i, fh in enumerate(files):
+            pool.submit(_read, i, fh)
+        pending = len(files)
+        while pending:
+            i, item = q.get()
+            if item is None:
+                pending -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield i, item
+    finally:
+        stop.set()   # consumidor parou (erro/abandono): libera leitores presos na fila
+        pool.shutdown(wait=True)
@@ -0,0 +1,80 @@
+"""Valores em reais (pt-BR): leitura de textos como "R$ 1.234,56" e formatação "R$ 1.234,56".
+
+parse/fmt recebem a coluna inteira (Series/array): colunas numéricas passam direto pelo NumPy e texto é
+convertido só nos valores distintos (pd.factorize) e devolvido por índice — extratos e relatórios repetem
+muito os mesmos valores. money/number/parse_one são as versões para um valor solto (KPIs, totais de PDF).
+"""
+from typing import Any, Callable
+
+import numpy as np
+import pandas as pd
+
+
+def _series(values: Any) -> pd.Series:
+    if isinstance(values, pd.Series):
+        return values
+    return pd.Series(np.atleast_1d(np.asarray(values, dtype=object)))
+
+
+def _by_unique(s: pd.Series, fn: Callable, dtype) -> np.ndarray:
+    codes, uniques = pd.factorize(s, use_na_sentinel=False)
+    return np.asarray([fn(u) for u in uniques.tolist()], dtype=dtype)[codes]
+
+
+def _parse_text(x: Any) -> float:
+    if x is None or x != x:   # None/NaN
+        return 0.0
+    s = str(x).replace("R$", "").replace("\xa0", "").replace(" ", "").strip()
+    neg = s[:1] == "(" and s[-1:] == ")"
+    if neg:
+        s = s[1:-1]
+    if "," in s:
+        s = s.replace(".", "").replace(",", ".")   # vírgula decimal: ponto é milhar
+    try:
+        v = float(s)
+    except ValueError:
+        return 0.0
+    return -abs(v) if neg else v
+
+
+def parse(values: Any) -> pd.Series:
+    """Coluna pt-BR → float64 (vazio/inválido = 0). Aceita 'R$', espaços, '-' e '(1.234,56)' como negativo.
+       Com vírgula, o ponto é milhar; só ponto fica como está (ex.: OFX '-10.50'). Numéricas só viram float."""
+    s = _series(values)
+    if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+        return s.astype("float64").fillna(0.0)
+    return pd.Series(_by_unique(s, _parse_text, "float64"), index=s.index)
+
+
+def parse_one(x: Any) -> float:
+    return _parse_text(x)
+
+
+def _formatter(decimals: int, prefix: str = "") -> Callable[[float], str]:
+    spec = (prefix + "{:,.%df}" % decimals).format
+    return lambda v: spec(v).replace(",", "\0").replace(".", ",").replace("\0", ".")
+
+
+def fmt(values: Any, decimals: int = 2, prefix: str = "R$ ") -> pd.Series:
+    """Coluna numérica → textos pt-BR ("R$ 1.234,56"; negativos "R$ -1.234,56"). Vazio/inválido = 0;
+       prefix="" formata quantidades (ex.: decimals=3)."""
+    s = _series(values)
+    v = pd.to_numeric(s, errors="coerce").to_numpy(dtype="float64", na_value=0.0)
+    v = np.where(np.abs(v) < 0.5 / 10 ** decimals, 0.0, v)   # sem "-0,00"
+    return pd.Series(_by_unique(pd.Series(v), _formatter(decimals, prefix), object), index=s.index)
+
+
+def number(v: Any, decimals: int = 2) -> str:
+    """Um número → "1.234,567" (sem prefixo; vazio/inválido = 0)."""
+    try:
+        v = float(v or 0)
+    except (TypeError, ValueError):
+        v = 0.0
+    if v != v or abs(v) < 0.5 / 10 ** decimals:   # NaN / sem "-0,00"
+        v = 0.0
+    return _formatter(decimals)(v)
+
+
+def money(v: Any) -> str:
+    """Um valor → "R$ 1.234,56" (vazio/inválido = R$ 0,00)."""
+    return "R$ " + number(v, 2)
@@ -0,0 +1,80 @@
+"""Acesso ao banco fora do Streamlit (API/CLI): pool de conexões + os mesmos helpers do app.
+
+Configuração pelas variáveis DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME, DB_SSLMODE
+e, para o pool, DB_POOL_MIN / DB_POOL_MAX / DB_POOL_TIMEOUT.
+"""
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+import psycopg
+import psycopg.rows
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import ConnectionPool
+
+_pool: Optional[ConnectionPool] = None
+_lock = threading.Lock()
+
+
+def conninfo() -> str:
+    host, user = os.getenv("DB_HOST", ""), os.getenv("DB_USER", "")
+    pwd, db = os.getenv("DB_PASSWORD", ""), os.getenv("DB_NAME", "")
+    if not host or not user or not pwd or not db:
+        raise RuntimeError("Configure as variáveis de conexão do banco (DB_HOST, DB_USER, DB_PASSWORD, DB_NAME).")
+    return make_conninfo(
+        host=host, port=os.getenv("DB_PORT", "5432"), user=user, password=pwd, dbname=db,
+        sslmode=os.getenv("DB_SSLMODE", "require"),
+    )
+
+
+def pool() -> ConnectionPool:
+    """Pool único do processo, aberto no primeiro uso."""
+    global _pool
+    if _pool is None:
+        with _lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    conninfo(),
+                    min_size=int(os.getenv("DB_POOL_MIN", "1")),
+                    max_size=int(os.getenv("DB_POOL_MAX", "10")),
+                    timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+                    kwargs={"autocommit": True, "row_factory": psycopg.rows.dict_row},
+                    open=True,
+                )
+    return _pool
+
+
+def close() -> None:
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def qall(sql: str, params: Optional[Tuple] = None) -> List[Dict[str, Any]]:
+    with pool().connection() as con, con.cursor() as cur:
+        cur.execute(sql, params or ())
+        return cur.fetchall()
+
+
+def qone(sql: str, params: Optional[Tuple] = None) -> Optional[Dict[str, Any]]:
+    with pool().connection() as con, con.cursor() as cur:
+        cur.execute(sql, params or ())
+        return cur.fetchone()
+
+
+def qexec(sql: str, params=None) -> int:
+    with pool().connection() as con, con.cursor() as cur:
+        cur.execute(sql, params)
+        return cur.rowcount or 0
+
+
+@contextmanager
+def qtx():
+    """Cursor numa única conexão/transação: commit ao sair, rollback se der erro."""
+    with pool().connection() as con:
+        with con.transaction():
+            with con.cursor() as cur:
+                yield cur
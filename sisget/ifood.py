@@ -0,0 +1,88 @@
+"""Leitura de relatórios do iFood (conciliação financeira / pedidos) e gravação em resto.ifood_import_*.
+
+Usado pela página de importação do app e pela linha de comando (python -m sisget import-ifood).
+"""
+import json
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+import pandas as pd
+
+
+def detect_tipo(df: pd.DataFrame) -> Optional[str]:
+    cols = set(df.columns)
+    # Relatório de conciliação (arquivo 2025-11.xlsx)
+    if "competencia" in cols and "pedido_associado_ifood" in cols:
+        return "conciliacao"
+    # Relatório de pedidos (arquivo relatorio-pedidos_....xlsx)
+    if "ID COMPLETO DO PEDIDO" in cols or "ID CURTO DO PEDIDO" in cols:
+        return "pedidos"
+    return None
+
+
+def load_ifood_file(file_obj, name: str) -> Tuple[pd.DataFrame, str]:
+    """Arquivo (caminho ou file-like) → (DataFrame, tipo). Em XLSX procura a aba com layout conhecido."""
+    if (name or "").lower().endswith(".csv"):
+        # Caso algum relatório venha em CSV; se precisar, ajuste separador/decimal
+        df_tmp = pd.read_csv(file_obj)
+        return df_tmp, detect_tipo(df_tmp) or "desconhecido"
+
+    # Padrão: XLSX com abas
+    xls = pd.ExcelFile(file_obj)
+    df_detectado, tipo_detectado = None, None
+
+    # tenta em todas as abas até encontrar um layout conhecido
+    for sheet in xls.sheet_names:
+        df_tmp = xls.parse(sheet)
+        t = detect_tipo(df_tmp)
+        if t:
+            df_detectado, tipo_detectado = df_tmp, t
+            break
+
+    if df_detectado is None:
+        # fallback: primeira aba
+        df_detectado = xls.parse(xls.sheet_names[0])
+        tipo_detectado = detect_tipo(df_detectado) or "desconhecido"
+
+    # remove linhas totalmente vazias
+    return df_detectado.dropna(how="all"), tipo_detectado
+
+
+def _row_to_dict(row: pd.Series) -> Dict[str, Any]:
+    d = {}
+    for col, val in row.items():
+        if pd.isna(val):
+            continue
+        # converte datas / timestamps pra string ISO
+        d[col] = val.isoformat() if isinstance(val, (pd.Timestamp, datetime)) else val
+    return d
+
+
+def _extract_order_id(row: pd.Series, tipo: str) -> Optional[str]:
+    keys = (["pedido_associado_ifood", "pedido_associado_ifood_curto"] if tipo == "conciliacao"
+            else ["ID COMPLETO DO PEDIDO", "ID CURTO DO PEDIDO"])   # 'pedidos' ou outros
+    for k in keys:
+        if k in row.index and not pd.isna(row[k]):
+            return str(row[k])
+    return None
+
+
+def save_import(cur, df: pd.DataFrame, tipo: str, file_name: str) -> Tuple[int, int]:
+    """Cria o lote e grava todas as linhas num único insert. Retorna (batch_id, linhas gravadas)."""
+    cur.execute("insert into resto.ifood_import_batch(file_name, file_type) values (%s, %s) returning id;",
+                (file_name, tipo))
+    batch_id = int(cur.fetchone()["id"])
+    nums, orders, data = [], [], []
+    for i, r in df.iterrows():
+        row_dict = _row_to_dict(r)
+        if not row_dict:
+            continue
+        nums.append(int(i) + 1)   # nº da linha no arquivo (o índice sobrevive ao dropna)
+        orders.append(_extract_order_id(r, tipo))
+        data.append(json.dumps(row_dict, ensure_ascii=False, default=str))
+    cur.execute("""
+        insert into resto.ifood_import_row(batch_id, row_number, order_id, data)
+        select %s, t.n, t.order_id, t.data::jsonb
+          from unnest(%s::int[], %s::text[], %s::text[]) as t(n, order_id, data);
+    """, (batch_id, nums, orders, data))
+    return batch_id, len(nums)
@@ -0,0 +1,127 @@
+"""Leitura de XML de NF-e (modelo 55) para importação de compras.
+
+Só biblioteca padrão e funções de módulo (picklable) — o app chama parse_many(),
+que distribui os arquivos num pool de processos.
+"""
+import re
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+NS = {"n": "http://www.portalfiscal.inf.br/nfe"}
+POOL_MIN_FILES = 8   # abaixo disso o custo de subir o pool não compensa
+
+
+def only_digits(s: Optional[str]) -> str:
+    return re.sub(r"\D", "", s or "")
+
+
+def entry_cfop(cfop: Optional[str]) -> Optional[str]:
+    """CFOP de saída do emitente → CFOP de entrada (5xxx→1xxx, 6xxx→2xxx, 7xxx→3xxx)."""
+    d = only_digits(cfop)
+    return {"5": "1", "6": "2", "7": "3"}.get(d[:1], d[:1]) + d[1:] if d else None
+
+
+def _txt(node, path: str, default: Optional[str] = None) -> Optional[str]:
+    if node is None:
+        return default
+    el = node.find(path, NS)
+    return el.text.strip() if el is not None and el.text else default
+
+
+def _num(node, path: str) -> float:
+    v = _txt(node, path)
+    try:
+        return float(v) if v else 0.0
+    except ValueError:
+        return 0.0
+
+
+def _ean(v: Optional[str]) -> Optional[str]:
+    d = only_digits(v)
+    return d if d and set(d) != {"0"} else None   # "SEM GTIN" / zeros → sem EAN
+
+
+def _lots(prod, qty: float) -> List[Dict[str, Any]]:
+    """Lotes do item a partir de <rastro>; sem rastro → um lote com a quantidade toda."""
+    out = []
+    for r in prod.findall("n:rastro", NS):
+        out.append({
+            "lot_number":  _txt(r, "n:nLote"),
+            "qty":         _num(r, "n:qLote"),
+            "expiry_date": (_txt(r, "n:dVal") or "")[:10] or None,
+        })
+    if not out:
+        return [{"lot_number": None, "qty": qty, "expiry_date": None}]
+    tot = sum(l["qty"] for l in out)
+    if tot <= 0:   # qLote ausente/zerado: divide igualmente
+        for l in out:
+            l["qty"] = qty / len(out)
+    return out
+
+
+def parse_nfe(name: str, raw: bytes) -> Dict[str, Any]:
+    """Converte um XML de NF-e em dict (cabeçalho + itens). Erros vão em 'error'."""
+    try:
+        root = ET.fromstring(raw)
+        inf = root.find(".//n:infNFe", NS)
+        if inf is None:
+            return {"file": name, "error": "XML não é uma NF-e (infNFe ausente)."}
+
+        ide, emit = inf.find("n:ide", NS), inf.find("n:emit", NS)
+        tot = inf.find("n:total/n:ICMSTot", NS)
+        key = only_digits(inf.get("Id"))
+        if not key:
+            prot = root.find(".//n:protNFe/n:infProt/n:chNFe", NS)
+            key = only_digits(prot.text if prot is not None else "")
+
+        items = []
+        for det in inf.findall("n:det", NS):
+            prod = det.find("n:prod", NS)
+            qty = _num(prod, "n:qCom")
+            items.append({
+                "n_item":        int(det.get("nItem") or len(items) + 1),
+                "supplier_code": _txt(prod, "n:cProd"),
+                "ean":           _ean(_txt(prod, "n:cEAN")) or _ean(_txt(prod, "n:cEANTrib")),
+                "description":   _txt(prod, "n:xProd", ""),
+                "ncm":           _txt(prod, "n:NCM"),
+                "cfop":          _txt(prod, "n:CFOP"),
+                "unit":          _txt(prod, "n:uCom"),
+                "qty":           qty,
+                "unit_price":    _num(prod, "n:vUnCom"),
+                "gross":         _num(prod, "n:vProd"),
+                "discount":      _num(prod, "n:vDesc"),
+                "lots":          _lots(prod, qty),
+            })
+
+        return {
+            "file":          name,
+            "error":         None,
+            "nfe_key":       key or None,
+            "number":        _txt(ide, "n:nNF"),
+            "series":        _txt(ide, "n:serie"),
+            "issue_date":    (_txt(ide, "n:dhEmi") or _txt(ide, "n:dEmi") or "")[:10] or None,
+            "emit_cnpj":     only_digits(_txt(emit, "n:CNPJ") or _txt(emit, "n:CPF")),
+            "emit_name":     _txt(emit, "n:xNome", ""),
+            "freight_value": _num(tot, "n:vFrete"),
+            "other_costs":   _num(tot, "n:vOutro"),
+            "total":         _num(tot, "n:vNF"),
+            "items":         items,
+        }
+    except ET.ParseError as e:
+        return {"file": name, "error": f"XML inválido: {e}"}
+    except Exception as e:
+        return {"file": name, "error": f"Falha ao ler NF-e: {e}"}
+
+
+def _parse_pair(pair: Tuple[str, bytes]) -> Dict[str, Any]:
+    return parse_nfe(*pair)
+
+
+def parse_many(files: Sequence[Tuple[str, bytes]], max_workers: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Lê vários XMLs (nome, bytes) — em paralelo quando o lote é grande. Mantém a ordem de entrada."""
+    files = list(files)
+    if len(files) < POOL_MIN_FILES:
+        return [_parse_pair(f) for f in files]
+    with ProcessPoolExecutor(max_workers=max_workers) as ex:
+        return list(ex.map(_parse_pair, files, chunksize=max(1, len(files) // 32)))
@@ -0,0 +1,99 @@
+"""Carga em massa de produtos a partir da planilha exportada do OLACLICK.
+
+A planilha vai para uma tabela temporária via COPY e é mesclada em resto.product com um único upsert
+que só escreve linhas que de fato mudaram. Usado pela página Cadastros e por python -m sisget import-products.
+"""
+import unicodedata
+from typing import Dict, Optional
+
+import pandas as pd
+
+from sisget import brl
+
+
+def _norm_colname(c) -> str:
+    if not c:
+        return ""
+    c = unicodedata.normalize("NFKD", str(c))
+    c = "".join(ch for ch in c if not unicodedata.combining(ch))
+    return c.lower().strip()
+
+
+def read_olaclick(file_obj, name: str) -> pd.DataFrame:
+    if str(name).lower().endswith((".xlsx", ".xls")):
+        return pd.read_excel(file_obj)
+    return pd.read_csv(file_obj, sep=";|,", engine="python")
+
+
+def olaclick_columns(df: pd.DataFrame) -> Dict[str, Optional[str]]:
+    """Colunas reais da planilha para nome, categoria, descrição, preço e preço com desconto."""
+    norm_map = {_norm_colname(c): c for c in df.columns}
+    return {
+        "nome":       norm_map.get("nome do produto") or norm_map.get("nome"),
+        "categoria":  norm_map.get("categoria do produto") or norm_map.get("categoria"),
+        "descricao":  norm_map.get("descricao"),
+        # o preço principal é sempre PREÇO (valor de venda)
+        "preco":      norm_map.get("preco"),
+        # usado só como fallback se o preço estiver vazio/zero
+        "preco_desc": norm_map.get("preco com desconto"),
+    }
+
+
+def olaclick_rows(df: pd.DataFrame) -> pd.DataFrame:
+    """Planilha → DataFrame (name, category, sale_price), sem nomes vazios."""
+    cols = olaclick_columns(df)
+    if not cols["nome"] or not cols["preco"]:
+        raise ValueError("A planilha precisa ter, no mínimo, as colunas 'Nome do produto' e 'Preço'.")
+    out = pd.DataFrame({"name": df[cols["nome"]].fillna("").astype(str).str.strip()})
+    # categoria (texto exatamente como está na planilha; vazia → NULL)
+    out["category"] = ([str(v).strip() or None if not pd.isna(v) else None for v in df[cols["categoria"]]]
+                       if cols["categoria"] else None)
+    price = brl.parse(df[cols["preco"]])   # numérico do XLSX ou "R$ 12,50" do CSV
+    if cols["preco_desc"]:
+        price = price.where(price != 0.0, brl.parse(df[cols["preco_desc"]]))
+    out["sale_price"] = price.round(2)
+    return out[out["name"] != ""].reset_index(drop=True)
+
+
+def upsert_olaclick(cur, rows: pd.DataFrame) -> Dict[str, int]:
+    """COPY → staging temporária → um upsert. Só categoria/preço de venda vêm da planilha; custo, estoque
+       mínimo e demais campos de produtos existentes são preservados. Nome repetido na planilha: vale a última linha.
+       Retorna {'inserted', 'updated', 'unchanged'}."""
+    if rows.empty:
+        return {"inserted": 0, "updated": 0, "unchanged": 0}
+    cur.execute("""
+        create temp table _olaclick_stage (ord int, name text, category text, sale_price numeric(14,2))
+        on commit drop;
+    """)
+    with cur.copy("copy _olaclick_stage (ord, name, category, sale_price) from stdin") as cp:
+        for i, r in enumerate(rows.itertuples(index=False)):
+            cp.write_row((i, r.name, r.category if isinstance(r.category, str) else None, float(r.sale_price)))
+    cur.execute("""
+        with src as (
+          select distinct on (name) name, category, sale_price
+            from _olaclick_stage
+           order by name, ord desc
+        ), upd as (
+          update resto.product p
+             set category = s.category, sale_price = s.sale_price, active = true, is_sale_item = true
+            from src s
+           where p.name = s.name
+             and (p.category, p.sale_price, p.active, p.is_sale_item)
+                 is distinct from (s.category, s.sale_price, true, true)
+          returning p.id
+        ), ins as (
+          insert into resto.product(name, unit, category, min_stock, last_cost, active,
+                                    sale_price, is_sale_item, is_ingredient, default_markup)
+          select s.name, 'un', s.category, 0, 0, true, s.sale_price, true, false, 0
+            from src s
+           where not exists (select 1 from resto.product p where p.name = s.name)
+          on conflict (name) do nothing
+          returning id
+        )
+        select (select count(*) from src) as total,
+               (select count(*) from ins) as inserted,
+               (select count(*) from upd) as updated;
+    """)
+    r = cur.fetchone()
+    return {"inserted": int(r["inserted"]), "updated": int(r["updated"]),
+            "unchanged": int(r["total"]) - int(r["inserted"]) - int(r["updated"])}
@@ -0,0 +1,141 @@
+"""Regras de categorização automática de lançamentos importados (descrição → categoria/método/fornecedor).
+
+As regras ficam em resto.cash_rule (padrão, prioridade, campos a preencher). Para aplicar, são compiladas
+numa regex combinada por campo e tipo (IN/OUT): uma alternância ancorada, na ordem de prioridade, que acha
+numa só passada pela coluna de descrições a regra mais prioritária que casa. Sem banco (CLI em dry-run),
+valem as regras de método embutidas (METHOD_RULES).
+
+Usado pela página de importação do app e pela linha de comando (python -m sisget import-bank).
+"""
+import re
+import unicodedata
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+FIELDS = ("category_id", "method", "supplier_id")
+DEFAULT_METHOD = "outro"
+
+# padrões sobre a descrição sem acento e em maiúsculas; prioridade crescente = avaliada antes
+METHOD_RULES = [
+    (r"PIX|QR ?CODE|\bCHAVE\b", "pix"),
+    (r"\bTED\b|\bTEF\b|\bDOC\b|TRANSFER", "transferência"),
+    (r"PAYGO|PAGSEGURO|\bSTONE\b|CIELO|\bREDE\b|GETNET|MERCADO ?PAGO|\bVISA\b|MASTERCARD|\bELO\b", "cartão crédito"),
+    (r"DEBITO", "cartão débito"),
+    (r"CREDITO", "cartão crédito"),
+    (r"BOLETO", "boleto"),
+    (r"SAQUE|\bATM\b|DINHEIRO|\bCASH\b", "dinheiro"),
+]
+METHOD_RULES_PRIORITY = 1000   # as embutidas ficam depois das regras do usuário (padrão 100)
+
+
+def default_rules() -> List[Dict[str, Any]]:
+    """METHOD_RULES no formato de resto.cash_rule (ids negativos: não existem no banco)."""
+    return [{"id": -(i + 1), "pattern": p, "is_regex": True, "kind": None, "category_id": None, "method": m,
+             "supplier_id": None, "priority": METHOD_RULES_PRIORITY + 10 * i}
+            for i, (p, m) in enumerate(METHOD_RULES)]
+
+
+def load_rules(cur) -> List[Dict[str, Any]]:
+    """Regras ativas, na ordem de avaliação. kind vem da categoria (regra só de método/fornecedor: ambos)."""
+    cur.execute("""
+        select r.id, r.pattern, r.is_regex, c.kind, r.category_id, r.method, r.supplier_id, r.priority
+          from resto.cash_rule r
+          left join resto.cash_category c on c.id = r.category_id
+         where r.active
+         order by r.priority, r.id;
+    """)
+    return list(cur.fetchall())
+
+
+def normalize(s: pd.Series) -> pd.Series:
+    """Sem acento, maiúsculas e espaços simples (vetorizado)."""
+    return (s.fillna("").astype(str).str.normalize("NFKD").str.encode("ascii", "ignore").str.decode("ascii")
+             .str.upper().str.replace(r"\s+", " ", regex=True).str.strip())
+
+
+def _unaccent(s: str) -> str:
+    return unicodedata.normalize("NFKD", s).encode("ascii", "ignore").decode("ascii")
+
+
+def rule_regex(pattern: str, is_regex: bool) -> str:
+    """Padrão da regra → regex sobre o texto normalizado (casa sem acento e sem diferenciar caixa).
+       Texto simples = 'contém'. Regex inválida sai como ValueError."""
+    if is_regex:
+        src = re.sub(r"\(\?P<\w+>", "(?:", _unaccent(pattern))   # grupos nomeados colidiriam na regex combinada
+    else:
+        src = re.escape(" ".join(_unaccent(pattern).upper().split()))
+    try:
+        re.compile(src)
+    except re.error as e:
+        raise ValueError(f"Regex inválida '{pattern}': {e}") from None
+    return src
+
+
+_GROUP = "__rule"
+
+
+def _group(rule_id: int) -> str:
+    return f"{_GROUP}{rule_id}" if rule_id >= 0 else f"{_GROUP}_{-rule_id}"
+
+
+class Matcher:
+    """Regras compiladas: uma regex combinada por (campo, tipo)."""
+
+    def __init__(self, rules: List[Dict[str, Any]]):
+        rules = sorted(rules, key=lambda r: (int(r.get("priority") or 0), int(r["id"])))
+        self.rules = {int(r["id"]): r for r in rules}
+        self._rx: Dict[tuple, Optional[re.Pattern]] = {}
+        for field in FIELDS:
+            for kind in ("IN", "OUT"):
+                alts = [(int(r["id"]), rule_regex(r["pattern"], bool(r.get("is_regex")))) for r in rules
+                        if r.get(field) is not None and r.get("kind") in (None, kind)]
+                # ^.*? em cada alternativa: a 1ª regra (mais prioritária) que casa em qualquer ponto ganha
+                self._rx[field, kind] = re.compile(
+                    "^(?:" + "|".join(f"(?P<{_group(i)}>.*?(?:{src}))" for i, src in alts) + ")",
+                    re.S | re.I) if alts else None
+
+    def _hits(self, text: pd.Series, field: str, kind: str) -> pd.Series:
+        """id da regra vencedora por linha (NaN = nenhuma)."""
+        rx = self._rx[field, kind]
+        if rx is None or text.empty:
+            return pd.Series(float("nan"), index=text.index)
+        groups = text.str.extract(rx, expand=True)
+        groups = groups[[g for g in groups.columns if str(g).startswith(_GROUP)]]   # só os grupos das regras
+        ids = [int(g[len(_GROUP):].replace("_", "-")) for g in groups.columns]
+        hit = groups.notna().to_numpy()
+        won = np.asarray(ids, dtype=float)[hit.argmax(axis=1)]
+        return pd.Series(np.where(hit.any(axis=1), won, np.nan), index=text.index)
+
+    def apply(self, descriptions: pd.Series, kinds: pd.Series) -> pd.DataFrame:
+        """Por linha: category_id/method/supplier_id da regra vencedora de cada campo (None se nenhuma)
+           e o id dessa regra em <campo>_rule."""
+        text = normalize(descriptions)
+        out = pd.DataFrame(index=descriptions.index)
+        for field in FIELDS:
+            rule = pd.Series(float("nan"), index=descriptions.index)
+            for kind in ("IN", "OUT"):
+                sel = kinds == kind
+                if sel.any():
+                    rule[sel] = self._hits(text[sel], field, kind)
+            out[f"{field}_rule"] = rule.astype("Int64")
+            out[field] = pd.Series([self.rules[int(r)][field] if pd.notna(r) else None for r in rule],
+                                   index=descriptions.index, dtype=object)
+        return out
+
+    def stats(self, applied: pd.DataFrame) -> pd.DataFrame:
+        """Linhas decididas por regra e campo (regra, padrão, categoria, método, fornecedor)."""
+        rows = []
+        for rid, r in self.rules.items():
+            n = {f: int((applied[f"{f}_rule"] == rid).sum()) for f in FIELDS}
+            if any(n.values()):
+                rows.append({"regra": rid if rid > 0 else "embutida", "padrão": r["pattern"],
+                             "categoria": n["category_id"], "método": n["method"], "fornecedor": n["supplier_id"]})
+        return pd.DataFrame(rows, columns=["regra", "padrão", "categoria", "método", "fornecedor"])
+
+
+def compile_rules(rules: Optional[List[Dict[str, Any]]] = None) -> Matcher:
+    """Regras do usuário (+ as de método embutidas, que ficam por último)."""
+    return Matcher(list(rules or []) + default_rules())
+
@@ -0,0 +1,458 @@
+"""Operações de domínio (venda, compra, produção, extrato) sem dependência do Streamlit.
+
+Cada função recebe um cursor já dentro de uma transação (app: qtx(); API/CLI: sisget.db.qtx())
+e não faz commit — quem chama decide o escopo. Erros de regra de negócio saem como ValueError.
+O schema é criado pelo app (ensure_migrations); aqui só se lê/grava.
+"""
+from datetime import date
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+IMPORTED_SALES_CATEGORY = ("IN", "Vendas (Importadas)")
+IMPORTED_EXPENSES_CATEGORY = ("OUT", "Despesas (Importadas)")
+
+
+# ===================== Vendas =====================
+def close_sale(cur, sale_date, items: List[Dict[str, Any]], client_token: str) -> Tuple[int, bool]:
+    """Grava venda + itens + saídas de estoque.
+       O client_token (um por carrinho) torna a operação idempotente: repetir o mesmo token
+       devolve a venda já gravada. Retorna (sale_id, criada_agora)."""
+    items = [it for it in items if float(it.get("qty") or 0) > 0]
+    if not items:
+        raise ValueError("Nenhum item no carrinho.")
+    total = sum(float(it["qty"]) * float(it["unit_price"]) for it in items)
+    cur.execute("""
+        insert into resto.sale(date, total, status, client_token)
+        values (%s, %s, 'FECHADA', %s)
+        on conflict (client_token) where client_token is not null do nothing
+        returning id;
+    """, (sale_date, total, client_token))
+    row = cur.fetchone()
+    if not row:
+        cur.execute("select id from resto.sale where client_token=%s;", (client_token,))
+        return int(cur.fetchone()["id"]), False
+    sale_id = int(row["id"])
+
+    cur.execute("""
+        insert into resto.sale_item(sale_id, product_id, qty, unit_price, total)
+        select %s, t.product_id, t.qty, t.unit_price, t.qty * t.unit_price
+          from unnest(%s::bigint[], %s::numeric[], %s::numeric[]) as t(product_id, qty, unit_price);
+    """, (sale_id, [int(it["product_id"]) for it in items],
+          [float(it["qty"]) for it in items], [float(it["unit_price"]) for it in items]))
+    # Saída usa CMP atual (sp cuidará); sem amarrar lote neste MVP de venda
+    cur.executemany(
+        "select resto.sp_register_movement(%s,'OUT',%s,null,'sale',%s,'');",
+        [(int(it["product_id"]), float(it["qty"]), sale_id) for it in items],
+    )
+    return sale_id, True
+
+
+# ===================== Compras =====================
+def post_purchase_items(cur, purchase_id: int, items: List[Dict[str, Any]]) -> int:
+    """INs de estoque (um por item/lote) + status POSTADA."""
+    cur.executemany(
+        "select resto.sp_register_movement(%s,'IN',%s,%s,'purchase',%s,%s);",
+        [(int(it["product_id"]), float(it["qty"]), float(it["unit_price"]), int(it["id"]),
+          f"lote:{it['id']}" + (f";exp:{it['exp']}" if it.get("exp") else ""))
+         for it in items],
+    )
+    cur.execute("update resto.purchase set status='POSTADA', posted_at=now() where id=%s;", (int(purchase_id),))
+    cur.execute("select resto.fn_price_history_refresh(%s::bigint[]);",
+                (sorted({int(it["product_id"]) for it in items}),))
+    return len(items)
+
+
+def _lock_purchase(cur, purchase_id: int) -> str:
+    cur.execute("select status from resto.purchase where id=%s for update;", (int(purchase_id),))
+    row = cur.fetchone()
+    if not row:
+        raise ValueError(f"Compra #{purchase_id} não encontrada.")
+    return row["status"]
+
+
+def post_purchase(cur, purchase_id: int) -> int:
+    """Posta uma compra já gravada."""
+    status = _lock_purchase(cur, purchase_id)
+    if status in ("POSTADA", "CANCELADA"):
+        raise ValueError(f"Compra #{purchase_id} está {status}.")
+    cur.execute("""
+        select id, product_id, qty, unit_price, coalesce(expiry_date::text,'') as exp
+          from resto.purchase_item
+         where purchase_id=%s
+         order by id;
+    """, (int(purchase_id),))
+    return post_purchase_items(cur, purchase_id, cur.fetchall())
+
+
+def unpost_purchase(cur, purchase_id: int) -> int:
+    """Estorna (OUT) todos os itens de uma compra POSTADA e marca ESTORNADA."""
+    status = _lock_purchase(cur, purchase_id)
+    if status != "POSTADA":
+        raise ValueError(f"Compra #{purchase_id} não está POSTADA ({status}).")
+    cur.execute("""
+        select id, product_id, qty, unit_price
+          from resto.purchase_item
+         where purchase_id=%s
+         order by id;
+    """, (int(purchase_id),))
+    items = cur.fetchall()
+    cur.executemany(
+        "select resto.sp_register_movement(%s,'OUT',%s,%s,'purchase_revert',%s,%s);",
+        [(int(it["product_id"]), float(it["qty"]), float(it["unit_price"]), int(it["id"]),
+          f"revert:purchase:{purchase_id};lot:{it['id']}") for it in items],
+    )
+    cur.execute("update resto.purchase set status='ESTORNADA', estornado_em=now() where id=%s;", (int(purchase_id),))
+    cur.execute("select resto.fn_price_history_refresh(%s::bigint[]);",
+                (sorted({int(it["product_id"]) for it in items}),))
+    return len(items)
+
+
+def save_purchase(cur, head: Dict[str, Any], items: List[Dict[str, Any]], post: bool = False) -> int:
+    """Grava cabeçalho + itens (insert multi-linha) e, se post=True, posta no estoque. Retorna o id da compra."""
+    if not items:
+        raise ValueError("Compra sem itens.")
+    total = float(sum(float(it.get("total") or 0) for it in items))
+    cur.execute("""
+        insert into resto.purchase(supplier_id, doc_number, cfop_entrada, doc_date, freight_value, other_costs, total, status)
+        values (%s,%s,%s,%s,%s,%s,%s,'LANÇADA')
+        returning id;
+    """, (int(head["supplier_id"]), head.get("doc_number"), head.get("cfop_entrada"), head.get("doc_date"),
+          float(head.get("freight_value") or 0), float(head.get("other_costs") or 0), total))
+    purchase_id = int(cur.fetchone()["id"])
+    cur.execute("""
+        insert into resto.purchase_item(
+          purchase_id, product_id, qty, unit_id, unit_price, discount, total, lot_number, expiry_date)
+        select %s, u.product_id, u.qty, u.unit_id, u.unit_price, u.discount, u.total, u.lot_number, u.expiry_date
+          from unnest(%s::bigint[], %s::numeric[], %s::bigint[], %s::numeric[], %s::numeric[], %s::numeric[],
+                      %s::text[], %s::date[])
+               as u(product_id, qty, unit_id, unit_price, discount, total, lot_number, expiry_date)
+        returning id, product_id, qty, unit_price, coalesce(expiry_date::text,'') as exp;
+    """, (purchase_id,
+          [int(it["product_id"]) for it in items],
+          [float(it["qty"]) for it in items],
+          [int(it["unit_id"]) if it.get("unit_id") else None for it in items],
+          [float(it.get("unit_price") or 0) for it in items],
+          [float(it.get("discount") or 0) for it in items],
+          [float(it.get("total") or 0) for it in items],
+          [it.get("lot_number") or None for it in items],
+          [it.get("expiry_date") or None for it in items]))
+    rows = cur.fetchall()
+    if post:
+        post_purchase_items(cur, purchase_id, rows)
+    return purchase_id
+
+
+# ===================== Produção =====================
+def _lot_balances(cur, product_ids: List[int]) -> Dict[int, List[Dict[str, Any]]]:
+    """Saldos por lote dos produtos (FIFO por validade, depois id). saldo = qty_lote − OUTs com reference_id=lote."""
+    cur.execute("""
+        with lots as (
+          select id, product_id, qty, unit_price, expiry_date
+            from resto.purchase_item
+           where product_id = any(%s)
+        ), cons as (
+          select m.reference_id as lot_id, coalesce(sum(m.qty),0) as qty_out
+            from resto.inventory_movement m
+           where m.kind='OUT' and m.reference_id in (select id from lots)
+           group by m.reference_id
+        )
+        select l.id as lot_id, l.product_id, l.unit_price,
+               greatest(l.qty - coalesce(c.qty_out,0), 0) as saldo
+          from lots l
+          left join cons c on c.lot_id = l.id
+         order by l.product_id, l.expiry_date nulls last, l.id;
+    """, (list(product_ids),))
+    out: Dict[int, List[Dict[str, Any]]] = {}
+    for r in cur.fetchall():
+        out.setdefault(int(r["product_id"]), []).append(r)
+    return out
+
+
+def produce(cur, product_id: int, qty: float, lot_number: Optional[str] = None,
+            expiry_date: Optional[date] = None, note: str = "") -> Dict[str, Any]:
+    """Ordem de produção: consome os ingredientes da ficha técnica por lote (FIFO) e dá entrada no produto final.
+       Retorna {'production_id', 'batch_cost', 'unit_cost', 'consumos'}."""
+    qty = float(qty or 0)
+    if qty <= 0:
+        raise ValueError("Quantidade a produzir deve ser > 0.")
+    cur.execute("select id, yield_qty, overhead_pct, loss_pct from resto.recipe where product_id=%s;", (int(product_id),))
+    recipe = cur.fetchone()
+    if not recipe:
+        raise ValueError("Este produto não possui ficha técnica (receita).")
+    yield_qty = float(recipe["yield_qty"] or 0)
+    if yield_qty <= 0:
+        raise ValueError("Ficha técnica inválida: rendimento deve ser > 0.")
+
+    cur.execute("""
+        select ri.ingredient_id, p.name as ingrediente, ri.qty, coalesce(ri.conversion_factor,1) as conversion_factor
+          from resto.recipe_item ri
+          join resto.product p on p.id = ri.ingredient_id
+         where ri.recipe_id=%s
+         order by p.name;
+    """, (recipe["id"],))
+    ingredients = cur.fetchall()
+    if not ingredients:
+        raise ValueError("Ficha técnica sem ingredientes.")
+
+    ing_ids = sorted({int(it["ingredient_id"]) for it in ingredients})
+    # Serializa produções concorrentes que disputam os mesmos ingredientes (evita alocar o mesmo saldo duas vezes)
+    cur.execute("select id from resto.product where id = any(%s) order by id for update;", (ing_ids,))
+    lots = _lot_balances(cur, ing_ids)
+
+    scale = qty / yield_qty
+    consumos, faltantes = [], []
+    for it in ingredients:
+        need = float(it["qty"] or 0) * float(it["conversion_factor"]) * scale
+        remaining = need
+        for lot in lots.get(int(it["ingredient_id"]), []):
+            if remaining <= 0:
+                break
+            avail = float(lot["saldo"] or 0)
+            if avail <= 0:
+                continue
+            take = min(avail, remaining)
+            lot["saldo"] = avail - take   # mesmo ingrediente repetido na receita não reaproveita saldo
+            cost = float(lot["unit_price"] or 0)
+            consumos.append({"ingredient_id": int(it["ingredient_id"]), "ingrediente": it["ingrediente"],
+                             "lot_id": int(lot["lot_id"]), "qty": take, "unit_cost": cost, "total": take * cost})
+            remaining -= take
+        if remaining > 1e-9:
+            faltantes.append((it["ingrediente"], need, need - remaining))
+    if faltantes:
+        raise ValueError("Estoque insuficiente:\n" + "\n".join(
+            f"- {n}: precisa {q:.3f}, alocado {al:.3f}" for n, q, al in faltantes))
+
+    total_ing_cost = sum(c["total"] for c in consumos)
+    batch_cost = (total_ing_cost * (1 + float(recipe["overhead_pct"] or 0) / 100.0)
+                  * (1 + float(recipe["loss_pct"] or 0) / 100.0))
+    unit_cost = batch_cost / qty
+
+    cur.execute("""
+        insert into resto.production(date, product_id, qty, unit_cost, total_cost, lot_number, expiry_date, note)
+        values (now(), %s, %s, %s, %s, %s, %s, %s)
+        returning id;
+    """, (int(product_id), qty, unit_cost, batch_cost, (lot_number or None),
+          (str(expiry_date) if expiry_date else None), note or ""))
+    production_id = int(cur.fetchone()["id"])
+
+    # ids reservados antes do insert em lote: o OUT de cada consumo referencia o seu production_item
+    cur.execute("select nextval(pg_get_serial_sequence('resto.production_item','id')) as id "
+                "from generate_series(1, %s);", (len(consumos),))
+    for c, r in zip(consumos, cur.fetchall()):
+        c["id"] = int(r["id"])
+    cur.execute("""
+        insert into resto.production_item(id, production_id, ingredient_id, lot_id, qty, unit_cost, total_cost)
+        select t.id, %s, t.ingredient_id, t.lot_id, t.qty, t.unit_cost, t.total_cost
+          from unnest(%s::bigint[], %s::bigint[], %s::bigint[], %s::numeric[], %s::numeric[], %s::numeric[])
+               as t(id, ingredient_id, lot_id, qty, unit_cost, total_cost);
+    """, (production_id, [c["id"] for c in consumos], [c["ingredient_id"] for c in consumos],
+          [c["lot_id"] for c in consumos], [c["qty"] for c in consumos],
+          [c["unit_cost"] for c in consumos], [c["total"] for c in consumos]))
+    cur.executemany(
+        "select resto.sp_register_movement(%s,'OUT',%s,%s,'production',%s,%s);",
+        [(c["ingredient_id"], c["qty"], c["unit_cost"], c["id"], f"production:{production_id};lot:{c['lot_id']}")
+         for c in consumos],
+    )
+    cur.execute("select resto.sp_register_movement(%s,'IN',%s,%s,'production',%s,%s);",
+                (int(product_id), qty, unit_cost, production_id,
+                 f"production:{production_id}" + (f";lot:{lot_number}" if lot_number else "")))
+    return {"production_id": production_id, "batch_cost": batch_cost, "unit_cost": unit_cost, "consumos": consumos}
+
+
+# ===================== Extrato bancário → livro caixa =====================
+def cash_category_id(cur, kind: str, name: str) -> int:
+    """Garante e retorna o id da categoria (kind, name)."""
+    cur.execute("""
+        with upsert as (
+          insert into resto.cash_category(kind, name)
+          values (%s,%s)
+          on conflict (kind, name) do update set name=excluded.name
+          returning id
+        )
+        select id from upsert
+        union all
+        select id from resto.cash_category where kind=%s and name=%s limit 1;
+    """, (kind, name, kind, name))
+    return int(cur.fetchone()["id"])
+
+
+def _statement_rows(rows: List[Dict[str, Any]], in_cat: Optional[int], out_cat: Optional[int],
+                    method: Optional[str], src: int = 0, start: int = 0) -> List[Tuple]:
+    """category_id/supplier_id da linha (regras de categorização) têm precedência sobre o padrão do tipo."""
+    out = []
+    for i, r in enumerate(rows, start):
+        amount = round(float(r["amount"]), 2)
+        kind = "IN" if amount >= 0 else "OUT"
+        cat = _opt_int(r.get("category_id")) or (in_cat if kind == "IN" else out_cat)
+        out.append((src, i, r["entry_date"], kind, cat,
+                    (str(r["description"]) if r.get("description") is not None else "")[:300],
+                    amount, method or r.get("method") or "outro", _opt_int(r.get("supplier_id"))))
+    return out
+
+
+def _opt_int(v) -> Optional[int]:
+    return None if v is None or v != v else int(v)   # v != v: NaN
+
+
+def _stage_statement(cur, rows: List[Tuple], truncate: bool = True) -> None:
+    """COPY das linhas (src, ord, entry_date, kind, category_id, description, amount, method, supplier_id)
+       p/ _stmt_stage. src = nº do arquivo no lote; truncate=False acumula vários arquivos/pedaços."""
+    cur.execute("""
+        create temp table if not exists _stmt_stage (
+          src int, ord int, entry_date date, kind text, category_id bigint, description text,
+          amount numeric(14,2), method text, supplier_id bigint
+        ) on commit drop;
+    """)
+    if truncate:
+        cur.execute("truncate _stmt_stage;")
+    with cur.copy("copy _stmt_stage (src, ord, entry_date, kind, category_id, description, amount, method, "
+                  "supplier_id) from stdin") as cp:
+        for r in rows:
+            cp.write_row(r)
+
+
+def import_statement(cur, rows: List[Dict[str, Any]], out_category_id: Optional[int] = None,
+                     method: Optional[str] = None) -> Dict[str, int]:
+    """Lança linhas de extrato (entry_date, description, amount[, method, category_id, supplier_id]) no livro
+       caixa: COPY p/ staging temporária e um insert ... on conflict do nothing pelo content_hash.
+       Sem category_id na linha, entradas vão para 'Vendas (Importadas)' e saídas para out_category_id
+       (ou 'Despesas (Importadas)').
+       Linhas já existentes (mesma data, tipo, valor e descrição normalizada) — no banco ou repetidas
+       no lote — são ignoradas. Retorna {'inserted', 'duplicates'}."""
+    if not rows:
+        return {"inserted": 0, "duplicates": 0}
+    in_cat = cash_category_id(cur, *IMPORTED_SALES_CATEGORY)
+    out_cat = int(out_category_id) if out_category_id else cash_category_id(cur, *IMPORTED_EXPENSES_CATEGORY)
+    _stage_statement(cur, _statement_rows(rows, in_cat, out_cat, method))
+    # o índice único cobre só linhas importadas (lançamentos manuais idênticos são legítimos);
+    # o not exists evita reimportar o que já foi digitado à mão
+    cur.execute("""
+        insert into resto.cashbook(entry_date, kind, category_id, description, amount, method, supplier_id, source)
+        select s.entry_date, s.kind, s.category_id, s.description, s.amount, s.method, s.supplier_id, 'import'
+          from _stmt_stage s
+         where not exists (
+               select 1 from resto.cashbook c
+                where c.content_hash = resto.fn_cashbook_hash(s.entry_date, s.kind, s.amount, s.description))
+         order by s.ord
+        on conflict (content_hash) where source = 'import' do nothing;
+    """)
+    inserted = cur.rowcount or 0
+    return {"inserted": inserted, "duplicates": len(rows) - inserted}
+
+
+def import_statement_chunks(cur, chunks: Iterable[List[Dict[str, Any]]], out_category_id: Optional[int] = None,
+                            method: Optional[str] = None) -> Dict[str, int]:
+    """import_statement pedaço a pedaço, na transação de quem chama (o arquivo entra inteiro ou nada).
+       Repetições entre pedaços caem no on conflict, já que os anteriores foram inseridos na mesma transação."""
+    tot = {"inserted": 0, "duplicates": 0}
+    for rows in chunks:
+        res = import_statement(cur, rows, out_category_id, method)
+        tot["inserted"] += res["inserted"]
+        tot["duplicates"] += res["duplicates"]
+    return tot
+
+
+# ===================== Lote de extratos (vários arquivos) =====================
+def _stage_statement_chunks(cur, chunks: Iterable[Tuple[int, List[Dict[str, Any]]]], in_cat: Optional[int],
+                            out_cat: Optional[int], method: Optional[str]) -> Dict[int, int]:
+    """(nº do arquivo, linhas) em fluxo p/ _stmt_stage (esvaziada antes). Retorna linhas por arquivo."""
+    _stage_statement(cur, [])
+    counts: Dict[int, int] = {}
+    for src, rows in chunks:
+        n = counts.get(src, 0)
+        _stage_statement(cur, _statement_rows(rows, in_cat, out_cat, method, src, n), truncate=False)
+        counts[src] = n + len(rows)
+    return counts
+
+
+def scan_statement_batch(cur, chunks: Iterable[Tuple[int, List[Dict[str, Any]]]],
+                         preview_rows: int = 200) -> Dict[int, Dict[str, Any]]:
+    """Conferência de um lote sem gravar: as linhas vão em fluxo p/ a staging e só voltam contagens.
+       Duplicado = já lançado no livro caixa ou repetido antes no lote (mesmo critério da importação).
+       Retorna {nº do arquivo: {'rows', 'duplicates', 'preview_dups'}}; preview_dups = posições
+       (< preview_rows) das linhas duplicadas do arquivo."""
+    counts = _stage_statement_chunks(cur, chunks, None, None, None)
+    cur.execute("""
+        with s as (
+          select s.src, s.ord,
+                 exists (select 1 from resto.cashbook c where c.content_hash = s.h)
+                 or row_number() over (partition by s.h order by s.src, s.ord) > 1 as dup
+            from (select s.src, s.ord, resto.fn_cashbook_hash(s.entry_date, s.kind, s.amount, s.description) as h
+                    from _stmt_stage s) s
+        )
+        select src, count(*) filter (where dup) as duplicates,
+               coalesce(array_agg(ord order by ord) filter (where dup and ord < %s), '{}') as preview_dups
+          from s
+         group by src;
+    """, (int(preview_rows),))
+    dups = {int(r["src"]): r for r in cur.fetchall()}
+    return {src: {"rows": n, "duplicates": int(dups[src]["duplicates"]) if src in dups else 0,
+                  "preview_dups": list(dups[src]["preview_dups"]) if src in dups else []}
+            for src, n in counts.items()}
+
+
+def import_statement_batch(cur, files: List[Dict[str, Any]], out_category_id: Optional[int] = None,
+                           method: Optional[str] = None,
+                           chunks: Optional[Iterable[Tuple[int, List[Dict[str, Any]]]]] = None) -> Dict[str, Any]:
+    """Vários extratos como um lote rastreado. files: [{'name', 'layout', 'encoding'[, 'chunks']}], onde
+       chunks são listas de linhas (entry_date, description, amount[, method, category_id, supplier_id]).
+       Ou chunks à parte: (nº do arquivo, linhas) intercalados entre arquivos (ex.: bank.stream_statements).
+       Tudo vai para a mesma staging e entra num único insert: repetidos entre arquivos e já lançados
+       no livro caixa ficam de fora. Retorna {'batch_id', 'rows', 'inserted', 'duplicates', 'files'}."""
+    in_cat = cash_category_id(cur, *IMPORTED_SALES_CATEGORY)
+    out_cat = int(out_category_id) if out_category_id else cash_category_id(cur, *IMPORTED_EXPENSES_CATEGORY)
+    cur.execute("insert into resto.statement_import_batch default values returning id;")
+    batch_id = int(cur.fetchone()["id"])
+    if chunks is None:
+        chunks = ((src, rows) for src, f in enumerate(files) for rows in f["chunks"])
+    staged = _stage_statement_chunks(cur, chunks, in_cat, out_cat, method)
+    counts = [staged.get(src, 0) for src in range(len(files))]
+    # 1ª ocorrência de cada hash (ordem dos arquivos/linhas) que ainda não existe no livro caixa
+    cur.execute("""
+        with s as (
+          select s.*, resto.fn_cashbook_hash(s.entry_date, s.kind, s.amount, s.description) as h,
+                 row_number() over (partition by resto.fn_cashbook_hash(s.entry_date, s.kind, s.amount, s.description)
+                                    order by s.src, s.ord) as rn
+            from _stmt_stage s
+        ), ins as (
+          insert into resto.cashbook(entry_date, kind, category_id, description, amount, method, supplier_id,
+                                     source, import_batch_id)
+          select s.entry_date, s.kind, s.category_id, s.description, s.amount, s.method, s.supplier_id, 'import', %s
+            from s
+           where s.rn = 1
+             and not exists (select 1 from resto.cashbook c where c.content_hash = s.h)
+           order by s.src, s.ord
+          on conflict (content_hash) where source = 'import' do nothing
+          returning content_hash
+        )
+        select s.src, count(*) as inserted
+          from ins join s on s.h = ins.content_hash and s.rn = 1
+         group by s.src;
+    """, (batch_id,))
+    per_file = {int(r["src"]): int(r["inserted"]) for r in cur.fetchall()}
+    out_files = []
+    for src, f in enumerate(files):
+        out_files.append({"name": f["name"], "rows": counts[src], "inserted": per_file.get(src, 0)})
+        cur.execute("""
+            insert into resto.statement_import_file(batch_id, file_no, file_name, layout, encoding, rows, inserted)
+            values (%s, %s, %s, %s, %s, %s, %s);
+        """, (batch_id, src, f["name"], f.get("layout"), f.get("encoding"), counts[src], per_file.get(src, 0)))
+    rows, inserted = sum(counts), sum(per_file.values())
+    cur.execute("update resto.statement_import_batch set rows = %s, inserted = %s, duplicates = %s where id = %s;",
+                (rows, inserted, rows - inserted, batch_id))
+    return {"batch_id": batch_id, "rows": rows, "inserted": inserted, "duplicates": rows - inserted,
+            "files": out_files}
+
+
+def rollback_statement_batch(cur, batch_id: int) -> int:
+    """Desfaz o lote: apaga os lançamentos que ele inseriu (inclusive se recategorizados depois).
+       Mês fechado bloqueia pelo trigger de período. Retorna quantos lançamentos saíram."""
+    cur.execute("select rolled_back_at from resto.statement_import_batch where id = %s for update;", (batch_id,))
+    r = cur.fetchone()
+    if not r:
+        raise ValueError(f"Lote #{batch_id} não encontrado.")
+    if r["rolled_back_at"]:
+        raise ValueError(f"Lote #{batch_id} já foi desfeito.")
+    cur.execute("delete from resto.cashbook where import_batch_id = %s;", (batch_id,))
+    n = cur.rowcount or 0
+    cur.execute("update resto.statement_import_batch set rolled_back_at = now() where id = %s;", (batch_id,))
+    return n